@@ -1,8 +1,12 @@
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
-from urllib.parse import unquote_plus
+import click
+from urllib.parse import unquote_plus, urlparse
 import socket
+import smtplib
 from flask_mail import Mail, Message
+from markupsafe import Markup, escape
 import requests
+import urllib3
 import threading
 import time
 from datetime import datetime, timedelta
@@ -10,8 +14,12 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 import os
 import json
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from pywebpush import webpush, WebPushException
+from py_vapid import Vapid
 import hashlib
 from flask_compress import Compress
 import requests
@@ -94,9 +102,184 @@ monthly_payments_collection = db['monthly_payments']
 user_stats_collection = db['user_stats']
 winner_claims_collection = db['winner_claims']
 app_settings_collection = db['app_settings']
+# Read model for the supporters leaderboard (one small document per supporter)
+leaderboard_collection = db['leaderboard']
+# Applied schema migrations (see MIGRATIONS / run_migrations)
+schema_migrations_collection = db['schema_migrations']
+
+
+# Index manager
+# -------------
+# Every index the app relies on is declared with declare_index() next to the
+# code that queries it, and built idempotently by ensure_indexes() (init_db,
+# worker startup, `flask --app app ensure-indexes`). index_report() explains
+# the hot queries in HOT_QUERIES and flags any that still scan a collection.
+REQUIRED_INDEXES = OrderedDict()  # collection name -> [(keys, options)]
+
+
+def _index_keys(keys):
+    return [(keys, 1)] if isinstance(keys, str) else list(keys)
+
+
+def _index_name(keys):
+    """The name MongoDB gives an index on `keys` by default."""
+    return '_'.join(f'{field}_{direction}' for field, direction in _index_keys(keys))
+
+
+def declare_index(collection, keys, **options):
+    """Register an index for ensure_indexes(); options go to create_index()."""
+    REQUIRED_INDEXES.setdefault(collection, []).append((_index_keys(keys), options))
+
+
+def ensure_indexes(collections=None):
+    """Create the declared indexes (all collections, or only `collections`).
+    Existing identical indexes are left alone. Best-effort: failures, e.g. a
+    unique index over duplicate values, are printed and returned."""
+    ensured = 0
+    failed = []
+    for name, specs in REQUIRED_INDEXES.items():
+        if collections is not None and name not in collections:
+            continue
+        for keys, options in specs:
+            try:
+                db[name].create_index(keys, **options)
+                ensured += 1
+            except Exception as e:
+                print(f'indexes: {name}.{_index_name(keys)} not created:', e)
+                failed.append({'collection': name, 'index': _index_name(keys), 'error': str(e)})
+    return {'ensured': ensured, 'failed': failed}
+
+
+def _plan_stages(plan):
+    """Stage names of an explain() winning plan, outermost first."""
+    if not isinstance(plan, dict):
+        return []
+    plan = plan.get('queryPlan', plan)  # the slot-based engine nests the plan once more
+    stages = [plan['stage']] if plan.get('stage') else []
+    for child in plan.get('inputStages') or [plan.get('inputStage')]:
+        stages += _plan_stages(child)
+    return stages
+
+
+def index_report():
+    """Declared indexes missing from MongoDB, indexes MongoDB has that nothing
+    declares, and the winning plan of each hot query with COLLSCANs flagged."""
+    missing, undeclared = [], []
+    for name, specs in REQUIRED_INDEXES.items():
+        try:
+            existing = set(db[name].index_information())
+        except Exception as e:
+            print(f'indexes: could not list {name} indexes:', e)
+            continue
+        declared = {options.get('name') or _index_name(keys) for keys, options in specs}
+        missing += [{'collection': name, 'index': index} for index in sorted(declared - existing)]
+        undeclared += [{'collection': name, 'index': index} for index in sorted(existing - declared - {'_id_'})]
+
+    queries = []
+    for label, collection, query, sort in HOT_QUERIES:
+        row = {'query': label, 'collection': collection}
+        try:
+            cursor = db[collection].find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            row['stages'] = _plan_stages(cursor.explain().get('queryPlanner', {}).get('winningPlan'))
+            row['collscan'] = 'COLLSCAN' in row['stages']
+        except Exception as e:
+            row['error'] = str(e)
+        queries.append(row)
+    return {
+        'missing': missing,
+        'undeclared': undeclared,
+        'queries': queries,
+        'collscans': [row['query'] for row in queries if row.get('collscan')]
+    }
+
+# user_stats, monthly_payments and winner_claims reference users through a
+# `user_id` field. It used to hold str(ObjectId); migration 1 converts it to an
+# ObjectId so joins can use the user_id indexes. While USER_ID_DUAL_READ is on
+# (the compatibility window), reads also match the legacy string form.
+USER_ID_DUAL_READ = os.getenv('USER_ID_DUAL_READ', 'True').lower() in ('1', 'true', 'yes')
+
+
+def user_ref(user_id):
+    """Value to store in a `user_id` reference field (an ObjectId)."""
+    return user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+
+
+def user_ref_query(user_id):
+    """Filter value matching a `user_id` reference, in either form during the
+    dual-read window."""
+    oid = user_ref(user_id)
+    if USER_ID_DUAL_READ:
+        return {'$in': [oid, str(oid)]}
+    return oid
+
+
+_mongo_lookup_concise = None
+
+
+def mongo_supports_concise_lookup():
+    """True when the server (MongoDB >= 5.0) accepts localField/foreignField
+    together with a `pipeline` in one $lookup (checked once)."""
+    global _mongo_lookup_concise
+    if _mongo_lookup_concise is None:
+        try:
+            _mongo_lookup_concise = client.server_info().get('versionArray', [0])[0] >= 5
+        except Exception as e:
+            print('lookups: could not detect server version', e)
+            _mongo_lookup_concise = False
+    return _mongo_lookup_concise
+
+
+def _lookup_stage(from_collection, local_field, foreign_field, as_field, pipeline=None):
+    """One $lookup matching local_field (a value or an array of values) against
+    foreign_field. Without a pipeline, or on MongoDB >= 5.0, this is an equality
+    join that uses the foreign index; older servers get the let/$expr form."""
+    if not pipeline or mongo_supports_concise_lookup():
+        lookup = {'from': from_collection, 'localField': local_field, 'foreignField': foreign_field, 'as': as_field}
+        if pipeline:
+            lookup['pipeline'] = pipeline
+        return {'$lookup': lookup}
+    local = f'${local_field}'
+    match = {'$cond': [{'$isArray': '$$local'},
+                       {'$in': [f'${foreign_field}', '$$local']},
+                       {'$eq': [f'${foreign_field}', '$$local']}]}
+    return {'$lookup': {'from': from_collection, 'let': {'local': local}, 'as': as_field,
+                        'pipeline': [{'$match': {'$expr': match}}] + list(pipeline)}}
+
+
+def user_ref_lookup(from_collection, as_field, pipeline=None):
+    """$lookup stages joining users._id to `<from_collection>.user_id` with an
+    equality (localField/foreignField) join, so the foreign user_id index is
+    used. During the dual-read window the local side is the pair
+    [_id, str(_id)], which still matches either stored form through the index."""
+    stages = []
+    local_field = '_id'
+    if USER_ID_DUAL_READ:
+        stages.append({'$addFields': {'_user_refs': ['$_id', {'$toString': '$_id'}]}})
+        local_field = '_user_refs'
+    stages.append(_lookup_stage(from_collection, local_field, 'user_id', as_field, pipeline))
+    return stages
+
+
+def user_lookup(as_field='user', fields=None):
+    """$lookup stages joining a document's `user_id` reference to users._id."""
+    stages = []
+    local_field = 'user_id'
+    if USER_ID_DUAL_READ:
+        stages.append({'$addFields': {'_user_oid': {'$convert': {'input': '$user_id', 'to': 'objectId', 'onError': None, 'onNull': None}}}})
+        local_field = '_user_oid'
+    stages.append(_lookup_stage('users', local_field, '_id', as_field,
+                                [{'$project': dict(fields)}] if fields else None))
+    stages.append({'$unwind': '$' + as_field})
+    return stages
 
 # Collection for storing push subscriptions
 push_subscriptions_collection = db['push_subscriptions']
+# Rendered notification HTML, content-addressed; pushes carry only the id
+push_messages_collection = db['push_messages']
+# One document per (user, set of missed months) warning, used to dedupe sends
+missed_payment_warnings_collection = db['missed_payment_warnings']
 
 
 @app.route('/vapid_public_key', methods=['GET'])
@@ -120,6 +303,14 @@ def _normalize_subscription(sub):
         return None
 
 
+def _subscription_expires_at(expiration_time):
+    """expirationTime (ms since epoch, or null) as a UTC datetime for the TTL index."""
+    try:
+        return datetime.utcfromtimestamp(float(expiration_time) / 1000) if expiration_time else None
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
 @app.route('/subscribe', methods=['POST'])
 def subscribe():
     try:
@@ -141,10 +332,19 @@ def subscribe():
             # Return diagnostic info to help debugging from client
             return jsonify({'status': 'error', 'message': 'invalid subscription', 'received': sub, 'raw': raw[:2000]}), 400
 
+        fields = {'keys': norm.get('keys', {}), 'expirationTime': norm.get('expirationTime'),
+                  'expires_at': _subscription_expires_at(norm.get('expirationTime')), 'created_at': datetime.utcnow()}
+        # Link the subscription to the signed-in user for segmented pushes
+        if 'user_id' in session:
+            try:
+                fields.update(push_targeting(session['user_id']))
+            except Exception as e:
+                print('subscribe: push targeting failed', e)
+
         # Upsert by endpoint to avoid duplicates
         result = push_subscriptions_collection.update_one(
             {'endpoint': norm['endpoint']},
-            {'$set': {'keys': norm.get('keys', {}), 'expirationTime': norm.get('expirationTime'), 'created_at': datetime.utcnow()}},
+            {'$set': fields},
             upsert=True
         )
         # Convert any ObjectId to string so jsonify doesn't fail
@@ -152,7 +352,8 @@ def subscribe():
         upserted_id = str(upserted) if upserted is not None else None
         matched = getattr(result, 'matched_count', None)
         # Return the normalized subscription and upsert result for debugging
-        return jsonify({'status': 'ok', 'normalized': norm, 'matched_count': matched, 'upserted_id': upserted_id}), 201
+        return jsonify({'status': 'ok', 'normalized': norm, 'matched_count': matched, 'upserted_id': upserted_id,
+                        'linked': 'user_id' in fields}), 201
     except Exception as e:
         print('subscribe error', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -172,42 +373,341 @@ def unsubscribe():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+# Web push delivery
+# -----------------
+PUSH_WORKERS = int(os.getenv('PUSH_WORKERS', '16'))
+PUSH_TIMEOUT = float(os.getenv('PUSH_TIMEOUT', '10'))
+# Transient push-service failures (429, 5xx, network) are retried with backoff
+PUSH_RETRIES = int(os.getenv('PUSH_RETRIES', '2'))
+PUSH_RETRY_BACKOFF = float(os.getenv('PUSH_RETRY_BACKOFF', '1'))
+PUSH_RETRY_MAX_WAIT = float(os.getenv('PUSH_RETRY_MAX_WAIT', '30'))
+# A broadcast runs inside the /notify request: no retries start after this many seconds
+PUSH_RETRY_BUDGET = float(os.getenv('PUSH_RETRY_BUDGET', '30'))
+PUSH_SERVICES = (
+    ('fcm.googleapis.com', 'fcm'),
+    ('push.services.mozilla.com', 'mozilla'),
+    ('push.apple.com', 'apple')
+)
+
+# Signed VAPID JWTs are valid for at most 24h; re-sign a little before expiry
+VAPID_JWT_TTL = min(86400, int(os.getenv('VAPID_JWT_TTL', str(12 * 3600))))
+VAPID_JWT_REFRESH_MARGIN = int(os.getenv('VAPID_JWT_REFRESH_MARGIN', '600'))
+
+_push_sessions = {}
+_push_sessions_lock = threading.Lock()
+_vapid_key = None
+_vapid_headers = {}  # push-service origin -> (authorization headers, exp)
+_vapid_lock = threading.Lock()
+
+
+def push_service(endpoint):
+    """Name of the push service behind a subscription endpoint."""
+    host = urlparse(endpoint or '').hostname or ''
+    for suffix, name in PUSH_SERVICES:
+        if host == suffix or host.endswith('.' + suffix):
+            return name
+    return 'other'
+
+
+def push_session(endpoint):
+    """Keep-alive requests.Session per push-service origin, pooled for the broadcast workers."""
+    parts = urlparse(endpoint)
+    origin = f'{parts.scheme}://{parts.netloc}'
+    session_ = _push_sessions.get(origin)
+    if session_ is None:
+        with _push_sessions_lock:
+            session_ = _push_sessions.get(origin)
+            if session_ is None:
+                from requests.adapters import HTTPAdapter
+                session_ = requests.Session()
+                session_.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=PUSH_WORKERS))
+                _push_sessions[origin] = session_
+    return session_
+
+
+def vapid_key():
+    """VAPID signing key parsed once from VAPID_PRIVATE_KEY (PEM, raw base64 or a file path)."""
+    global _vapid_key
+    if _vapid_key is None:
+        with _vapid_lock:
+            if _vapid_key is None:
+                private = os.getenv('VAPID_PRIVATE_KEY')
+                if not private:
+                    raise RuntimeError('VAPID_PRIVATE_KEY not set')
+                if os.path.isfile(private):
+                    _vapid_key = Vapid.from_file(private_key_file=private)
+                else:
+                    _vapid_key = Vapid.from_string(private_key=private)
+    return _vapid_key
+
+
+def vapid_headers(endpoint):
+    """VAPID Authorization header for the endpoint's push service, signed once
+    per origin and reused until shortly before the JWT expires."""
+    parts = urlparse(endpoint)
+    aud = f'{parts.scheme}://{parts.netloc}'
+    cached = _vapid_headers.get(aud)
+    if cached and cached[1] - VAPID_JWT_REFRESH_MARGIN > time.time():
+        return cached[0]
+    with _vapid_lock:
+        cached = _vapid_headers.get(aud)
+        if cached and cached[1] - VAPID_JWT_REFRESH_MARGIN > time.time():
+            return cached[0]
+        exp = int(time.time()) + VAPID_JWT_TTL
+        headers = vapid_key().sign({
+            'sub': os.getenv('VAPID_SUB', 'mailto:admin@example.com'),
+            'aud': aud,
+            'exp': exp
+        })
+        _vapid_headers[aud] = (headers, exp)
+        return headers
+
+
+def _push_retry_wait(response, attempt):
+    """Seconds to wait before retrying: the push service's Retry-After if it
+    sent one, else exponential backoff."""
+    try:
+        wait = float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        wait = PUSH_RETRY_BACKOFF * (2 ** attempt)
+    return min(max(wait, 0), PUSH_RETRY_MAX_WAIT)
+
+
+def _push_connect_failed(ex):
+    """True if a requests error happened before the push service could have
+    received the message (connection refused, DNS, connect timeout). Read
+    timeouts and dropped responses are not retried: the push may have landed."""
+    reason = getattr(ex.args[0], 'reason', None) if ex.args else None
+    return isinstance(ex, requests.exceptions.ConnectTimeout) or isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+def _deliver_push(subscription_doc, data, retry_until=None):
+    """Send pre-serialised push data to one subscription, retrying transient
+    failures (429, 5xx, connect errors) up to PUSH_RETRIES times, and not
+    past the `retry_until` timestamp when one is given.
+    Returns ('sent' | 'expired' | 'failed', http status or None, retries)."""
+    endpoint = subscription_doc['endpoint']
+    for attempt in range(PUSH_RETRIES + 1):
+        response = None
+        try:
+            webpush(
+                subscription_info={
+                    'endpoint': endpoint,
+                    'keys': subscription_doc.get('keys', {})
+                },
+                data=data,
+                headers=vapid_headers(endpoint),
+                timeout=PUSH_TIMEOUT,
+                requests_session=push_session(endpoint)
+            )
+            return 'sent', 201, attempt
+        except WebPushException as ex:
+            response = getattr(ex, 'response', None)
+            status_code = getattr(response, 'status_code', None)
+            # 404/410: the browser unsubscribed or the subscription expired
+            if status_code in (404, 410):
+                return 'expired', status_code, attempt
+            print('webpush exception', ex, 'status_code=', status_code)
+            if status_code != 429 and not (status_code or 0) >= 500:
+                return 'failed', status_code, attempt
+        except requests.exceptions.RequestException as ex:
+            print('webpush request error', endpoint[:60], ex)
+            status_code = None
+            if not _push_connect_failed(ex):
+                return 'failed', None, attempt
+        if attempt == PUSH_RETRIES:
+            break
+        wait = _push_retry_wait(response, attempt)
+        if retry_until is not None and time.time() + wait > retry_until:
+            return 'failed', status_code, attempt
+        time.sleep(wait)
+    return 'failed', status_code, PUSH_RETRIES
+
+
 def send_push(subscription_doc, payload):
     """Send a single web-push to a stored subscription document.
     subscription_doc must include 'endpoint' and 'keys'."""
-    private = os.getenv('VAPID_PRIVATE_KEY')
-    if not private:
-        raise RuntimeError('VAPID_PRIVATE_KEY not set')
+    outcome, _, _ = _deliver_push(subscription_doc, json.dumps(payload))
+    return outcome == 'sent'
+
+
+def remove_push_subscriptions(ids, chunk_size=1000):
+    """Delete subscriptions by _id in a few delete_many round trips. Returns the count removed."""
+    removed = 0
+    ids = list(ids)
+    for i in range(0, len(ids), chunk_size):
+        removed += push_subscriptions_collection.delete_many({'_id': {'$in': ids[i:i + chunk_size]}}).deleted_count
+    return removed
+
+
+def broadcast_push(payload, query=None, progress=None):
+    """Deliver payload to every subscription matching query on a bounded thread
+    pool, streaming subscriptions from a cursor rather than loading them all.
+    Subscriptions the push service reports gone (404/410) are collected and
+    removed in bulk at the end; other failures keep their subscription.
+    Retries stop PUSH_RETRY_BUDGET seconds into the broadcast. `progress`, if
+    given, is called with the running counts every few seconds.
+    Returns counts, per-service counts and elapsed seconds."""
+    vapid_key()  # fail fast when the key is missing or invalid
+    started = time.time()
+    retry_until = started + PUSH_RETRY_BUDGET
+    data = json.dumps(payload)
+    counts = {'sent': 0, 'failed': 0, 'expired': 0, 'removed': 0, 'retried': 0}
+    by_service = {}
+    expired_ids = []
+    counts_lock = threading.Lock()
+    last_report = [started]
+    # Cap in-flight subscriptions so the cursor is consumed at delivery speed
+    slots = threading.BoundedSemaphore(PUSH_WORKERS * 4)
+
+    def deliver(sub):
+        try:
+            try:
+                outcome, _, retries = _deliver_push(sub, data, retry_until)
+            except Exception as e:
+                print('push delivery error', e)
+                outcome, retries = 'failed', 0
+            service = push_service(sub.get('endpoint'))
+            report = None
+            with counts_lock:
+                counts[outcome] += 1
+                counts['retried'] += retries
+                if outcome == 'expired':
+                    expired_ids.append(sub['_id'])
+                by_service.setdefault(service, {'sent': 0, 'failed': 0, 'expired': 0})[outcome] += 1
+                if progress and time.time() - last_report[0] >= 2:
+                    last_report[0] = time.time()
+                    report = dict(counts, elapsed_seconds=round(last_report[0] - started, 3))
+            if report:
+                progress(report)
+        finally:
+            slots.release()
+
+    cursor = push_subscriptions_collection.find(query or {}, {'endpoint': 1, 'keys': 1}, batch_size=500)
+    with ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix='push') as pool:
+        for sub in cursor:
+            slots.acquire()
+            pool.submit(deliver, sub)
+    if expired_ids:
+        try:
+            counts['removed'] = remove_push_subscriptions(expired_ids)
+        except Exception as e:
+            print('push broadcast: expired subscription cleanup failed', e)
+    result = dict(counts, services=by_service, elapsed_seconds=round(time.time() - started, 3))
+    print('push broadcast', result)
+    return result
+
+
+def store_push_message(html, allow_js=False):
+    """Store notification HTML once under a content hash and return its id.
+    Identical broadcasts reuse the same document."""
+    allow_js = bool(allow_js)
+    message_id = hashlib.sha256(f'{int(allow_js)}:{html}'.encode('utf-8')).hexdigest()[:32]
+    push_messages_collection.update_one(
+        {'_id': message_id},
+        {'$setOnInsert': {'html': html, 'allow_js': allow_js, 'created_at': datetime.utcnow()}},
+        upsert=True
+    )
+    return message_id
+
+
+# Push segments
+# -------------
+# Subscriptions carry copies of their user's targeting fields (user_id, nation,
+# is_premium, last_paid_month) so a segment is a plain indexed query. They are
+# refreshed on subscribe, nation selection and payment completion, and nightly
+# by the reconcile-stats job.
+PUSH_SEGMENT_KEYS = ('nation', 'premium', 'unpaid')
+
+
+def push_targeting(user_id):
+    """Targeting fields to copy onto a user's push subscriptions."""
+    oid = user_ref(user_id)
+    user = users_collection.find_one({'_id': oid}, {'nation': 1, 'is_premium': 1}) or {}
+    stats = user_stats_collection.find_one({'user_id': user_ref_query(oid)}, {'last_payment_month': 1}) or {}
+    return {
+        'user_id': oid,
+        'nation': user.get('nation'),
+        'is_premium': bool(user.get('is_premium')),
+        'last_paid_month': stats.get('last_payment_month')
+    }
 
+
+def sync_push_targeting(user_id):
+    """Refresh the targeting fields on every subscription linked to user_id. Best-effort."""
     try:
-        webpush(
-            subscription_info={
-                'endpoint': subscription_doc['endpoint'],
-                'keys': subscription_doc.get('keys', {})
-            },
-            data=json.dumps(payload),
-            vapid_private_key=private,
-            vapid_claims={"sub": os.getenv('VAPID_SUB', 'mailto:admin@example.com')}
-        )
-        return True
-    except WebPushException as ex:
-        # If subscription is gone or unsubscribed, remove it (410 or 404)
-        try:
-            status_code = getattr(ex, 'response', None) and getattr(ex.response, 'status_code', None)
-            print('webpush exception', ex, 'status_code=', status_code)
-        except Exception:
-            print('webpush exception', ex)
-        return False
+        fields = push_targeting(user_id)
+        push_subscriptions_collection.update_many({'user_id': fields['user_id']}, {'$set': fields})
+    except Exception as e:
+        print('push targeting: sync failed for', user_id, e)
+
+
+def refresh_push_targeting():
+    """Re-sync targeting for every user with a linked subscription. Returns the user count."""
+    user_ids = push_subscriptions_collection.distinct('user_id', {'user_id': {'$ne': None}})
+    for user_id in user_ids:
+        sync_push_targeting(user_id)
+    return len(user_ids)
+
+
+def push_segment_query(segment):
+    """Subscription filter for a /notify segment. An empty segment is everyone;
+    otherwise a dict combining `nation` (name), `premium` (bool) and `unpaid`
+    (no completed payment for the current month). Raises ValueError."""
+    if not segment:
+        return {}
+    if not isinstance(segment, dict):
+        raise ValueError('segment must be an object')
+    unknown = set(segment) - set(PUSH_SEGMENT_KEYS)
+    if unknown:
+        raise ValueError(f'unknown segment keys: {", ".join(sorted(unknown))}')
+    query = {}
+    if segment.get('nation'):
+        query['nation'] = segment['nation']
+    if segment.get('premium') is not None:
+        query['is_premium'] = bool(segment['premium'])
+    if segment.get('unpaid'):
+        # Like the reminder e-mails: only supporters who picked a nation
+        query.setdefault('nation', {'$ne': None})
+        query['last_paid_month'] = {'$ne': get_current_month_year()}
+    return query
+
+
+# Parse the VAPID key at startup so a bad key shows up in the boot log
+if os.getenv('VAPID_PRIVATE_KEY'):
+    try:
+        vapid_key()
+    except Exception as e:
+        print('VAPID_PRIVATE_KEY could not be parsed', e)
+
+
+def cleanup_dead_push_subscriptions():
+    """Delete subscriptions that can no longer receive pushes: past the
+    browser-reported expirationTime (ms since epoch), or stored without an
+    endpoint or keys. Returns the number removed. Subscriptions stored with
+    expires_at are also dropped by the TTL index; this catches older ones."""
+    res = push_subscriptions_collection.delete_many({'$or': [
+        {'expirationTime': {'$lt': int(time.time() * 1000)}},
+        {'endpoint': {'$in': [None, '']}},
+        {'keys.p256dh': {'$exists': False}}
+    ]})
+    return res.deleted_count
 
 
 @app.route('/notify', methods=['POST'])
 def notify():
     """Admin-protected endpoint to broadcast a notification to all stored subscriptions.
-    Body: { title, body, url (optional) }
+    Body: { title, body, url (optional), segment (optional, see push_segment_query) }
+    Returns 202 with the id of the admin job delivering it (see /admin/jobs/<id>).
     """
-    # TODO: protect this endpoint with admin auth in production
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
     try:
         data = request.get_json(force=True) or {}
+        try:
+            query = push_segment_query(data.get('segment'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         title = data.get('title', 'WC 2026')
         body = data.get('body', '')
         url = data.get('url')
@@ -217,6 +717,7 @@ def notify():
         if url:
             payload['data']['url'] = url
         html = data.get('html')
+        message_html = html
         # If raw HTML not provided, but a structured template was sent, render it server-side
         if not html and isinstance(data.get('template'), dict):
             try:
@@ -229,41 +730,26 @@ def notify():
                                            image=tmpl.get('image'),
                                            cta_text=tmpl.get('cta_text'),
                                            cta_url=tmpl.get('cta_url'))
-                payload['data']['html'] = rendered
+                message_html = rendered
                 # Mark that this notification used a template (for debugging)
                 payload['data']['template_used'] = True
             except Exception as e:
                 print('template render failed', e)
                 html = None
-        elif html:
-            # include raw html as part of the payload data (clients should sanitize/use as needed)
-            payload['data']['html'] = html
-        # allow_js: whether the admin allows scripts to run in the notification viewer
-        # Default behaviour: if admin sent HTML and didn't explicitly set allow_js,
-        # treat allow_js as True (per user's request to make it true by default).
-        if 'allow_js' in data:
-            allow_js = bool(data.get('allow_js'))
-        else:
-            allow_js = bool(html)
-        if allow_js:
-            payload['data']['allow_js'] = True
-
-        subs = list(push_subscriptions_collection.find({}))
-        removed = 0
-        sent = 0
-        for s in subs:
-            ok = send_push(s, payload)
-            if ok:
-                sent += 1
-            else:
-                # best-effort remove (cleanup)
-                try:
-                    push_subscriptions_collection.delete_one({'_id': s['_id']})
-                    removed += 1
-                except Exception:
-                    pass
-
-        return jsonify({'status': 'ok', 'sent': sent, 'removed': removed}), 200
+        # allow_js: whether the admin allows scripts to run in the notification
+        # viewer, which is served from this origin; off unless explicitly asked for
+        allow_js = bool(data.get('allow_js', False))
+        if message_html:
+            # Ship only a reference; the viewer fetches the stored HTML
+            message_id = store_push_message(message_html, allow_js)
+            payload['data']['message_id'] = message_id
+            payload['data']['viewer_url'] = url_for('push_message_viewer', message_id=message_id)
+
+        vapid_key()  # fail now rather than in the job when the key is missing or invalid
+        # Large segments take minutes: deliver from a background job the panel polls
+        job_id = submit_admin_job('push-broadcast', {'payload': payload, 'segment': data.get('segment')},
+                                  created_by=session.get('user_id'))
+        return jsonify({'status': 'ok', 'job_id': job_id}), 202
     except Exception as e:
         print('notify error', e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -307,6 +793,24 @@ def push_viewer():
     allow_js = request.args.get('allow_js') in ('1', 'true', 'True')
     return render_template('push_viewer.html', html=html, allow_js=allow_js)
 
+
+@app.route('/push-viewer/<message_id>')
+def push_message_viewer(message_id):
+    """Render a stored notification. Ids are content hashes, so the page never
+    changes and can be cached for as long as clients like."""
+    if request.if_none_match.contains(message_id):
+        response = app.response_class(status=304)
+    else:
+        message = push_messages_collection.find_one({'_id': message_id})
+        if not message:
+            return render_template('push_viewer.html', html='<p>This notification is no longer available.</p>',
+                                   allow_js=False), 404
+        response = app.make_response(render_template('push_viewer.html', html=message.get('html') or '',
+                                                     allow_js=bool(message.get('allow_js'))))
+    response.set_etag(message_id)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 # Razorpay is deprecated in this deployment; keep placeholders in env for compatibility but do not initialize client
 try:
     import razorpay  # optional dependency
@@ -328,6 +832,316 @@ app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
 
 mail = Mail(app)
 
+# Outbound email rate limits, per provider, in messages per second. Every
+# delivery path (single sends and bulk batches) takes tokens from the bucket
+# of the transport it uses.
+EMAIL_RATE_SMTP = float(os.getenv('EMAIL_RATE_SMTP', '2'))
+EMAIL_BURST_SMTP = float(os.getenv('EMAIL_BURST_SMTP', '10'))
+EMAIL_RATE_BREVO = float(os.getenv('EMAIL_RATE_BREVO', '100'))
+EMAIL_BURST_BREVO = float(os.getenv('EMAIL_BURST_BREVO', '1000'))
+# After a throttling reply the rate is halved (down to 1/16 of the configured
+# rate) and only starts climbing back once this many seconds pass without one
+EMAIL_RATE_COOLDOWN = float(os.getenv('EMAIL_RATE_COOLDOWN', '60'))
+# Outbox workers do not wait longer than this for a token; the rest of the
+# batch goes back to the queue without using up a delivery attempt
+EMAIL_RATE_MAX_WAIT = float(os.getenv('EMAIL_RATE_MAX_WAIT', '30'))
+
+
+class AdaptiveTokenBucket:
+    """Thread-safe token bucket with additive-increase/multiplicative-decrease.
+
+    acquire(n) blocks until n tokens are available; a request larger than the
+    burst is allowed and simply waits longer. With max_wait it instead gives
+    up (taking nothing) when the wait would be longer. throttled() halves the rate,
+    empties the bucket and holds the rate down for `cooldown` seconds;
+    succeeded() then raises it back towards the configured rate step by step.
+    """
+
+    def __init__(self, name, rate, burst, cooldown=60):
+        self.name = name
+        self.max_rate = max(0.01, rate)
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = max(1.0, burst)
+        self.cooldown = cooldown
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._throttled_at = None
+        self._lock = threading.Lock()
+        self.throttle_count = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, n=1, max_wait=None):
+        """Take n tokens, sleeping as long as needed. Returns the seconds waited,
+        or None without taking any when that would exceed max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = (n - self._tokens) / self.rate if self._tokens < n else 0.0
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= n
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+            self._throttled_at = time.monotonic()
+            self.throttle_count += 1
+            rate = self.rate
+        print(f'email rate [{self.name}]: throttled, slowing to {rate:.2f} msg/s')
+
+    def succeeded(self, n=1):
+        with self._lock:
+            if self.rate >= self.max_rate:
+                return
+            if self._throttled_at is not None and time.monotonic() - self._throttled_at < self.cooldown:
+                return
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05 * n)
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': round(self.rate, 3),
+                'max_rate': self.max_rate,
+                'burst': self.burst,
+                'tokens': round(self._tokens, 2),
+                'throttle_count': self.throttle_count
+            }
+
+
+email_rate_limiters = {
+    'smtp': AdaptiveTokenBucket('smtp', EMAIL_RATE_SMTP, EMAIL_BURST_SMTP, EMAIL_RATE_COOLDOWN),
+    'brevo': AdaptiveTokenBucket('brevo', EMAIL_RATE_BREVO, EMAIL_BURST_BREVO, EMAIL_RATE_COOLDOWN)
+}
+
+# SMTP replies that mean "slow down" rather than "this message is bad"
+SMTP_THROTTLE_CODES = (421, 450, 451, 452, 454)
+
+
+def smtp_throttled(err):
+    """True if an smtplib error is the server rate-limiting us."""
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return any(code in SMTP_THROTTLE_CODES for code, _ in err.recipients.values())
+    return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code in SMTP_THROTTLE_CODES
+
+
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '2'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '10'))  # seconds, connect and per command
+# Idle connections older than this are closed rather than reused (servers drop them)
+SMTP_MAX_IDLE = float(os.getenv('SMTP_MAX_IDLE', '60'))
+SMTP_HEALTH_TTL = float(os.getenv('SMTP_HEALTH_TTL', '30'))
+
+
+class SMTPConnectionPool:
+    """A small pool of authenticated Flask-Mail connections.
+
+    Connections are opened lazily (TLS handshake and login happen once per
+    connection, not per message), handed out one per thread and returned
+    after use. A connection that fails is closed and the send is retried once
+    on a fresh one, so a server-side disconnect costs a reconnect rather than
+    a lost message.
+    """
+
+    def __init__(self, mail, size=2, timeout=10, max_idle=60, health_ttl=30):
+        self.mail = mail
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_ttl = health_ttl
+        self._idle = []  # [(connection, returned_at)], most recent last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._health = None  # (checked_at, ok, detail)
+        self.opened = 0
+        self.sent = 0
+        self.errors = 0
+
+    def _configure_host(self):
+        # Same as flask_mail.Connection.configure_host, plus a socket timeout
+        if self.mail.use_ssl:
+            host = smtplib.SMTP_SSL(self.mail.server, self.mail.port, timeout=self.timeout)
+        else:
+            host = smtplib.SMTP(self.mail.server, self.mail.port, timeout=self.timeout)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+    def _open(self):
+        conn = self.mail.connect()
+        conn.num_emails = 0
+        conn.host = None if self.mail.suppress else self._configure_host()
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            if conn.host:
+                conn.host.quit()
+        except Exception:
+            try:
+                conn.host.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """Check out a connection, reusing a recently returned one if possible."""
+        if not self._slots.acquire(timeout=self.timeout * 3):
+            raise TimeoutError('no SMTP connection available')
+        try:
+            stale = []
+            conn = None
+            with self._lock:
+                while self._idle:
+                    candidate, returned_at = self._idle.pop()
+                    if time.time() - returned_at <= self.max_idle:
+                        conn = candidate
+                        break
+                    stale.append(candidate)
+            for old in stale:
+                self._close(old)
+            return conn or self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    @staticmethod
+    def _connection_lost(err):
+        # Errors after which the connection itself is unusable
+        if isinstance(err, (smtplib.SMTPServerDisconnected, OSError)):
+            return True
+        return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code == 421
+
+    def send_many(self, messages, limiter=None, max_wait=None):
+        """Send Message objects over one connection; returns [(ok, error)].
+        Each message first takes a token from `limiter`; a throttling reply
+        slows the limiter down and fails the rest of the batch for a later retry,
+        as does a token wait longer than `max_wait`.
+        Must be called inside an application context."""
+        results = []
+        conn = self.acquire()
+        broken = False
+        deferred = 'deferred: SMTP server is throttling'
+        try:
+            for msg in messages:
+                if limiter and limiter.acquire(max_wait=max_wait) is None:
+                    deferred = 'deferred: local SMTP rate limit'
+                    break
+                error = None
+                throttled = False
+                for attempt in (1, 2):
+                    try:
+                        conn.send(msg)
+                        error = None
+                        break
+                    except Exception as e:
+                        error = str(e) or e.__class__.__name__
+                        if smtp_throttled(e):
+                            throttled = True
+                            broken = self._connection_lost(e)
+                            break
+                        if not self._connection_lost(e):
+                            break  # e.g. a refused recipient; the connection is fine
+                        self._close(conn)
+                        conn = self._open()  # reconnect, then retry this message once
+                with self._lock:
+                    if error is None:
+                        self.sent += 1
+                    else:
+                        self.errors += 1
+                results.append((error is None, error))
+                if throttled:
+                    if limiter:
+                        limiter.throttled()
+                    print(f'smtp pool: throttled by server ({error}), deferring {len(messages) - len(results)} messages')
+                    break
+                if error is None and limiter:
+                    limiter.succeeded()
+        except Exception as e:
+            # Could not reconnect: fail the rest of the batch and drop the connection
+            print('smtp pool: reconnect failed:', e)
+            results.extend((False, f'SMTP unavailable: {e}') for _ in range(len(messages) - len(results)))
+            self.release(conn, broken=True)
+            return results
+        results.extend((False, deferred) for _ in range(len(messages) - len(results)))
+        self.release(conn, broken=broken)
+        return results
+
+    def send(self, msg, limiter=None):
+        ok, error = self.send_many([msg], limiter=limiter)[0]
+        if not ok:
+            raise smtplib.SMTPException(error)
+        return True
+
+    def health_check(self, force=False):
+        """(ok, detail) from an SMTP NOOP on a pooled connection; cached for health_ttl seconds."""
+        cached = self._health
+        if not force and cached and time.time() - cached[0] < self.health_ttl:
+            return cached[1], cached[2]
+        if self.mail.suppress:
+            ok, detail = True, 'mail suppressed'
+        else:
+            ok, detail = False, None
+            for attempt in (1, 2):
+                try:
+                    conn = self.acquire()
+                except Exception as e:
+                    detail = f'connect failed: {e}'
+                    break
+                try:
+                    code = conn.host.noop()[0]
+                    ok, detail = code == 250, f'NOOP {code}'
+                except Exception as e:
+                    detail = f'NOOP failed: {e}'
+                self.release(conn, broken=not ok)
+                if ok:
+                    break
+                # A pooled connection may simply have gone stale; retry on a fresh one
+        self._health = (time.time(), ok, detail)
+        return ok, detail
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'opened': self.opened,
+                'sent': self.sent,
+                'errors': self.errors,
+                'healthy': self._health[1] if self._health else None,
+                'health_detail': self._health[2] if self._health else None
+            }
+
+
+smtp_pool = SMTPConnectionPool(mail, size=SMTP_POOL_SIZE, timeout=SMTP_TIMEOUT,
+                               max_idle=SMTP_MAX_IDLE, health_ttl=SMTP_HEALTH_TTL)
+
 # --- Startup ping to wake external webhook(s) on application start ---
 # Configure one or more comma-separated URLs via STARTUP_PING_URLS env var.
 STARTUP_PING_URLS = os.getenv('STARTUP_PING_URLS', 'https://sms-webhook-9l8c.onrender.com/')
@@ -370,7 +1184,9 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 # Email sending functions
-def send_email(subject, recipients, html_body):
+def deliver_email(subject, recipients, html_body):
+    """Send one email right now over Brevo or SMTP. Returns True on success.
+    Request handlers should call send_email(), which queues through the outbox."""
     import traceback
     try:
         # Normalize recipients: allow a single string or iterable; filter out falsy values
@@ -406,113 +1222,533 @@ def send_email(subject, recipients, html_body):
                 print('send_email: BREVO requested via USE_BREVO but BREVO_API_KEY is not set')
                 return False
 
-            brevo_url = 'https://api.brevo.com/v3/smtp/email'
-            headers = {
-                'accept': 'application/json',
-                'api-key': brevo_api_key,
-                'content-type': 'application/json'
-            }
+            ok, error = brevo_send_batch([(subject, recip_list, html_body)], api_key=brevo_api_key)[0]
+            if not ok:
+                print(f'send_email: {error}')
+            return ok
 
-            # Build payload
-            sender_email = app.config.get('MAIL_DEFAULT_SENDER') or os.getenv('MAIL_DEFAULT_SENDER') or 'no-reply@wc2026.onrender.com'
-            sender_name = os.getenv('MAIL_SENDER_NAME', 'WC2026')
-            to_list = [{'email': r} for r in recip_list]
-
-            payload = {
-                'sender': {'name': sender_name, 'email': sender_email},
-                'to': to_list,
-                'subject': subject,
-                'htmlContent': html_body
-            }
-
-            try:
-                resp = requests.post(brevo_url, json=payload, headers=headers, timeout=10)
-                if resp.status_code in (200, 201):
-                    return True
-                else:
-                    print(f'send_email: Brevo API error {resp.status_code}: {resp.text}')
-                    return False
-            except Exception as e:
-                print('send_email: Brevo request failed:', e)
-                return False
-
-        # Fallback: send using configured SMTP (Flask-Mail). Keep the TCP pre-check
-        mail_server = app.config.get('MAIL_SERVER')
-        mail_port = app.config.get('MAIL_PORT')
-        try:
-            if mail_server:
-                sock = socket.create_connection((mail_server, int(mail_port)), timeout=5)
-                sock.close()
-        except Exception as conn_err:
-            print(f'send_email: cannot connect to SMTP {mail_server}:{mail_port} - {conn_err}')
+        # Fallback: send using configured SMTP (Flask-Mail) over a pooled connection
+        ok, detail = smtp_pool.health_check()
+        if not ok:
+            print(f"send_email: SMTP {app.config.get('MAIL_SERVER')}:{app.config.get('MAIL_PORT')} unavailable - {detail}")
             return False
 
         # Ensure Message creation and sending happen inside an application context
         with app.app_context():
             msg = Message(subject, recipients=recip_list)
             msg.html = html_body
-            mail.send(msg)
+            smtp_pool.send(msg, limiter=email_rate_limiters['smtp'])
         return True
     except Exception as e:
         print('Error sending email:', e)
         print(traceback.format_exc())
         return False
 
+
+# Brevo HTTP transport
+# --------------------
+# One keep-alive session per process. Bulk sends go out as a single request
+# per chunk using `messageVersions`, each version carrying its own recipient,
+# subject and body.
+BREVO_API_URL = os.getenv('BREVO_API_URL', 'https://api.brevo.com/v3').rstrip('/')
+BREVO_BATCH_SIZE = min(1000, int(os.getenv('BREVO_BATCH_SIZE', '500')))  # Brevo allows 1000 versions
+BREVO_TIMEOUT = float(os.getenv('BREVO_TIMEOUT', '30'))
+
+_brevo_session = None
+_brevo_session_lock = threading.Lock()
+
+
+def brevo_session():
+    """Shared requests.Session with a connection pool sized for the outbox workers."""
+    global _brevo_session
+    if _brevo_session is None:
+        with _brevo_session_lock:
+            if _brevo_session is None:
+                from requests.adapters import HTTPAdapter
+                session_ = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(4, EMAIL_OUTBOX_WORKERS * 2))
+                session_.mount('https://', adapter)
+                session_.mount('http://', adapter)
+                session_.headers.update({'accept': 'application/json', 'content-type': 'application/json'})
+                _brevo_session = session_
+    return _brevo_session
+
+
+def _brevo_payload(chunk):
+    sender_email = app.config.get('MAIL_DEFAULT_SENDER') or os.getenv('MAIL_DEFAULT_SENDER') or 'no-reply@wc2026.onrender.com'
+    payload = {
+        'sender': {'name': os.getenv('MAIL_SENDER_NAME', 'WC2026'), 'email': sender_email},
+        'subject': chunk[0][0],
+        'htmlContent': chunk[0][2]
+    }
+    if len(chunk) == 1:
+        payload['to'] = [{'email': r} for r in chunk[0][1]]
+    else:
+        payload['messageVersions'] = [{
+            'to': [{'email': r} for r in recip_list],
+            'subject': subject,
+            'htmlContent': html_body
+        } for subject, recip_list, html_body in chunk]
+    return payload
+
+
+# A 400 naming a recipient field is about one message; anything else (sender,
+# template, attachment...) is wrong for every message in the request
+BREVO_RECIPIENT_ERROR = re.compile(r'\b(to|cc|bcc|recipients?|email)\b', re.IGNORECASE)
+BREVO_PAYLOAD_FIELDS = re.compile(r'\b(sender|replyto|reply-to|template)', re.IGNORECASE)
+
+
+def _brevo_recipient_error(resp):
+    """True if a Brevo 400 response blames a recipient address."""
+    try:
+        body = resp.json()
+    except ValueError:
+        return False
+    message = str(body.get('message') or '') if isinstance(body, dict) else ''
+    return bool(BREVO_RECIPIENT_ERROR.search(message)) and not BREVO_PAYLOAD_FIELDS.search(message)
+
+
+def _brevo_send_chunk(chunk, api_key, api_url):
+    """POST one chunk; returns ([(ok, error)], throttled). A 400 rejects the
+    whole request: when it blames a recipient the chunk is bisected to isolate
+    the offending message(s), which fail as 'rejected:', otherwise the whole
+    chunk fails at once."""
+    try:
+        resp = brevo_session().post(f'{api_url}/smtp/email', json=_brevo_payload(chunk),
+                                    headers={'api-key': api_key}, timeout=BREVO_TIMEOUT)
+    except Exception as e:
+        return [(False, f'Brevo request failed: {e}')] * len(chunk), False
+    if resp.status_code in (200, 201, 202):
+        return [(True, None)] * len(chunk), False
+    error = f'Brevo API error {resp.status_code}: {resp.text[:200]}'
+    if resp.status_code == 400 and _brevo_recipient_error(resp):
+        if len(chunk) == 1:
+            # Isolated: this address will be rejected on every retry
+            return [(False, f'rejected: {error}')], False
+        mid = len(chunk) // 2
+        first, first_throttled = _brevo_send_chunk(chunk[:mid], api_key, api_url)
+        second, second_throttled = _brevo_send_chunk(chunk[mid:], api_key, api_url)
+        return first + second, first_throttled or second_throttled
+    # 401/429/5xx etc. apply to the whole chunk; the outbox retries it later
+    return [(False, error)] * len(chunk), resp.status_code == 429
+
+
+def brevo_send_batch(messages, api_key=None, api_url=None, batch_size=None,
+                     limiter=email_rate_limiters['brevo'], max_wait=None):
+    """Send [(subject, recipient_list, html_body)] via Brevo, BREVO_BATCH_SIZE
+    messages per request, paced by `limiter`. After a 429, or a token wait
+    longer than `max_wait`, the remaining chunks are deferred.
+    Returns [(ok, error)] in the same order."""
+    api_key = api_key or os.getenv('BREVO_API_KEY')
+    if not api_key:
+        return [(False, 'BREVO_API_KEY is not set')] * len(messages)
+    api_url = (api_url or BREVO_API_URL).rstrip('/')
+    batch_size = max(1, batch_size or BREVO_BATCH_SIZE)
+    results = []
+    for i in range(0, len(messages), batch_size):
+        chunk = messages[i:i + batch_size]
+        if limiter and limiter.acquire(len(chunk), max_wait=max_wait) is None:
+            results.extend((False, 'deferred: local Brevo rate limit') for _ in range(len(messages) - len(results)))
+            break
+        chunk_results, throttled = _brevo_send_chunk(chunk, api_key, api_url)
+        failed = [err for ok, err in chunk_results if not ok]
+        if failed:
+            print(f'brevo: {len(failed)}/{len(chunk)} failed in chunk {i // batch_size}: {failed[0]}')
+        results.extend(chunk_results)
+        if throttled:
+            if limiter:
+                limiter.throttled()
+            results.extend((False, 'deferred: Brevo is throttling') for _ in range(len(messages) - len(results)))
+            break
+        if limiter:
+            limiter.succeeded(len(chunk) - len(failed))
+    return results
+
+
+def use_brevo_transport():
+    return bool(os.getenv('BREVO_API_KEY')) or \
+        os.getenv('USE_BREVO', 'False').lower() in ('1', 'true', 'yes')
+
+
+def deliver_email_batch(messages, max_wait=None):
+    """Send [(subject, recipients, html_body)] right now; returns [(ok, error)]
+    in the same order. Over SMTP the whole batch shares one pooled connection;
+    over Brevo it goes out as messageVersions requests. Messages that would wait
+    longer than `max_wait` for the rate limiter come back 'deferred:'."""
+    results = [None] * len(messages)
+    outgoing = []
+    for i, (subject, recipients, html_body) in enumerate(messages):
+        recip_list = _normalize_recipients(recipients)
+        if recip_list:
+            outgoing.append((i, subject, recip_list, html_body))
+        else:
+            results[i] = (False, 'no valid recipients')
+    if outgoing and use_brevo_transport():
+        sent = brevo_send_batch([(subject, recip_list, html_body) for _, subject, recip_list, html_body in outgoing],
+                                max_wait=max_wait)
+        for (i, *_), result in zip(outgoing, sent):
+            results[i] = result
+    elif outgoing:
+        ok, detail = smtp_pool.health_check()
+        if not ok:
+            print(f'deliver_email_batch: SMTP unavailable - {detail}')
+            for i, *_ in outgoing:
+                results[i] = (False, f'SMTP unavailable: {detail}')
+            return results
+        with app.app_context():
+            msgs = []
+            for _, subject, recip_list, html_body in outgoing:
+                msg = Message(subject, recipients=recip_list)
+                msg.html = html_body
+                msgs.append(msg)
+            sent = smtp_pool.send_many(msgs, limiter=email_rate_limiters['smtp'], max_wait=max_wait)
+            for (i, *_), result in zip(outgoing, sent):
+                results[i] = result
+    return results
+
+# Durable email outbox
+# -------------------
+# send_email() only records the message in `email_outbox`; a small pool of
+# worker threads in every app process claims due jobs with a lease, delivers
+# them through deliver_email() and retries failures with exponential backoff.
+# A job whose worker died (e.g. gunicorn recycling the process) is picked up
+# again once its lease expires, so queued mail survives restarts.
+email_outbox_collection = db['email_outbox']
+
+EMAIL_OUTBOX_WORKERS = int(os.getenv('EMAIL_OUTBOX_WORKERS', '2'))
+EMAIL_OUTBOX_LEASE_SECONDS = int(os.getenv('EMAIL_OUTBOX_LEASE_SECONDS', '120'))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '6'))
+EMAIL_OUTBOX_BACKOFF_BASE = float(os.getenv('EMAIL_OUTBOX_BACKOFF_BASE', '30'))   # seconds
+EMAIL_OUTBOX_BACKOFF_MAX = float(os.getenv('EMAIL_OUTBOX_BACKOFF_MAX', '3600'))  # seconds
+EMAIL_OUTBOX_POLL_SECONDS = float(os.getenv('EMAIL_OUTBOX_POLL_SECONDS', '5'))
+# Completed jobs are kept as a send log for this long
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.getenv('EMAIL_OUTBOX_RETENTION_DAYS', '30'))
+# Jobs queued together by send_email_batch() are delivered up to this many at a
+# time: one SMTP connection, or one Brevo messageVersions request
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '500' if os.getenv('BREVO_API_KEY') else '50'))
+
+_email_outbox_wakeup = threading.Event()
+_email_outbox_started = False
+_email_outbox_lock = threading.Lock()
+_email_outbox_owner = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _normalize_recipients(recipients):
+    """Return a list of non-empty recipient addresses (None if unusable)."""
+    if recipients is None:
+        return None
+    if isinstance(recipients, str):
+        return [recipients] if recipients else None
+    try:
+        recip_list = [r for r in recipients if r]
+    except Exception:
+        return None
+    return recip_list or None
+
+
+def _outbox_job(subject, recip_list, html_body, now, batch=None):
+    job = {
+        'subject': subject,
+        'recipients': recip_list,
+        'html': html_body,
+        'status': 'pending',
+        'attempts': 0,
+        'max_attempts': EMAIL_OUTBOX_MAX_ATTEMPTS,
+        'next_attempt_at': now,
+        'lease_until': None,
+        'lease_owner': None,
+        'last_error': None,
+        'created_at': now,
+        'sent_at': None
+    }
+    if batch:
+        job['batch'] = batch
+    return job
+
+
+def send_email(subject, recipients, html_body):
+    """Queue an email in the durable outbox and return immediately.
+    Returns True when the message was queued, False for unusable recipients."""
+    recip_list = _normalize_recipients(recipients)
+    if not recip_list:
+        print('send_email: no valid recipient addresses, not queued')
+        return False
+    try:
+        email_outbox_collection.insert_one(_outbox_job(subject, recip_list, html_body, datetime.now()))
+    except Exception as e:
+        # Never lose the message because the queue is unavailable
+        print('send_email: outbox insert failed, delivering inline:', e)
+        return deliver_email(subject, recip_list, html_body)
+    _email_outbox_wakeup.set()
+    return True
+
+
+def send_email_batch(messages, batch=None):
+    """Queue many [(subject, recipients, html_body)] with one insert.
+    Jobs sharing a batch id are delivered together over one connection.
+    Returns the number of messages queued."""
+    now = datetime.now()
+    batch = batch or f'batch:{ObjectId()}'
+    jobs = []
+    for subject, recipients, html_body in messages:
+        recip_list = _normalize_recipients(recipients)
+        if recip_list:
+            jobs.append(_outbox_job(subject, recip_list, html_body, now, batch=batch))
+    if not jobs:
+        return 0
+    try:
+        email_outbox_collection.insert_many(jobs, ordered=False)
+    except Exception as e:
+        print('send_email_batch: outbox insert failed, delivering inline:', e)
+        return sum(1 for ok, _ in deliver_email_batch(
+            [(j['subject'], j['recipients'], j['html']) for j in jobs]) if ok)
+    _email_outbox_wakeup.set()
+    return len(jobs)
+
+
+def _claim_email_job():
+    """Atomically lease the next due job (or one whose lease expired)."""
+    from pymongo import ReturnDocument
+    now = datetime.now()
+    return email_outbox_collection.find_one_and_update(
+        {'$or': [
+            {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'status': 'sending', 'lease_until': {'$lt': now}}
+        ]},
+        {'$set': {
+            'status': 'sending',
+            'lease_until': now + timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS),
+            'lease_owner': _email_outbox_owner,
+            # Fences this claim: a later re-claim after expiry gets a new token
+            'lease_token': ObjectId()
+        }, '$inc': {'attempts': 1}},
+        sort=[('next_attempt_at', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def email_batch_limit():
+    """Jobs one claim may take. Over SMTP each message waits for the rate
+    limiter, so the batch is capped at what the current rate sends in half a
+    lease; the heartbeat keeps the lease alive but a smaller batch also
+    bounds how much a crashed worker leaves stuck in 'sending'."""
+    if use_brevo_transport():
+        return EMAIL_OUTBOX_BATCH_SIZE
+    rate = email_rate_limiters['smtp'].stats()['rate']
+    return max(1, min(EMAIL_OUTBOX_BATCH_SIZE, int(rate * EMAIL_OUTBOX_LEASE_SECONDS / 2)))
+
+
+def _claim_email_batch(job):
+    """Lease more due jobs from the same batch as `job` (up to email_batch_limit() in all)."""
+    limit = email_batch_limit()
+    if not job.get('batch') or limit <= 1:
+        return [job]
+    now = datetime.now()
+    ids = [d['_id'] for d in email_outbox_collection.find(
+        {'batch': job['batch'], 'status': 'pending', 'next_attempt_at': {'$lte': now}},
+        {'_id': 1}
+    ).limit(limit - 1)]
+    if not ids:
+        return [job]
+    # The claim's token identifies exactly the jobs it won; others may race for the same ids
+    token = job['lease_token']
+    email_outbox_collection.update_many(
+        {'_id': {'$in': ids}, 'status': 'pending'},
+        {'$set': {
+            'status': 'sending',
+            'lease_until': now + timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS),
+            'lease_owner': _email_outbox_owner,
+            'lease_token': token
+        }, '$inc': {'attempts': 1}}
+    )
+    return [job] + list(email_outbox_collection.find({'lease_token': token, '_id': {'$ne': job['_id']}}))
+
+
+def email_backoff_seconds(attempts):
+    """Delay before retry number `attempts` (1-based): exponential, capped, jittered."""
+    import random
+    delay = min(EMAIL_OUTBOX_BACKOFF_MAX, EMAIL_OUTBOX_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _complete_email_job(job, ok, error=None):
+    now = datetime.now()
+    # Only the current lease holder may finish the job: once the lease expired
+    # and another worker re-claimed it, the token no longer matches
+    owner_filter = {'_id': job['_id'], 'lease_token': job.get('lease_token'), 'status': 'sending'}
+    if ok:
+        email_outbox_collection.update_one(owner_filter, {'$set': {
+            'status': 'sent', 'sent_at': now, 'lease_until': None, 'last_error': None
+        }})
+    elif error and error.startswith('deferred:'):
+        # Held back by the rate limiter before a real attempt: retry without using one up
+        email_outbox_collection.update_one(owner_filter, {'$set': {
+            'status': 'pending',
+            'next_attempt_at': now + timedelta(seconds=email_backoff_seconds(1)),
+            'lease_until': None,
+            'last_error': error
+        }, '$inc': {'attempts': -1}})
+    elif (error and error.startswith('rejected:')) or \
+            job.get('attempts', 1) >= job.get('max_attempts', EMAIL_OUTBOX_MAX_ATTEMPTS):
+        # A permanent rejection (e.g. an invalid recipient) is not worth retrying
+        email_outbox_collection.update_one(owner_filter, {'$set': {
+            'status': 'failed', 'failed_at': now, 'lease_until': None, 'last_error': error
+        }})
+        print(f"email outbox: giving up on {job['_id']} after {job.get('attempts')} attempts: {error}")
+    else:
+        email_outbox_collection.update_one(owner_filter, {'$set': {
+            'status': 'pending',
+            'next_attempt_at': now + timedelta(seconds=email_backoff_seconds(job.get('attempts', 1))),
+            'lease_until': None,
+            'last_error': error
+        }})
+
+
+def _renew_email_leases(jobs, stop):
+    """Heartbeat: extend the lease on `jobs` until `stop` is set, so slow,
+    rate-limited deliveries are not re-claimed and sent twice."""
+    ids = [j['_id'] for j in jobs]
+    token = jobs[0].get('lease_token')
+    while not stop.wait(EMAIL_OUTBOX_LEASE_SECONDS / 3):
+        try:
+            email_outbox_collection.update_many(
+                {'_id': {'$in': ids}, 'lease_token': token, 'status': 'sending'},
+                {'$set': {'lease_until': datetime.now() + timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            print('email outbox: lease renewal failed:', e)
+
+
+def process_email_jobs(jobs):
+    """Deliver leased jobs as one batch and record each outcome. Returns the number sent."""
+    stop = threading.Event()
+    threading.Thread(target=_renew_email_leases, args=(jobs, stop), name='email-lease', daemon=True).start()
+    try:
+        try:
+            # A long wait for the local rate limiter defers jobs instead of
+            # holding them (and using up an attempt) here
+            results = deliver_email_batch([(j['subject'], j['recipients'], j['html']) for j in jobs],
+                                          max_wait=EMAIL_RATE_MAX_WAIT)
+        except Exception as e:
+            results = [(False, str(e))] * len(jobs)
+    finally:
+        stop.set()
+    for job, (ok, error) in zip(jobs, results):
+        _complete_email_job(job, ok, error)
+    return sum(1 for ok, _ in results if ok)
+
+
+def _email_outbox_worker():
+    while True:
+        try:
+            job = _claim_email_job()
+        except Exception as e:
+            print('email outbox: claim failed:', e)
+            job = None
+        if job is None:
+            _email_outbox_wakeup.wait(EMAIL_OUTBOX_POLL_SECONDS)
+            _email_outbox_wakeup.clear()
+            continue
+        try:
+            jobs = _claim_email_batch(job)
+        except Exception as e:
+            print('email outbox: batch claim failed:', e)
+            jobs = [job]
+        process_email_jobs(jobs)
+
+
+declare_index('email_outbox', [('status', 1), ('next_attempt_at', 1)])
+declare_index('email_outbox', [('status', 1), ('lease_until', 1)])
+declare_index('email_outbox', [('batch', 1), ('status', 1), ('next_attempt_at', 1)])
+declare_index('email_outbox', [('campaign', 1), ('status', 1)])  # campaign progress counts
+declare_index('email_outbox', 'lease_token', sparse=True)
+declare_index('email_outbox', 'sent_at', expireAfterSeconds=EMAIL_OUTBOX_RETENTION_DAYS * 86400)
+
+
+def start_email_outbox_workers():
+    """Start this process's outbox workers once (EMAIL_OUTBOX_WORKERS=0 disables).
+    Called from start_background(); they also pick up mail queued by earlier
+    (possibly recycled) processes and by CLI commands."""
+    global _email_outbox_started
+    if _email_outbox_started or EMAIL_OUTBOX_WORKERS <= 0:
+        return
+    with _email_outbox_lock:
+        if _email_outbox_started:
+            return
+        _email_outbox_started = True
+    for i in range(EMAIL_OUTBOX_WORKERS):
+        threading.Thread(target=_email_outbox_worker, name=f'email-outbox-{i}', daemon=True).start()
+
+
+def email_outbox_stats():
+    """Counts of outbox jobs per status."""
+    counts = {row['_id']: row['count'] for row in email_outbox_collection.aggregate([
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ])}
+    return {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed')}
+
+
+
+# Email templates
+# ---------------
+# Bodies live in templates/email/ and are compiled once by Flask's Jinja
+# environment, with autoescaping on. Bulk sends render the shared body once
+# per campaign (EmailCampaign) and only splice in escaped per-recipient values.
+APP_LINK = os.getenv('APP_LINK', 'https://wc2026.onrender.com/')
+
+
+def render_email(template, /, **context):
+    """Render templates/email/<template>.html."""
+    return app.jinja_env.get_template(f'email/{template}.html').render(**context)
+
+
+class EmailCampaign:
+    """An email template rendered once for many recipients.
+
+    The `personal` fields are rendered as markers and replaced per recipient
+    by render(); they may only be printed by the template, not used in
+    conditions or filters.
+    """
+    _MARK = '\x1e'
+
+    def __init__(self, template, /, personal, **shared):
+        markers = {field: Markup(f'{self._MARK}{field}{self._MARK}') for field in personal}
+        # Alternating literal text and field names: [text, field, text, ..., text]
+        self._parts = render_email(template, **shared, **markers).split(self._MARK)
+        self.template = template
+        self.personal = tuple(personal)
+
+    def render(self, **values):
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            value = values.get(parts[i])
+            parts[i] = '' if value is None else str(escape(value))
+        return ''.join(parts)
+
+
 def send_signup_email(email, username):
     subject = "Welcome to WC 2026!"
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                <h1 style="color: #1173d4;">Welcome to WC 2026! 🎉</h1>
-                <p style="color: #fbbf24; font-size: 16px; font-style: italic; font-weight: bold;">May Your Nation Lead You to Glory</p>
-                <p>Hi <strong>{username}</strong>,</p>
-                <p>Thank you for signing up! You're now part of our exclusive World Cup supporter community.</p>
-                <h3>Next Steps:</h3>
-                <ol>
-                    <li>Select your favorite nation to support</li>
-                    <li>Make your first monthly payment of ₹50</li>
-                    <li>Join the leaderboard and compete with other fans!</li>
-                </ol>
-                <p>If your nation wins the World Cup 2026, you'll share in the prize pool with all supporters of the winning team!</p>
-                <p style="margin-top: 30px;">Best regards,<br><strong>WC 2026 Team</strong></p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('signup', username=username)
     return send_email(subject, [email], html)
 
-def send_payment_reminder(email, username, month_year, reminder_type='start'):
-    """Send a reminder email to a single user. reminder_type in ('start','end') affects wording."""
+def payment_reminder_message(username, month_year, reminder_type='start'):
+    """(subject, html) of the monthly reminder. reminder_type in ('start','end') affects wording."""
     subject = f"Payment Reminder - {month_year}"
-    app_link = 'https://wc2026.onrender.com/'
-    if reminder_type == 'end':
-        lead = f"It's almost the end of {month_year}."
-        cta_text = 'Pay now to ensure your support is recorded for this month'
-    else:
-        lead = f"Welcome to {month_year}."
-        cta_text = 'Please make your monthly payment to support your nation'
-
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                <h2 style="color: #1173d4;">Monthly Payment Reminder 💰</h2>
-                <p>Hi <strong>{username}</strong>,</p>
-                <p>{lead} This is a friendly reminder that your monthly payment of <strong>₹50</strong> for <strong>{month_year}</strong> is still outstanding.</p>
-                <p style="font-weight:600;">{cta_text}.</p>
-                <p style="margin-top:12px;"><a href="{app_link}" style="display: inline-block; background-color: #1173d4; color: white; padding: 12px 20px; text-decoration: none; border-radius: 6px;">Open WC2026 App</a></p>
-                <p style="margin-top: 20px;">Best regards,<br><strong>WC 2026 Team</strong></p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('payment_reminder', username=username, month_year=month_year,
+                        reminder_type=reminder_type, app_link=APP_LINK)
+    return subject, html
+
+
+def payment_reminder_campaign(month_year, reminder_type='start'):
+    """(subject, EmailCampaign) for a bulk reminder run; personalised by username."""
+    campaign = EmailCampaign('payment_reminder', personal=('username',), month_year=month_year,
+                             reminder_type=reminder_type, app_link=APP_LINK)
+    return f"Payment Reminder - {month_year}", campaign
+
+
+def send_payment_reminder(email, username, month_year, reminder_type='start'):
+    """Send a reminder email to a single user."""
+    subject, html = payment_reminder_message(username, month_year, reminder_type)
     return send_email(subject, [email], html)
 
 
@@ -551,22 +1787,7 @@ def is_valid_email_format(email: str) -> bool:
 
 def send_payment_approved(email, username, month_year, amount):
     subject = f"Payment Approved - {month_year}"
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                <h2 style="color: #059669;">Payment Approved ✓</h2>
-                <p>Hi <strong>{username}</strong>,</p>
-                <p>Great news! Your payment of <strong>₹{amount}</strong> for <strong>{month_year}</strong> has been approved.</p>
-                <p>Thank you for supporting your nation! Keep up the momentum!</p>
-                <p style="margin-top: 30px;">Best regards,<br><strong>WC 2026 Team</strong></p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('payment_approved', username=username, month_year=month_year, amount=amount)
     return send_email(subject, [email], html)
 
 
@@ -588,76 +1809,24 @@ def _safe_send_payment_approved(email, username, month_year, amount=50.00):
 
 def send_payment_rejected(email, username, month_year):
     subject = f"Payment Issue - {month_year}"
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                <h2 style="color: #dc2626;">Payment Not Approved</h2>
-                <p>Hi <strong>{username}</strong>,</p>
-                <p>Unfortunately, your payment for <strong>{month_year}</strong> could not be approved.</p>
-                <p>Please contact support or try submitting your payment again.</p>
-                <p style="margin-top: 30px;">Best regards,<br><strong>WC 2026 Team</strong></p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('payment_rejected', username=username, month_year=month_year)
     return send_email(subject, [email], html)
 
 def send_reward_approved(email, username, amount):
     subject = "Reward Approved - Congratulations! 🎉"
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: #fef3c7; padding: 30px; border-radius: 10px; border: 3px solid #fbbf24;">
-                <h1 style="color: #92400e;">🏆 CONGRATULATIONS! 🏆</h1>
-                <p>Hi <strong>{username}</strong>,</p>
-                <p style="font-size: 18px;">Your reward claim of <strong style="color: #059669; font-size: 24px;">₹{amount}</strong> has been approved!</p>
-                <p>Your nation won the World Cup and you're a winner! 🎉</p>
-                <p style="margin-top: 30px;">Best regards,<br><strong>WC 2026 Team</strong></p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('reward_approved', username=username, amount=amount)
     return send_email(subject, [email], html)
 
 def send_admin_notification(subject, body):
     admin_email = os.getenv('ADMIN_EMAIL', 'nithupd@gmail.com')
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                <h2 style="color: #1173d4;">Admin Notification</h2>
-                <p>{body}</p>
-                <p style="margin-top: 30px;">WC 2026 System</p>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('admin_notification', body=body)
 
-    # Helper that sends synchronously and returns success boolean
-    def _send_sync():
-        try:
-            return send_email(subject, [admin_email], html)
-        except Exception as e:
-            print('Error sending admin notification:', e)
-            return False
-
-    # Attempt to send in a background thread by default to avoid blocking web requests
+    # Queued through the outbox, so this never blocks the web request
     try:
-        import threading
-        t = threading.Thread(target=_send_sync, daemon=True)
-        t.start()
-        return True
+        return send_email(subject, [admin_email], html)
     except Exception as e:
-        # Fallback to synchronous send if threads can't be started
-        print('Could not start admin notify thread, sending synchronously:', e)
-        return _send_sync()
+        print('Error sending admin notification:', e)
+        return False
 
 
 # Informational pages and contact form
@@ -669,11 +1838,7 @@ def contact():
         message = request.form.get('message')
 
         subject = f"Contact Form Message from {name or email}"
-        html = f"""
-        <p><strong>From:</strong> {name or 'N/A'} &lt;{email or 'N/A'}&gt;</p>
-        <p><strong>Message:</strong></p>
-        <div>{(message or '').replace('\n','<br/>')}</div>
-        """
+        html = render_email('contact_message', name=name, email=email, message=message)
 
         # Notify admin (non-blocking)
         try:
@@ -681,50 +1846,261 @@ def contact():
         except Exception as e:
             print('contact: admin notify failed', e)
 
-        # Send confirmation to user (non-blocking) with WC 2026 wording
+        # Send confirmation to user (queued, non-blocking) with WC 2026 wording
         try:
-            import threading
-            def _send_user_confirm():
-                try:
-                    subject = 'Message received — WC 2026'
-                    html = f"""
-                    <p>Hi {name or ''},</p>
-                    <p>Thanks for contacting WC 2026. We have received your message and will respond within 2–3 working days.</p>
-                    <p>If your message is about a payment issue, please include your transaction reference so we can investigate quickly.</p>
-                    <p>Best regards,<br><strong>WC 2026 Team</strong></p>
-                    """
-                    send_email(subject, [email], html)
-                except Exception as e:
-                    print('contact: user confirmation failed', e)
-            threading.Thread(target=_send_user_confirm, daemon=True).start()
+            confirm_subject = 'Message received — WC 2026'
+            confirm_html = render_email('contact_confirmation', name=name)
+            send_email(confirm_subject, [email], confirm_html)
         except Exception as e:
-            print('contact: could not spawn confirmation thread', e)
+            print('contact: user confirmation failed', e)
+
+        return render_template('contact.html', success='Your message was sent. We will respond shortly.')
+
+    return render_template('contact.html')
+
+
+@app.route('/terms')
+def terms():
+    return render_template('terms.html')
+
+
+@app.route('/refund-policy')
+def refund_policy():
+    return render_template('refund_policy.html')
+
+@app.route('/shipping-policy')
+def shipping_policy():
+    return render_template('shipping_policy.html')
+
+# Campaigns
+# ---------
+# A campaign is one bulk send: a month's reminders or a winner announcement.
+# Every recipient becomes an outbox job with the deterministic _id
+# "<campaign>:<user_id>", so queuing is idempotent per (campaign, user) and the
+# outbox doubles as the per-recipient progress log. The campaign document
+# holds a lease and a checkpoint (the last user _id queued, recipients are
+# selected in _id order); a run whose process died is resumed from the
+# checkpoint once its lease expires.
+campaigns_collection = db['campaigns']
+
+CAMPAIGN_LEASE_SECONDS = int(os.getenv('CAMPAIGN_LEASE_SECONDS', '120'))
+declare_index('campaigns', [('status', 1), ('lease_until', 1)])
+
+
+def _reminders_campaign_plan(params):
+    subject, body = payment_reminder_campaign(params['month'], params['reminder_type'])
+
+    def candidates(after_id):
+        return reminder_candidates(params['month'], after_id=after_id, batch_size=EMAIL_OUTBOX_BATCH_SIZE)
+
+    def message(user):
+        return subject, [user.get('email')], body.render(username=user.get('username'))
+    return candidates, message
+
+
+def _winners_campaign_plan(params):
+    subject = f"🏆 CONGRATULATIONS! {params['nation']} Won the World Cup!"
+    body = EmailCampaign('winner_announcement', personal=('username',),
+                         winning_nation=params['nation'], reward_per_person=params['reward_per_person'],
+                         total_pool=params['total_pool'], winner_count=params['winner_count'])
+
+    def candidates(after_id):
+        query = {'nation': params['nation']}
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+        return users_collection.find(query, {'username': 1, 'email': 1}).sort('_id', 1)
+
+    def message(user):
+        return subject, [user.get('email')], body.render(username=user.get('username'))
+    return candidates, message
+
+
+def _losers_campaign_plan(params):
+    subject = f"World Cup 2026 Winner Announced - {params['nation']}"
+    body = EmailCampaign('loser_announcement', personal=('username', 'their_nation'),
+                         winning_nation=params['nation'])
+
+    def candidates(after_id):
+        query = {'nation': {'$nin': [None, params['nation']]}}
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+        return users_collection.find(query, {'username': 1, 'email': 1, 'nation': 1}).sort('_id', 1)
+
+    def message(user):
+        return subject, [user.get('email')], body.render(username=user.get('username'),
+                                                         their_nation=user.get('nation'))
+    return candidates, message
+
+
+CAMPAIGN_PLANS = {
+    'reminders': _reminders_campaign_plan,
+    'winners': _winners_campaign_plan,
+    'losers': _losers_campaign_plan
+}
+
+
+def _queue_campaign_chunk(campaign_id, rows):
+    """Queue [(user_id, (subject, recipients, html))] as outbox jobs; recipients
+    already queued by an earlier (crashed) run are skipped. Returns the number queued."""
+    from pymongo.errors import BulkWriteError
+    now = datetime.now()
+    jobs = []
+    for user_id, (subject, recipients, html_body) in rows:
+        recip_list = _normalize_recipients(recipients)
+        if not recip_list:
+            continue
+        job = _outbox_job(subject, recip_list, html_body, now, batch=campaign_id)
+        job['_id'] = f'{campaign_id}:{user_id}'
+        job['campaign'] = campaign_id
+        jobs.append(job)
+    if not jobs:
+        return 0
+    try:
+        return len(email_outbox_collection.insert_many(jobs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(err.get('code') != 11000 for err in errors):
+            raise
+        return e.details.get('nInserted', 0)
+
+
+def run_campaign(campaign_id, kind=None, params=None):
+    """Create (first call) or resume campaign `campaign_id` and queue every
+    recipient not queued yet. Returns campaign_progress(). If another process
+    holds the campaign's lease, or selection already finished, nothing is
+    queued and the current progress is returned."""
+    from pymongo import ReturnDocument
+    now = datetime.now()
+    if kind is not None:
+        campaigns_collection.update_one({'_id': campaign_id}, {'$setOnInsert': {
+            'kind': kind,
+            'params': params or {},
+            'status': 'running',
+            'checkpoint': None,
+            'scanned': 0,
+            'queued': 0,
+            'lease_until': None,
+            'lease_owner': None,
+            'created_at': now
+        }}, upsert=True)
+
+    owner = f'{_email_outbox_owner}:{threading.get_ident()}'
+    campaign = campaigns_collection.find_one_and_update(
+        {'_id': campaign_id, 'status': 'running',
+         '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+        {'$set': {
+            'lease_until': now + timedelta(seconds=CAMPAIGN_LEASE_SECONDS),
+            'lease_owner': owner,
+            'last_started_at': now
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+    if campaign is None:
+        return campaign_progress(campaign_id)
+
+    candidates, message = CAMPAIGN_PLANS[campaign['kind']](campaign['params'])
+    chunk_size = max(1, EMAIL_OUTBOX_BATCH_SIZE)
+    if campaign.get('checkpoint') is not None:
+        print(f"campaign {campaign_id}: resuming after {campaign['checkpoint']} ({campaign.get('queued', 0)} queued so far)")
+
+    def checkpoint(rows):
+        queued = _queue_campaign_chunk(campaign_id, [(u['_id'], message(u)) for u in rows])
+        # Only the lease holder may advance the checkpoint
+        result = campaigns_collection.update_one({'_id': campaign_id, 'lease_owner': owner}, {
+            '$set': {
+                'checkpoint': rows[-1]['_id'],
+                'lease_until': datetime.now() + timedelta(seconds=CAMPAIGN_LEASE_SECONDS)
+            },
+            '$inc': {'scanned': len(rows), 'queued': queued}
+        })
+        _email_outbox_wakeup.set()
+        return result.matched_count == 1
 
-        return render_template('contact.html', success='Your message was sent. We will respond shortly.')
+    rows = []
+    try:
+        for user in candidates(campaign.get('checkpoint')):
+            rows.append(user)
+            if len(rows) >= chunk_size:
+                if not checkpoint(rows):
+                    print(f'campaign {campaign_id}: lease lost, stopping')
+                    return campaign_progress(campaign_id)
+                rows = []
+        if rows and not checkpoint(rows):
+            print(f'campaign {campaign_id}: lease lost, stopping')
+            return campaign_progress(campaign_id)
+    except Exception as e:
+        # Keep the checkpoint; drop the lease so the next run resumes right away
+        print(f'campaign {campaign_id}: interrupted: {e}')
+        campaigns_collection.update_one({'_id': campaign_id, 'lease_owner': owner},
+                                        {'$set': {'lease_until': None, 'last_error': str(e)}})
+        return campaign_progress(campaign_id)
+
+    campaigns_collection.update_one({'_id': campaign_id, 'lease_owner': owner}, {'$set': {
+        'status': 'queued',
+        'queued_at': datetime.now(),
+        'lease_until': None
+    }})
+    return campaign_progress(campaign_id)
 
-    return render_template('contact.html')
 
+def campaign_progress(campaign_id):
+    """Live counts for a campaign: recipients queued so far and how many of
+    them are sent, failed or still remaining in the outbox."""
+    campaign = campaigns_collection.find_one({'_id': campaign_id})
+    if not campaign:
+        return None
+    counts = {row['_id']: row['count'] for row in email_outbox_collection.aggregate([
+        {'$match': {'campaign': campaign_id}},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ])}
+    remaining = counts.get('pending', 0) + counts.get('sending', 0)
+    return {
+        'id': campaign_id,
+        'kind': campaign.get('kind'),
+        'status': campaign.get('status'),
+        'scanned': campaign.get('scanned', 0),
+        'queued': campaign.get('queued', 0),
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'remaining': remaining,
+        'complete': campaign.get('status') == 'queued' and remaining == 0,
+        'created_at': campaign['created_at'].isoformat() if isinstance(campaign.get('created_at'), datetime) else None,
+        'queued_at': campaign['queued_at'].isoformat() if isinstance(campaign.get('queued_at'), datetime) else None
+    }
+
+
+def resume_stalled_campaigns():
+    """Resume campaigns whose selection was interrupted (lease expired). Returns their ids."""
+    now = datetime.now()
+    stalled = [c['_id'] for c in campaigns_collection.find(
+        {'status': 'running', '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+        {'_id': 1}
+    )]
+    for campaign_id in stalled:
+        run_campaign(campaign_id)
+    return stalled
 
-@app.route('/terms')
-def terms():
-    return render_template('terms.html')
 
+def _campaign_resume_loop():
+    while True:
+        time.sleep(CAMPAIGN_LEASE_SECONDS)
+        try:
+            resume_stalled_campaigns()
+        except Exception as e:
+            print('campaigns: resume check failed:', e)
 
-@app.route('/refund-policy')
-def refund_policy():
-    return render_template('refund_policy.html')
 
-@app.route('/shipping-policy')
-def shipping_policy():
-    return render_template('shipping_policy.html')
+def start_campaign_resumer():
+    """Start this process's stalled-campaign watcher (with the outbox workers,
+    from start_background())."""
+    if EMAIL_OUTBOX_WORKERS <= 0:
+        return
+    threading.Thread(target=_campaign_resume_loop, name='campaign-resumer', daemon=True).start()
+
 
 def send_winner_announcement_to_winners(winning_nation):
-    """Send email to all users who supported the winning nation"""
-    winners = list(users_collection.find(
-        {'nation': winning_nation},
-        {'username': 1, 'email': 1}
-    ))
-    
+    """Send email to all users who supported the winning nation (a resumable campaign).
+    Returns the number of winners queued."""
     # Calculate reward info from completed monthly payments
     pipeline = [
         {'$match': {'status': 'completed'}},
@@ -733,182 +2109,96 @@ def send_winner_announcement_to_winners(winning_nation):
     result = list(monthly_payments_collection.aggregate(pipeline))
     total_pool = result[0]['total'] if result else 0
 
-    winner_count = len(winners)
+    winner_count = users_collection.count_documents({'nation': winning_nation})
     reward_per_person = round(total_pool / winner_count, 2) if winner_count > 0 else 0
 
-    for winner in winners:
-        username = winner['username']
-        email = winner['email']
-        subject = f"🏆 CONGRATULATIONS! {winning_nation} Won the World Cup!"
-        html = f"""
-        <html>
-            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #fef3c7;">
-                <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; border: 4px solid #fbbf24;">
-                    <div style="text-align: center;">
-                        <h1 style="color: #92400e; font-size: 36px;">🏆 CONGRATULATIONS! 🏆</h1>
-                        <h2 style="color: #1173d4;">{winning_nation} Won the World Cup 2026!</h2>
-                    </div>
-                    <p style="font-size: 18px;">Hi <strong>{username}</strong>,</p>
-                    <p style="font-size: 16px; line-height: 1.6;">
-                        Amazing news! Your nation <strong style="color: #059669;">{winning_nation}</strong> has won the World Cup 2026! 🎉
-                    </p>
-                    <div style="background-color: #dcfce7; padding: 20px; border-radius: 8px; margin: 20px 0; text-align: center;">
-                        <p style="margin: 0; font-size: 16px;">Your Reward Amount:</p>
-                        <p style="margin: 10px 0; font-size: 32px; font-weight: bold; color: #059669;">₹{reward_per_person}</p>
-                        <p style="margin: 0; font-size: 14px; color: #666;">Total Pool: ₹{total_pool} | Winners: {winner_count}</p>
-                    </div>
-                    <p style="font-size: 16px;">
-                        <strong>Next Step:</strong> Login to your dashboard and claim your reward now!
-                    </p>
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="#" style="display: inline-block; background-color: #059669; color: white; padding: 15px 40px; text-decoration: none; border-radius: 8px; font-size: 16px; font-weight: bold;">Claim Your Reward</a>
-                    </div>
-                    <p style="margin-top: 30px; font-size: 14px; color: #666;">
-                        Best regards,<br><strong>WC 2026 Team</strong>
-                    </p>
-                </div>
-            </body>
-        </html>
-        """
-        send_email(subject, [email], html)
+    # The amounts are fixed when the campaign is created, so a resumed run
+    # announces exactly the same reward
+    progress = run_campaign(f'winners:{winning_nation}', 'winners', {
+        'nation': winning_nation,
+        'total_pool': total_pool,
+        'winner_count': winner_count,
+        'reward_per_person': reward_per_person
+    })
+    return progress['queued']
 
 def send_winner_announcement_to_losers(winning_nation):
-    """Send email to all users who did NOT support the winning nation"""
-    losers = list(users_collection.find(
-        {
-            'nation': {'$ne': None, '$ne': winning_nation}
-        },
-        {'username': 1, 'email': 1, 'nation': 1}
-    ))
-    
-    for loser in losers:
-        username = loser['username']
-        email = loser['email']
-        their_nation = loser['nation']
-        subject = f"World Cup 2026 Winner Announced - {winning_nation}"
-        html = f"""
-        <html>
-            <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-                <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px;">
-                    <h2 style="color: #1173d4;">World Cup 2026 Winner Announced</h2>
-                    <p>Hi <strong>{username}</strong>,</p>
-                    <p>The World Cup 2026 has concluded and the winner has been announced!</p>
-                    <div style="background-color: #fef3c7; padding: 20px; border-radius: 8px; margin: 20px 0; text-align: center;">
-                        <p style="font-size: 24px; font-weight: bold; color: #92400e; margin: 0;">🏆 {winning_nation} 🏆</p>
-                    </div>
-                    <p>You supported <strong>{their_nation}</strong>. While your team didn't win this time, thank you for being part of the WC 2026 community!</p>
-                    <p style="font-size: 20px; margin-top: 30px;"><strong>Better luck next time! ⚽</strong></p>
-                    <p>We hope to see you at the next World Cup!</p>
-                    <p style="margin-top: 30px; font-size: 14px; color: #666;">
-                        Best regards,<br><strong>WC 2026 Team</strong>
-                    </p>
-                </div>
-            </body>
-        </html>
-        """
-        send_email(subject, [email], html)
+    """Send email to all users who did NOT support the winning nation (a resumable campaign).
+    Returns the number of users queued."""
+    progress = run_campaign(f'losers:{winning_nation}', 'losers', {'nation': winning_nation})
+    return progress['queued']
 
 def send_missed_payment_warning(email, username, missed_months):
     """Send warning email when user has missed payments"""
     subject = f"⚠️ Payment Reminder - {len(missed_months)} Month(s) Unpaid"
-    
-    missed_list = "<br>".join([f"• <strong>{month}</strong>" for month in missed_months])
-    
-    html = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; border: 3px solid #ef4444;">
-                <div style="text-align: center; margin-bottom: 20px;">
-                    <span style="font-size: 48px;">⚠️</span>
-                    <h2 style="color: #dc2626; margin: 10px 0;">Missed Payment Alert!</h2>
-                </div>
-                
-                <p style="font-size: 16px;">Hi <strong>{username}</strong>,</p>
-                
-                <p style="font-size: 16px; line-height: 1.6;">
-                    We noticed you have <strong style="color: #dc2626;">{len(missed_months)} unpaid month(s)</strong> for your nation support.
-                </p>
-                
-                <div style="background-color: #fee2e2; padding: 20px; border-radius: 8px; margin: 20px 0; border-left: 4px solid #ef4444;">
-                    <p style="margin: 0 0 10px 0; font-weight: bold; color: #991b1b;">Missed Months:</p>
-                    <p style="margin: 0; line-height: 1.8;">{missed_list}</p>
-                </div>
-                
-                <p style="font-size: 16px; line-height: 1.6;">
-                    <strong>Don't worry!</strong> You can still make backpayments and catch up. Every month counts towards:
-                </p>
-                
-                <ul style="font-size: 15px; line-height: 1.8; color: #374151;">
-                    <li>🏆 <strong>Leaderboard Rankings</strong> - Compete with other supporters</li>
-                    <li>⭐ <strong>Premium Status</strong> - Unlock after 3 months</li>
-                    <li>💰 <strong>Prize Eligibility</strong> - Share in winnings if your nation wins</li>
-                    <li>📊 <strong>Support Stats</strong> - Show your dedication</li>
-                </ul>
-                
-                <div style="text-align: center; margin: 30px 0;">
-                    <a href="#" style="display: inline-block; background-color: #dc2626; color: white; padding: 14px 32px; text-decoration: none; border-radius: 8px; font-weight: bold; font-size: 16px;">
-                        Login & Pay Now
-                    </a>
-                </div>
-                
-                <p style="font-size: 14px; color: #6b7280; margin-top: 20px;">
-                    <strong>Payment Amount:</strong> ₹50 per month<br>
-                    <strong>Total Due:</strong> ₹{len(missed_months) * 50}
-                </p>
-                
-                <p style="margin-top: 30px; font-size: 14px; color: #666;">
-                    Best regards,<br><strong>WC 2026 Team</strong>
-                </p>
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #eee; text-align: center;">
-                    <p style="font-size: 12px; color: #999;">Built by <span style="color: #1173d4; font-weight: bold;">MARK.ORG</span></p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    html = render_email('missed_payment_warning', username=username, missed_months=list(missed_months))
     return send_email(subject, [email], html)
 
+def missed_payment_warning_key(user_id, missed_months):
+    """Dedupe key for a warning: one per user and per set of missed months."""
+    digest = hashlib.sha1('|'.join(sorted(missed_months)).encode()).hexdigest()[:16]
+    return f'{user_id}:{digest}'
+
+
+def enqueue_missed_payment_warning(user_id, email, username, missed_months):
+    """Queue the missed-payment warning email without blocking the request.
+    The warning for a given set of missed months is queued at most once per
+    user across sessions and devices (delivery retries are the email outbox's
+    job). Returns True when the warning was queued by this call."""
+    from pymongo.errors import DuplicateKeyError
+    key = missed_payment_warning_key(user_id, missed_months)
+    try:
+        missed_payment_warnings_collection.insert_one({
+            '_id': key,
+            'user_id': user_ref(user_id),
+            'missed_months': list(missed_months),
+            'created_at': datetime.now()
+        })
+    except DuplicateKeyError:
+        return False
+    if not send_missed_payment_warning(email, username, missed_months):
+        # Not queued (e.g. no usable address): let a later view try again
+        missed_payment_warnings_collection.delete_one({'_id': key})
+        return False
+    return True
+
+
+def reminder_candidates(month_year, after_id=None, batch_size=500):
+    """Cursor over users with a nation and no completed/pending payment for
+    `month_year`, in _id order (optionally only those after `after_id`). The
+    anti-join runs in MongoDB: each user probes the (user_id, month_year)
+    payment index once, and nothing is materialised."""
+    match = {'nation': {'$ne': None}}
+    if after_id is not None:
+        match['_id'] = {'$gt': after_id}
+    return users_collection.aggregate([
+        {'$match': match},
+        {'$sort': {'_id': 1}},
+        {'$project': {'username': 1, 'email': 1}},
+        *user_ref_lookup('monthly_payments', 'current_payment', pipeline=[
+            {'$match': {'month_year': month_year, 'status': {'$in': ['completed', 'pending']}}},
+            {'$limit': 1},
+            {'$project': {'_id': 1}}
+        ]),
+        {'$match': {'current_payment': {'$size': 0}}},
+        {'$project': {'username': 1, 'email': 1}}
+    ], batchSize=batch_size)
+
+
 def send_monthly_reminder_to_all(reminder_type='start'):
     """Send monthly payment reminder to all users at start/end of month.
-    reminder_type: 'start' or 'end' (affects email wording). Returns number of reminders sent.
+    reminder_type: 'start' or 'end' (affects email wording). Returns the number
+    of reminders this call queued.
+
+    Runs as the campaign "reminders:<month>:<type>": calling it again for the
+    same month and type resumes an interrupted run instead of mailing twice,
+    and returns 0 once the campaign has queued everyone.
     """
     current_month = get_current_month_year()
-
-    # Get all users who have a nation
-    all_users = list(users_collection.find(
-        {'nation': {'$ne': None}},
-        {'_id': 1, 'username': 1, 'email': 1}
-    ))
-
-    # Get user IDs who have already paid or have pending payment for current month
-    paid_user_ids = [
-        str(p['user_id']) for p in monthly_payments_collection.find(
-            {
-                'month_year': current_month,
-                'status': {'$in': ['completed', 'pending']}
-            },
-            {'user_id': 1}
-        )
-    ]
-
-    # Send reminder to users who haven't paid
-    sent = 0
-    # Batch send: send in chunks to avoid SMTP throttling
-    BATCH_SIZE = 50
-    SLEEP_BETWEEN_BATCHES = 1  # seconds
-    to_send = [u for u in all_users if str(u['_id']) not in paid_user_ids]
-    for i in range(0, len(to_send), BATCH_SIZE):
-        batch = to_send[i:i+BATCH_SIZE]
-        for user in batch:
-            try:
-                send_payment_reminder(user['email'], user['username'], current_month, reminder_type=reminder_type)
-                sent += 1
-            except Exception as e:
-                print(f'Failed to send reminder to {user.get("email")}: {e}')
-                continue
-        # brief pause between batches
-        if i + BATCH_SIZE < len(to_send):
-            time.sleep(SLEEP_BETWEEN_BATCHES)
+    campaign_id = f'reminders:{current_month}:{reminder_type}'
+    earlier = (campaigns_collection.find_one({'_id': campaign_id}, {'queued': 1}) or {}).get('queued', 0)
+    progress = run_campaign(campaign_id, 'reminders', {'month': current_month, 'reminder_type': reminder_type})
+    sent = max(0, (progress['queued'] if progress else 0) - earlier)
 
     # Log run
     try:
@@ -917,8 +2207,10 @@ def send_monthly_reminder_to_all(reminder_type='start'):
             'run_at': datetime.now(),
             'mode': reminder_type,
             'month': current_month,
+            'campaign': campaign_id,
             'sent': sent,
-            'total_candidates': len(to_send)
+            'already_queued': earlier,
+            'total_candidates': progress['scanned'] if progress else 0
         })
     except Exception as e:
         print('Failed to write reminder run log:', e)
@@ -926,22 +2218,219 @@ def send_monthly_reminder_to_all(reminder_type='start'):
     return sent
 
 
+# Admin jobs
+# ----------
+# Long admin operations (reminder runs, winner announcements, push
+# broadcasts) are recorded in `admin_jobs` and executed on a background
+# thread; the endpoint returns the job id straight away and the admin panel
+# polls /admin/jobs/<id>. Email progress comes from the campaigns the job
+# drives, so it stays accurate even if the campaign is resumed by another
+# process after a restart; other jobs report running counts through
+# admin_job_progress_reporter(). While a job is
+# queued or running its process keeps renewing `lease_until`; a job whose
+# lease lapsed (worker recycled or crashed) is reported as interrupted.
+admin_jobs_collection = db['admin_jobs']
+_admin_job_context = threading.local()
+admin_job_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ADMIN_JOB_WORKERS', '1')),
+                                        thread_name_prefix='admin-job')
+ADMIN_JOB_LEASE_SECONDS = int(os.getenv('ADMIN_JOB_LEASE_SECONDS', '60'))
+
+
+def _reminders_admin_job(mode):
+    month = get_current_month_year()
+    ran, sent = run_exclusive('monthly-reminders', send_monthly_reminder_to_all, reminder_type=mode)
+    if not ran:
+        raise RuntimeError('a reminder run is already in progress')
+    progress = campaign_progress(f'reminders:{month}:{mode}') or {}
+    skipped = max(0, progress.get('queued', 0) - sent)
+    # Notify admin of reminder summary
+    if sent:
+        summary = f'Reminders sent to {sent} users for {month} (mode={mode}).'
+        if skipped:
+            summary += f' {skipped} users already had this reminder from an earlier run.'
+    else:
+        summary = (f'No new reminders for {month} (mode={mode}): this campaign had already '
+                   f'reached all {skipped} users.')
+    send_admin_notification('Monthly Reminders Sent' if sent else 'Monthly Reminders Already Sent', summary)
+    return {'reminders_sent': sent, 'already_sent': skipped, 'mode': mode}
+
+
+def _winner_announcement_admin_job(winning_nation):
+    ran, winners = run_exclusive('winner-announcement', send_winner_announcement_to_winners, winning_nation)
+    if ran:
+        ran, losers = run_exclusive('winner-announcement', send_winner_announcement_to_losers, winning_nation)
+    if not ran:
+        raise RuntimeError('a winner announcement is already in progress')
+    send_admin_notification(
+        "Winner Declared",
+        f"World Cup winner has been set to <strong>{escape(winning_nation)}</strong>. All users have been notified via email."
+    )
+    return {'winners_notified': winners, 'others_notified': losers}
+
+
+def _push_broadcast_admin_job(payload, segment=None):
+    return broadcast_push(payload, push_segment_query(segment), progress=admin_job_progress_reporter())
+
+
+ADMIN_JOB_KINDS = {
+    'monthly-reminders': _reminders_admin_job,
+    'winner-announcement': _winner_announcement_admin_job,
+    'push-broadcast': _push_broadcast_admin_job
+}
+
+
+def admin_job_progress_reporter():
+    """A callable recording partial results of the admin job running on this
+    thread (shown by /admin/jobs/<id> until the final result replaces them).
+    It may be called from other threads; outside a job it does nothing."""
+    job_id = getattr(_admin_job_context, 'job_id', None)
+
+    def report(result):
+        if job_id is None:
+            return
+        try:
+            admin_jobs_collection.update_one({'_id': job_id, 'status': 'running'}, {'$set': {'result': result}})
+        except Exception as e:
+            print(f'admin job {job_id}: progress update failed: {e}')
+    return report
+
+
+def submit_admin_job(kind, params, campaigns=(), created_by=None):
+    """Record a job and start it in the background. Returns the job id."""
+    now = datetime.now()
+    job_id = admin_jobs_collection.insert_one({
+        'kind': kind,
+        'params': params,
+        'campaigns': list(campaigns),
+        'status': 'queued',
+        'created_by': created_by,
+        'created_at': now,
+        'lease_until': now + timedelta(seconds=ADMIN_JOB_LEASE_SECONDS),
+        'started_at': None,
+        'finished_at': None,
+        'result': None,
+        'error': None
+    }).inserted_id
+    future = admin_job_executor.submit(_run_admin_job, job_id)
+    stop = threading.Event()
+    future.add_done_callback(lambda _: stop.set())
+    threading.Thread(target=_renew_admin_job_lease, args=(job_id, stop), name='admin-job-lease', daemon=True).start()
+    return str(job_id)
+
+
+def _renew_admin_job_lease(job_id, stop):
+    """Heartbeat: extend the job's lease until it finishes (`stop` is set)."""
+    while not stop.wait(ADMIN_JOB_LEASE_SECONDS / 3):
+        try:
+            admin_jobs_collection.update_one(
+                {'_id': job_id, 'status': {'$in': ['queued', 'running']}},
+                {'$set': {'lease_until': datetime.now() + timedelta(seconds=ADMIN_JOB_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            print(f'admin job {job_id}: lease renewal failed: {e}')
+
+
+def _run_admin_job(job_id):
+    job = admin_jobs_collection.find_one_and_update(
+        {'_id': job_id, 'status': 'queued'},
+        {'$set': {'status': 'running', 'started_at': datetime.now()}}
+    )
+    if not job:
+        return
+    _admin_job_context.job_id = job_id
+    try:
+        result = ADMIN_JOB_KINDS[job['kind']](**job['params'])
+        update = {'status': 'done', 'result': result}
+    except Exception as e:
+        print(f"admin job {job_id} ({job['kind']}) failed: {e}")
+        update = {'status': 'error', 'error': str(e)}
+    finally:
+        _admin_job_context.job_id = None
+    update['finished_at'] = datetime.now()
+    admin_jobs_collection.update_one({'_id': job_id}, {'$set': update})
+
+
+def admin_job_status(job_id):
+    """Job state plus the combined progress, throughput and recent delivery
+    errors of its campaigns. None if there is no such job."""
+    try:
+        job = admin_jobs_collection.find_one({'_id': ObjectId(job_id)})
+    except Exception:
+        return None
+    if not job:
+        return None
+    if job['status'] in ('queued', 'running') and (job.get('lease_until') or datetime.min) < datetime.now():
+        # Nobody is renewing the lease: the process running it is gone
+        interrupted = {'status': 'error', 'finished_at': datetime.now(),
+                       'error': 'interrupted: the server restarted before the job finished; run it again'}
+        if admin_jobs_collection.update_one({'_id': job['_id'], 'status': job['status'],
+                                             'lease_until': job.get('lease_until')},
+                                            {'$set': interrupted}).modified_count:
+            job.update(interrupted)
+    totals = {'queued': 0, 'sent': 0, 'failed': 0, 'remaining': 0}
+    campaigns = [p for p in (campaign_progress(c) for c in job.get('campaigns', [])) if p]
+    for progress in campaigns:
+        for key in totals:
+            totals[key] += progress[key]
+    started = job.get('started_at')
+    elapsed = (datetime.now() - started).total_seconds() if started else 0
+    errors = [{
+        'recipients': j.get('recipients'),
+        'status': j.get('status'),
+        'attempts': j.get('attempts'),
+        'error': j.get('last_error')
+    } for j in email_outbox_collection.find(
+        {'campaign': {'$in': job.get('campaigns', [])}, 'last_error': {'$ne': None}}
+    ).sort('next_attempt_at', -1).limit(10)] if job.get('campaigns') else []
+    if job.get('error'):
+        errors.insert(0, {'error': job['error']})
+    status = job['status']
+    if status == 'done' and campaigns and not all(p['complete'] for p in campaigns):
+        status = 'delivering'  # everyone queued; the outbox is still sending
+    iso = lambda v: v.isoformat() if isinstance(v, datetime) else None
+    return {
+        'id': str(job['_id']),
+        'kind': job['kind'],
+        'params': job.get('params'),
+        'status': status,
+        'created_at': iso(job.get('created_at')),
+        'started_at': iso(started),
+        'finished_at': iso(job.get('finished_at')),
+        'result': job.get('result'),
+        'progress': totals,
+        'campaigns': campaigns,
+        'throughput_per_sec': round(totals['sent'] / elapsed, 2) if elapsed > 0 else None,
+        'errors': errors
+    }
+
+
+@app.route('/admin/jobs/<job_id>')
+def admin_job(job_id):
+    """Admin-only: progress, throughput and errors of a background admin job."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    job = admin_job_status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'job not found'}), 404
+    return jsonify({'status': 'ok', 'job': job})
+
+
 @app.route('/admin/run-monthly-reminders', methods=['POST'])
 def admin_run_monthly_reminders():
-    """Admin-only endpoint to trigger monthly reminders on demand (returns JSON report)."""
+    """Admin-only endpoint to trigger monthly reminders on demand. Runs in the
+    background; returns a job id to poll at /admin/jobs/<id>."""
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
 
     # Accept JSON or form 'mode' parameter: 'start' or 'end'
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
     mode = data.get('mode') or request.form.get('mode') or 'start'
     mode = mode if mode in ('start', 'end') else 'start'
 
-    sent = send_monthly_reminder_to_all(reminder_type=mode)
-
-    # Notify admin of reminder summary
-    send_admin_notification('Monthly Reminders Sent', f'Reminders sent to {sent} users for {get_current_month_year()} (mode={mode}).')
-    return jsonify({'status': 'ok', 'reminders_sent': sent, 'mode': mode})
+    job_id = submit_admin_job('monthly-reminders', {'mode': mode},
+                              campaigns=[f'reminders:{get_current_month_year()}:{mode}'],
+                              created_by=session.get('user_id'))
+    return jsonify({'status': 'ok', 'job_id': job_id, 'mode': mode}), 202
 
 
 @app.route('/admin/reminder-status')
@@ -960,58 +2449,679 @@ def admin_reminder_status():
         'mode': lr.get('mode'),
         'month': lr.get('month'),
         'sent': lr.get('sent'),
-        'total_candidates': lr.get('total_candidates')
+        'total_candidates': lr.get('total_candidates'),
+        'campaign': campaign_progress(lr['campaign']) if lr.get('campaign') else None
     }})
 
 
-def _monthly_scheduler_loop():
-    """Background thread that waits until the first of each month and runs reminders."""
-    import time
-    while True:
+@app.route('/admin/scheduler')
+def admin_scheduler():
+    """Admin-only: scheduled jobs with next run, last outcome and duration metrics."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    return jsonify({'status': 'ok', 'jobs': scheduler_status()})
+
+
+@app.route('/admin/campaigns')
+def admin_campaigns():
+    """Admin-only: live sent/failed/remaining counts of the most recent campaigns."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    recent = campaigns_collection.find({}, {'_id': 1}).sort('created_at', -1).limit(20)
+    return jsonify({'status': 'ok', 'campaigns': [campaign_progress(c['_id']) for c in recent]})
+
+
+@app.route('/admin/campaigns/<path:campaign_id>', methods=['GET', 'POST'])
+def admin_campaign(campaign_id):
+    """Admin-only: progress of one campaign; POST resumes it if it was interrupted."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    progress = run_campaign(campaign_id) if request.method == 'POST' else campaign_progress(campaign_id)
+    if progress is None:
+        return jsonify({'status': 'error', 'message': 'campaign not found'}), 404
+    return jsonify({'status': 'ok', 'campaign': progress})
+
+
+# Distributed lease locks
+# -----------------------
+# One document per lock name in `locks`. Acquiring sets an expiry and bumps a
+# fencing token; the holder renews the expiry from a heartbeat thread. If the
+# holder stalls or dies the lease lapses and the next acquirer gets a higher
+# token, so writes guarded with fenced_filter() from the old holder are
+# rejected instead of clobbering the new one.
+locks_collection = db['locks']
+
+LOCK_TTL_SECONDS = int(os.getenv('LOCK_TTL_SECONDS', '60'))
+
+
+class LeaseLock:
+    """MongoDB-backed lease lock with TTL, heartbeat and fencing token."""
+
+    def __init__(self, name, ttl=None, owner=None):
+        self.name = name
+        self.ttl = ttl or LOCK_TTL_SECONDS
+        self.owner = owner or f'{_email_outbox_owner}:{threading.get_ident()}:{ObjectId()}'
+        self.token = None
+        self._stop = threading.Event()
+        self._lost = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        """Try once to take the lock. Returns True and starts heartbeating on success."""
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
         now = datetime.now()
-        # compute next run at 00:10 on first day of next month
-        year = now.year + (1 if now.month == 12 else 0)
-        month = 1 if now.month == 12 else now.month + 1
-        next_run = datetime(year, month, 1, 0, 10, 0)
-        wait_seconds = (next_run - now).total_seconds()
-        if wait_seconds <= 0:
-            # if we missed (rare), run now and loop
+        try:
+            doc = locks_collection.find_one_and_update(
+                {'_id': self.name, 'expires_at': {'$lte': now}},
+                {'$set': {'owner': self.owner, 'acquired_at': now,
+                          'expires_at': now + timedelta(seconds=self.ttl)},
+                 '$inc': {'token': 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False  # held by someone else (the upsert collided with their document)
+        if not doc or doc.get('owner') != self.owner:
+            return False
+        self.token = doc['token']
+        self._stop.clear()
+        self._lost.clear()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name=f'lock-{self.name}', daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
             try:
-                send_monthly_reminder_to_all()
+                result = locks_collection.update_one(
+                    {'_id': self.name, 'owner': self.owner, 'token': self.token},
+                    {'$set': {'expires_at': datetime.now() + timedelta(seconds=self.ttl)}}
+                )
             except Exception as e:
-                print('Error running monthly reminders:', e)
-            time.sleep(60)
-            continue
-        # sleep until next_run
-        time.sleep(wait_seconds)
+                print(f'lock {self.name}: heartbeat failed: {e}')
+                continue
+            if result.matched_count == 0:
+                print(f'lock {self.name}: lease lost (token {self.token})')
+                self._lost.set()
+                return
+
+    @property
+    def lost(self):
+        """True once the heartbeat found the lease taken over."""
+        return self._lost.is_set()
+
+    def fenced_filter(self, query=None):
+        """`query` restricted to documents not yet written by a newer holder.
+        Pair it with {'$set': {'fence': lock.token}} in the update."""
+        fenced = {'$or': [{'fence': {'$exists': False}}, {'fence': {'$lte': self.token}}]}
+        if not query:
+            return fenced
+        if '$or' in query:
+            return {'$and': [query, fenced]}
+        return dict(query, **fenced)
+
+    def release(self):
+        self._stop.set()
+        if self.token is None:
+            return
+        try:
+            # Expire rather than delete, so the token keeps increasing
+            locks_collection.update_one(
+                {'_id': self.name, 'owner': self.owner, 'token': self.token},
+                {'$set': {'expires_at': datetime.now(), 'owner': None}}
+            )
+        except Exception as e:
+            print(f'lock {self.name}: release failed: {e}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+scheduler_runs_collection = db['scheduler_runs']
+
+
+def record_scheduler_run(lock, job, update=None):
+    """Apply `update` to the job's scheduler_runs document, fenced by the lock's
+    token: a holder whose lease already passed to someone else cannot
+    overwrite the record. Returns False for such a stale write."""
+    from pymongo.errors import DuplicateKeyError
+    update = dict(update or {})
+    update['$set'] = dict(update.get('$set', {}), fence=lock.token, last_run_at=datetime.now())
+    try:
+        result = scheduler_runs_collection.update_one(lock.fenced_filter({'_id': job}), update, upsert=True)
+        return result.matched_count == 1 or result.upserted_id is not None
+    except DuplicateKeyError:
+        print(f'scheduler: stale write for {job} rejected (token {lock.token})')
+        return False
+
+
+def run_exclusive(name, fn, *args, ttl=None, **kwargs):
+    """Run fn(*args, **kwargs) only if lease lock `name` is free in every
+    process and instance. Returns (ran, result). fn cannot be interrupted, so
+    if the heartbeat loses the lease meanwhile this is reported once fn returns."""
+    lock = LeaseLock(name, ttl=ttl)
+    if not lock.acquire():
+        print(f'lock {name}: held elsewhere, skipping')
+        return False, None
+    with lock:
+        result = fn(*args, **kwargs)
+    if lock.lost:
+        print(f'lock {name}: WARNING {getattr(fn, "__name__", fn)} kept running after losing its lease; '
+              f'another holder may have run concurrently')
+    return True, result
+
+
+@app.cli.command('lock-drill')
+@click.option('--processes', default=6, help='Competing simulated processes.')
+@click.option('--seconds', default=10.0, help='How long to run.')
+@click.option('--ttl', default=2, help='Lease TTL in seconds.')
+@click.option('--crash-rate', default=0.2, help='Chance a holder stalls past its lease instead of releasing.')
+def lock_drill_command(processes, seconds, ttl, crash_rate):
+    """Simulate processes competing for one lease lock: `flask --app app lock-drill`.
+    Checks that live holders never overlap, that tokens only increase and that
+    a stalled ("zombie") holder's fenced writes are rejected."""
+    import random
+    name = f'lock-drill-{ObjectId()}'
+    state = {'live': 0, 'max_live': 0, 'tokens': [], 'acquired': 0, 'contended': 0,
+             'newest_write': None, 'zombie_writes': 0, 'zombie_rejected': 0, 'zombie_unopposed': 0}
+    state_lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def fenced_write(lock):
+        ok = record_scheduler_run(lock, name)
+        if ok:
+            with state_lock:
+                if state['newest_write'] is None or lock.token > state['newest_write']:
+                    state['newest_write'] = lock.token
+        return ok
+
+    def process(i):
+        while time.time() < deadline:
+            lock = LeaseLock(name, ttl=ttl, owner=f'sim-{i}-{ObjectId()}')
+            if not lock.acquire():
+                with state_lock:
+                    state['contended'] += 1
+                time.sleep(random.uniform(0.05, 0.2))
+                continue
+            with state_lock:
+                state['live'] += 1
+                state['max_live'] = max(state['max_live'], state['live'])
+                state['tokens'].append(lock.token)
+                state['acquired'] += 1
+            fenced_write(lock)
+            time.sleep(random.uniform(0.05, ttl / 2))
+            if random.random() < crash_rate:
+                # Stall: stop heartbeating and vanish; the lease lapses, then wake and write
+                lock._stop.set()
+                with state_lock:
+                    state['live'] -= 1
+                time.sleep(ttl * 2)
+                with state_lock:
+                    superseded = state['newest_write'] is not None and state['newest_write'] > lock.token
+                ok = fenced_write(lock)
+                with state_lock:
+                    if superseded:
+                        # A newer holder has written: this write must be rejected
+                        state['zombie_writes'] += 1
+                        state['zombie_rejected'] += 0 if ok else 1
+                    else:
+                        state['zombie_unopposed'] += 1
+                continue
+            with state_lock:
+                state['live'] -= 1
+            lock.release()
+
+    threads = [threading.Thread(target=process, args=(i,)) for i in range(processes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    locks_collection.delete_one({'_id': name})
+    scheduler_runs_collection.delete_one({'_id': name})
+
+    increasing = all(a < b for a, b in zip(state['tokens'], state['tokens'][1:]))
+    print(f"acquisitions: {state['acquired']}, contended attempts: {state['contended']}")
+    print(f"max simultaneous live holders: {state['max_live']} (expected 1)")
+    print(f"fencing tokens strictly increasing: {increasing}")
+    print(f"zombie writes rejected: {state['zombie_rejected']}/{state['zombie_writes']} "
+          f"(plus {state['zombie_unopposed']} with no newer holder's write to protect)")
+    ok = state['max_live'] <= 1 and increasing and state['zombie_rejected'] == state['zombie_writes']
+    print('lock drill ' + ('passed' if ok else 'FAILED'))
+    if not ok:
+        raise SystemExit(1)
+
+
+# Job scheduler
+# -------------
+# Cron-style jobs with their next run time persisted in `scheduler_runs`.
+# Every process runs the scheduler loop; a due job is run under the lease
+# lock "job:<name>", so it runs once per deployment. After downtime a missed
+# run is caught up once (several missed runs collapse into one), unless it
+# is later than the job's max_delay, in which case it is skipped.
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+SCHEDULER_POLL_SECONDS = float(os.getenv('SCHEDULER_POLL_SECONDS', '30'))
+
+
+class CronSchedule:
+    """Five-field cron expression (minute hour day-of-month month day-of-week)
+    supporting *, lists, ranges and steps, plus `L` (last day) for day-of-month.
+    Day-of-week is 0-6 with 0 = Sunday; as in cron, when both day fields are
+    restricted a day matching either one fires."""
+
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression needs 5 fields: {expr!r}')
+        self.expr = expr
+        self.last_day = 'L' in fields[2].split(',')
+        if self.last_day:
+            fields[2] = ','.join(f for f in fields[2].split(',') if f != 'L') or '-'
+        parsed = [self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        if field == '-':
+            return set()
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = (int(x) for x in part.split('-'))
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or step < 1:
+                raise ValueError(f'cron field {field!r} out of range {lo}-{hi}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, d):
+        import calendar
+        in_days = d.day in self.days or (self.last_day and d.day == calendar.monthrange(d.year, d.month)[1])
+        in_weekdays = (d.isoweekday() % 7) in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return in_days or in_weekdays
+        if self.days_restricted:
+            return in_days
+        return in_weekdays
+
+    def next_after(self, after):
+        """First matching minute strictly after `after`."""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(366 * 5):
+            if day.month in self.months and self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f'cron expression never fires: {self.expr!r}')
+
+
+SCHEDULED_JOBS = OrderedDict()
+
+
+def scheduled_job(name, cron, max_delay=None):
+    """Register fn as job `name` on cron expression `cron`. A catch-up run more
+    than `max_delay` (timedelta) late is skipped instead of run."""
+    def register(fn):
+        SCHEDULED_JOBS[name] = {'name': name, 'schedule': CronSchedule(cron), 'fn': fn, 'max_delay': max_delay}
+        return fn
+    return register
+
+
+@scheduled_job('monthly-reminders:start', '10 0 1 * *', max_delay=timedelta(days=7))
+def scheduled_start_reminders():
+    ran, sent = run_exclusive('monthly-reminders', send_monthly_reminder_to_all, reminder_type='start')
+    return {'sent': sent} if ran else {'skipped': 'reminder run in progress'}
+
+
+@scheduled_job('monthly-reminders:end', '0 10 L * *', max_delay=timedelta(hours=12))
+def scheduled_end_reminders():
+    ran, sent = run_exclusive('monthly-reminders', send_monthly_reminder_to_all, reminder_type='end')
+    return {'sent': sent} if ran else {'skipped': 'reminder run in progress'}
+
+
+@scheduled_job('reconcile-stats', '30 3 * * *')
+def scheduled_reconcile_stats():
+    nations = reconcile_nation_stats()
+    supporters = rebuild_leaderboard()
+    push_users = refresh_push_targeting()
+    return {'nations': len(nations), 'leaderboard_supporters': supporters, 'push_targeted_users': push_users}
+
+
+@scheduled_job('cleanup-push-subscriptions', '15 4 * * *')
+def scheduled_cleanup_push_subscriptions():
+    return {'removed': cleanup_dead_push_subscriptions()}
+
+
+def run_scheduled_job(job, now=None):
+    """Run `job` if it is due, under its lease lock, and record the outcome,
+    duration and next run time. Returns the recorded status or None if not run."""
+    now = now or datetime.now()
+    lock = LeaseLock(f"job:{job['name']}")
+    if not lock.acquire():
+        return None
+    with lock:
+        state = scheduler_runs_collection.find_one({'_id': job['name']}) or {}
+        due_at = state.get('next_run_at')
+        if due_at is None or due_at > now:
+            return None  # another process ran it since we looked
+        result, error = None, None
+        started = time.perf_counter()
+        if job['max_delay'] is not None and now - due_at > job['max_delay']:
+            status = 'skipped'
+            error = f'missed run at {due_at.isoformat()} is too late to catch up'
+        else:
+            try:
+                result = job['fn']()
+                status = 'ok'
+            except Exception as e:
+                status, error = 'error', str(e)
+                print(f"scheduler: job {job['name']} failed: {e}")
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        update = {
+            '$set': {
+                'next_run_at': job['schedule'].next_after(datetime.now()),
+                'last_due_at': due_at,
+                'last_status': status,
+                'last_error': error,
+                'last_result': result,
+                'last_duration_ms': duration_ms
+            },
+            '$inc': {f'runs.{status}': 1, 'total_duration_ms': duration_ms},
+            '$max': {'max_duration_ms': duration_ms},
+            '$push': {'recent_durations_ms': {'$each': [duration_ms], '$slice': -50}}
+        }
+        record_scheduler_run(lock, job['name'], update)
+        print(f"scheduler: {job['name']} {status} in {duration_ms} ms")
+        return status
+
+
+def run_due_jobs(now=None):
+    """One scheduler tick: run every due job. New jobs get their first
+    next_run_at (they do not fire on first sight)."""
+    from pymongo.errors import DuplicateKeyError
+    now = now or datetime.now()
+    states = {s['_id']: s for s in scheduler_runs_collection.find(
+        {'_id': {'$in': list(SCHEDULED_JOBS)}}, {'next_run_at': 1})}
+    ran = []
+    for name, job in SCHEDULED_JOBS.items():
+        next_run_at = states.get(name, {}).get('next_run_at')
+        if next_run_at is None:
+            try:
+                scheduler_runs_collection.update_one(
+                    {'_id': name, 'next_run_at': None},
+                    {'$set': {'next_run_at': job['schedule'].next_after(now), 'cron': job['schedule'].expr}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass
+        elif next_run_at <= now and run_scheduled_job(job, now):
+            ran.append(name)
+    return ran
+
+
+def scheduler_status():
+    """Per-job schedule, last outcome and duration metrics."""
+    states = {s['_id']: s for s in scheduler_runs_collection.find({'_id': {'$in': list(SCHEDULED_JOBS)}})}
+    jobs = []
+    for name, job in SCHEDULED_JOBS.items():
+        st = states.get(name, {})
+        runs = st.get('runs', {})
+        total_runs = sum(runs.values())
+        iso = lambda v: v.isoformat() if isinstance(v, datetime) else None
+        jobs.append({
+            'name': name,
+            'cron': job['schedule'].expr,
+            'next_run_at': iso(st.get('next_run_at')),
+            'last_run_at': iso(st.get('last_run_at')),
+            'last_status': st.get('last_status'),
+            'last_error': st.get('last_error'),
+            'last_result': st.get('last_result'),
+            'runs': runs,
+            'last_duration_ms': st.get('last_duration_ms'),
+            'avg_duration_ms': round(st.get('total_duration_ms', 0) / total_runs, 1) if total_runs else None,
+            'max_duration_ms': st.get('max_duration_ms')
+        })
+    return jobs
+
+
+def _scheduler_loop():
+    """Background thread: check for due jobs every SCHEDULER_POLL_SECONDS."""
+    while True:
+        time.sleep(SCHEDULER_POLL_SECONDS)
         try:
-            send_monthly_reminder_to_all()
-            print(f'Monthly reminders executed for {get_current_month_year()}')
+            run_due_jobs()
         except Exception as e:
-            print('Error running monthly reminders:', e)
+            print('scheduler: tick failed:', e)
+
+
+_scheduler_started = False
+
+
+def start_scheduler():
+    """Start this process's scheduler thread once (SCHEDULER_ENABLED=false disables)."""
+    global _scheduler_started
+    if _scheduler_started or not SCHEDULER_ENABLED:
+        return
+    _scheduler_started = True
+    threading.Thread(target=_scheduler_loop, name='scheduler', daemon=True).start()
+
+
+# Schema migrations
+# -----------------
+# Each migration is (version, name, function); functions must be idempotent.
+# Applied versions are recorded in `schema_migrations` so every one runs once.
+def _migrate_user_id_to_objectid(batch_size=500):
+    """Convert legacy str(ObjectId) `user_id` references to ObjectIds."""
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    for collection in (user_stats_collection, monthly_payments_collection, winner_claims_collection):
+        converted = 0
+        conflicts = 0
+        ops = []
+
+        def _flush():
+            nonlocal converted, conflicts, ops
+            if not ops:
+                return
+            try:
+                converted += collection.bulk_write(ops, ordered=False).modified_count
+            except BulkWriteError as bwe:
+                # user_stats has a unique user_id index: a user that already has an
+                # ObjectId-keyed stats document keeps its legacy duplicate as-is
+                # (reported by /admin/debug-supporters) instead of failing the run.
+                converted += bwe.details.get('nModified', 0)
+                conflicts += len(bwe.details.get('writeErrors', []))
+            ops = []
+
+        for doc in collection.find({'user_id': {'$type': 'string'}}, {'user_id': 1}):
+            try:
+                oid = ObjectId(doc['user_id'])
+            except Exception:
+                continue
+            ops.append(UpdateOne({'_id': doc['_id'], 'user_id': doc['user_id']}, {'$set': {'user_id': oid}}))
+            if len(ops) >= batch_size:
+                _flush()
+        _flush()
+        print(f'migration user_id_to_objectid: {collection.name}: converted={converted} conflicts={conflicts}')
+
+
+def _migrate_claim_used_transactions(batch_size=500):
+    """Mark UPI transactions already attached to a payment as claimed, so
+    complete_payment() cannot credit them a second time."""
+    from pymongo import UpdateOne
+    transactions_collection = db['transactions']
+    claimed = 0
+    ops = []
+    for payment in monthly_payments_collection.find({'transaction_id': {'$type': 'string'}},
+                                                    {'transaction_id': 1, 'user_id': 1, 'approved_at': 1}):
+        ops.append(UpdateOne(
+            {'transaction_id': payment['transaction_id'], 'claimed_by': None},
+            {'$set': {'claimed_by': payment.get('user_id'), 'claimed_at': payment.get('approved_at') or datetime.now()}}
+        ))
+        if len(ops) >= batch_size:
+            claimed += transactions_collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        claimed += transactions_collection.bulk_write(ops, ordered=False).modified_count
+    print(f'migration claim_used_transactions: claimed={claimed}')
+
+
+def _migrate_dedupe_push_endpoints():
+    """Keep only the newest subscription per endpoint, so the unique
+    push_subscriptions.endpoint index can be built."""
+    removed = 0
+    for dup in push_subscriptions_collection.aggregate([
+        {'$sort': {'_id': -1}},
+        {'$group': {'_id': '$endpoint', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True):
+        removed += remove_push_subscriptions(dup['ids'][1:])
+    print(f'migration dedupe_push_endpoints: removed={removed}')
+
+
+MIGRATIONS = [
+    (1, 'user_id_to_objectid', _migrate_user_id_to_objectid),
+    (2, 'claim_used_transactions', _migrate_claim_used_transactions),
+    (3, 'dedupe_push_endpoints', _migrate_dedupe_push_endpoints),
+]
+
+
+def run_migrations():
+    """Apply pending schema migrations in version order. Returns the versions applied."""
+    applied = {m['_id'] for m in schema_migrations_collection.find({}, {'_id': 1})}
+    ran = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        started = datetime.now()
+        migrate()
+        schema_migrations_collection.update_one(
+            {'_id': version},
+            {'$set': {'name': name, 'started_at': started, 'applied_at': datetime.now()}},
+            upsert=True
+        )
+        ran.append(version)
+    return ran
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations: `flask --app app migrate`."""
+    ran = run_migrations()
+    print(f'migrations applied: {ran or "none pending"}')
+
+
+# Core collection indexes
+declare_index('users', 'username', unique=True)
+declare_index('users', 'email')
+declare_index('nations', 'name', unique=True)
+declare_index('monthly_payments', [('user_id', 1), ('month_year', 1)])
+declare_index('monthly_payments', [('user_id', 1), ('status', 1)])
+declare_index('monthly_payments', [('user_id', 1), ('payment_date', -1)])   # payment history
+declare_index('monthly_payments', [('status', 1), ('approved_at', -1)])     # admin: recent completed
+# A UPI transaction id completes at most one payment (backs up the claim in complete_payment)
+declare_index('monthly_payments', 'transaction_id', unique=True,
+              partialFilterExpression={'transaction_id': {'$type': 'string'}})
+# A month is paid at most once (backs up the already_paid check in complete_payment)
+declare_index('monthly_payments', [('user_id', 1), ('month_year', 1), ('status', 1)], unique=True,
+              partialFilterExpression={'status': 'completed'})
+declare_index('monthly_payments', 'order_id', partialFilterExpression={'order_id': {'$type': 'string'}})
+declare_index('monthly_payments', 'razorpay_order_id',
+              partialFilterExpression={'razorpay_order_id': {'$type': 'string'}})
+# Not unique: the external SMS ingest can store the same transaction twice.
+# Double use is stopped by the claim and the monthly_payments index above.
+declare_index('transactions', 'transaction_id')
+declare_index('user_stats', 'user_id', unique=True)
+declare_index('winner_claims', 'user_id')
+declare_index('winner_claims', [('status', 1), ('claimed_at', -1)])
+# Push subscriptions: upsert key (unique, so concurrent /subscribe calls
+# cannot both insert) and segment targeting fields
+declare_index('push_subscriptions', 'endpoint', unique=True)
+declare_index('push_subscriptions', 'user_id', sparse=True)
+declare_index('push_subscriptions', [('nation', 1), ('last_paid_month', 1)])
+declare_index('push_subscriptions', [('is_premium', 1), ('nation', 1)])
+# TTL: MongoDB drops subscriptions once their browser-reported expiry passes
+declare_index('push_subscriptions', 'expires_at', expireAfterSeconds=0)
+
+# (label, collection, filter, sort) for index_report(); values are placeholders
+_SAMPLE_USER = user_ref_query(ObjectId('0' * 24))
+HOT_QUERIES = [
+    ('payment by transaction id', 'monthly_payments', {'transaction_id': '000000000000'}, None),
+    ('payment by order id', 'monthly_payments', {'order_id': 'UPI-0', 'user_id': _SAMPLE_USER}, None),
+    ('payment by razorpay order id', 'monthly_payments', {'razorpay_order_id': 'order_0', 'user_id': _SAMPLE_USER}, None),
+    ('pending payment for user', 'monthly_payments', {'user_id': _SAMPLE_USER, 'status': 'pending'}, None),
+    ('payment for user and month', 'monthly_payments', {'user_id': _SAMPLE_USER, 'month_year': 'June 2026'}, None),
+    ('payment history', 'monthly_payments', {'user_id': _SAMPLE_USER}, [('payment_date', -1)]),
+    ('recent completed payments', 'monthly_payments', {'status': 'completed'}, [('approved_at', -1)]),
+    ('transaction lookup', 'transactions', {'transaction_id': '000000000000'}, None),
+    ('user stats', 'user_stats', {'user_id': _SAMPLE_USER}, None),
+    ('pending reward claims', 'winner_claims', {'status': 'pending'}, [('claimed_at', -1)]),
+    ('user by email', 'users', {'email': 'nobody@example.com'}, None),
+    ('push subscription by endpoint', 'push_subscriptions', {'endpoint': 'https://example.com/0'}, None),
+    ('push segment: nation unpaid', 'push_subscriptions', {'nation': 'Brazil', 'last_paid_month': {'$ne': 'June 2026'}}, None),
+    ('email outbox due jobs', 'email_outbox', {'status': 'pending', 'next_attempt_at': {'$lte': datetime(2026, 1, 1)}}, None),
+]
+
+
+@app.cli.command('ensure-indexes')
+@click.option('--report/--no-report', default=True, help='Explain the hot queries afterwards.')
+def ensure_indexes_command(report):
+    """Build every declared index, then report COLLSCANs: `flask --app app ensure-indexes`.
+    Exits non-zero if a hot query still scans a collection."""
+    result = ensure_indexes()
+    print(f"indexes ensured: {result['ensured']}, failed: {len(result['failed'])}")
+    if not report:
+        return
+    summary = index_report()
+    for row in summary['queries']:
+        if 'error' in row:
+            status, plan = 'error', row['error']
+        else:
+            status, plan = 'COLLSCAN' if row['collscan'] else 'ok', ' > '.join(row['stages'])
+        print(f"  {status:8} {row['collection']}: {row['query']} ({plan})")
+    for row in summary['undeclared']:
+        print(f"  undeclared index {row['collection']}.{row['index']} (drop it if nothing uses it)")
+    if summary['collscans']:
+        raise SystemExit(1)
+
+
+@app.route('/admin/indexes')
+def admin_indexes():
+    """Admin-only: missing/undeclared indexes and the plan of each hot query."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    return jsonify(dict(index_report(), status='ok'))
 
 
 # Database initialization
 def init_db():
-    # MongoDB initialization - Create indexes for performance
-    
-    # Create indexes for users collection
-    users_collection.create_index('username', unique=True)
-    users_collection.create_index('email')
-    
-    # Create indexes for nations collection
-    nations_collection.create_index('name', unique=True)
-    
-    # Create indexes for monthly_payments collection
-    monthly_payments_collection.create_index([('user_id', 1), ('month_year', 1)])
-    monthly_payments_collection.create_index('status')
-    
-    # Create indexes for user_stats collection
-    user_stats_collection.create_index('user_id', unique=True)
-    
-    # Create indexes for winner_claims collection
-    winner_claims_collection.create_index('user_id')
-    winner_claims_collection.create_index('status')
+    # MongoDB initialization - Create indexes for performance (see declare_index)
+    ensure_indexes()
+
+    try:
+        if run_migrations():
+            # Indexes the old data blocked (e.g. unique ones) get a second try
+            ensure_indexes()
+    except Exception as e:
+        print('init_db: migrations failed:', e)
     
     # Insert default nations (FIFA World Cup 2026 Top Teams)
     nations = [
@@ -1083,6 +3193,18 @@ def init_db():
     except Exception as e:
         print('init_db: avatar sanitation failed:', e)
 
+    # Backfill nation totals for nations that predate the precomputed counters
+    try:
+        if nations_collection.count_documents({'stats_reconciled_at': {'$exists': False}}):
+            reconcile_nation_stats()
+    except Exception as e:
+        print('init_db: nation stats reconcile failed:', e)
+
+    try:
+        ensure_leaderboard()
+    except Exception as e:
+        print('init_db: leaderboard build failed:', e)
+
 def get_current_month_year():
     return datetime.now().strftime("%B %Y")
 
@@ -1106,6 +3228,457 @@ def get_winning_nation():
     result = app_settings_collection.find_one({})
     return result['winning_nation'] if result and 'winning_nation' in result else None
 
+
+# Leaderboard read model
+# ----------------------
+# `leaderboard` holds one document per supporter (a user with a nation) keyed by
+# the user's ObjectId, carrying the sort key (months_paid, total_paid, _id) and
+# the fields the pages render. It is kept up to date by the same code paths that
+# change user_stats or a user's nation, so the dashboard and /api/supporters can
+# read one indexed range instead of joining users and user_stats per request.
+LEADERBOARD_SORT = [('months_paid', -1), ('total_paid', -1), ('_id', 1)]
+# Compound indexes matching the page sort, overall and per nation
+declare_index('leaderboard', LEADERBOARD_SORT)
+declare_index('leaderboard', [('nation', 1)] + LEADERBOARD_SORT)
+HOT_QUERIES.append(('leaderboard page', 'leaderboard', {}, LEADERBOARD_SORT))
+
+
+class LeaderboardCache:
+    """Small thread-safe LRU cache with a TTL for leaderboard pages and the
+    supporter total. Shared by dashboard() and api_supporters(); every write to
+    the leaderboard read model calls invalidate(), the TTL only bounds staleness
+    from writes made by other processes. A cache created with `parent` is
+    invalidated together with it."""
+
+    def __init__(self, max_entries=256, ttl_seconds=30, parent=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._children = []
+        if parent is not None:
+            parent._children.append(self)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            generation = self._generation
+        value = loader()
+        with self._lock:
+            # Don't store a value computed before an invalidation raced with it
+            if generation == self._generation:
+                self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self.invalidations += 1
+        for child in self._children:
+            child.invalidate()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations
+            }
+
+
+leaderboard_cache = LeaderboardCache(
+    max_entries=int(os.getenv('LEADERBOARD_CACHE_SIZE', '256')),
+    ttl_seconds=float(os.getenv('LEADERBOARD_CACHE_TTL', '30'))
+)
+# Ranks are per user: kept apart so many different users cannot evict the shared pages
+leaderboard_rank_cache = LeaderboardCache(
+    max_entries=int(os.getenv('LEADERBOARD_RANK_CACHE_SIZE', '64')),
+    ttl_seconds=float(os.getenv('LEADERBOARD_CACHE_TTL', '30')),
+    parent=leaderboard_cache
+)
+
+
+def _supporters_with_stats_pipeline():
+    """Aggregation over users joining user_stats; source of truth for rebuilds."""
+    return [
+        {'$match': {'nation': {'$ne': None}}},
+        {'$project': {'username': 1, 'nation': 1, 'avatar_url': 1}},
+        *user_ref_lookup('user_stats', 'stats', pipeline=[{'$project': {'months_paid': 1, 'total_paid': 1, '_id': 0}}]),
+        # If multiple stats documents matched (rare), take the max values to dedupe
+        {'$project': {
+            'username': 1,
+            'nation': 1,
+            'avatar_url': 1,
+            'months_paid': {'$ifNull': [{'$max': '$stats.months_paid'}, 0]},
+            'total_paid': {'$ifNull': [{'$max': '$stats.total_paid'}, 0]}
+        }}
+    ]
+
+
+def refresh_leaderboard_entry(user_id):
+    """Recompute a single supporter's leaderboard document from users + user_stats.
+    Removes the entry if the user no longer exists or has no nation."""
+    uid = ObjectId(user_id)
+    user = users_collection.find_one({'_id': uid}, {'username': 1, 'nation': 1, 'avatar_url': 1})
+    if not user or not user.get('nation'):
+        leaderboard_collection.delete_one({'_id': uid})
+        leaderboard_cache.invalidate()
+        return
+    stats = user_stats_collection.find_one({'user_id': user_ref_query(uid)}) or {}
+    leaderboard_collection.update_one(
+        {'_id': uid},
+        {'$set': {
+            'username': user.get('username'),
+            'nation': user.get('nation'),
+            'avatar_url': user.get('avatar_url', 'default_avatar.png'),
+            'months_paid': int(stats.get('months_paid', 0)),
+            'total_paid': float(stats.get('total_paid', 0.00)),
+            'updated_at': datetime.now()
+        }},
+        upsert=True
+    )
+    leaderboard_cache.invalidate()
+
+
+def record_payment_aggregates(user_id, amount=50.00):
+    """Apply one completed monthly payment to the precomputed aggregates: the
+    supporter's leaderboard entry and their nation's totals. Call after
+    user_stats has been incremented. Best-effort: never raises."""
+    try:
+        entry = leaderboard_collection.find_one_and_update(
+            {'_id': ObjectId(user_id)},
+            {'$inc': {'months_paid': 1, 'total_paid': amount}, '$set': {'updated_at': datetime.now()}},
+            projection={'nation': 1}
+        )
+        if entry is None:
+            # Supporter not materialized yet: build the entry from the source documents
+            refresh_leaderboard_entry(user_id)
+            entry = leaderboard_collection.find_one({'_id': ObjectId(user_id)}, {'nation': 1})
+        else:
+            leaderboard_cache.invalidate()
+    except Exception as e:
+        print('leaderboard: failed to record payment for', user_id, e)
+        entry = None
+
+    nation = entry.get('nation') if entry else None
+    try:
+        if not nation:
+            user = users_collection.find_one({'_id': ObjectId(user_id)}, {'nation': 1})
+            nation = user.get('nation') if user else None
+        if nation:
+            nations_collection.update_one(
+                {'name': nation},
+                {'$inc': {'total_raised': amount, 'payments_count': 1}}
+            )
+    except Exception as e:
+        print('nations: failed to record payment for', nation or user_id, e)
+
+
+def rebuild_leaderboard(batch_size=500):
+    """Rebuild the whole leaderboard collection from users + user_stats.
+    Safe to run while the app is serving: entries are upserted in place,
+    except those a payment updated since the rebuild started (their $inc is
+    newer than the snapshot read here), and only entries not touched since
+    the rebuild started are removed afterwards.
+    Returns the number of supporters written."""
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError
+    started = datetime.now()
+    written = 0
+    ops = []
+
+    def _flush():
+        nonlocal written, ops
+        try:
+            written += len(ops)
+            leaderboard_collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate _id: the entry changed after `started`, so the filter
+            # missed it and the upsert collided; that newer entry wins
+            errors = e.details.get('writeErrors', [])
+            if any(err.get('code') != 11000 for err in errors):
+                raise
+            written -= len(errors)
+        ops = []
+
+    for u in users_collection.aggregate(_supporters_with_stats_pipeline(), allowDiskUse=True):
+        ops.append(ReplaceOne({'_id': u['_id'], 'updated_at': {'$not': {'$gt': started}}}, {
+            'username': u.get('username'),
+            'nation': u.get('nation'),
+            'avatar_url': u.get('avatar_url', 'default_avatar.png'),
+            'months_paid': int(u.get('months_paid', 0)),
+            'total_paid': float(u.get('total_paid', 0.00)),
+            'updated_at': started
+        }, upsert=True))
+        if len(ops) >= batch_size:
+            _flush()
+    if ops:
+        _flush()
+    # Drop supporters that disappeared (nation cleared / user deleted)
+    leaderboard_collection.delete_many({'updated_at': {'$lt': started}})
+    leaderboard_cache.invalidate()
+    return written
+
+
+def ensure_leaderboard():
+    """Build the leaderboard on first start, when the read model is still
+    empty (afterwards it is maintained incrementally; use
+    `flask --app app rebuild-leaderboard` to resync). Returns the number of
+    supporters written, or None if there was nothing to do."""
+    if leaderboard_collection.estimated_document_count():
+        return None
+    ran, written = run_exclusive('rebuild-leaderboard', rebuild_leaderboard)
+    if ran:
+        print(f'leaderboard: built with {written} supporters')
+    return written
+
+
+LEADERBOARD_FIELDS = {'username': 1, 'nation': 1, 'avatar_url': 1, 'months_paid': 1, 'total_paid': 1}
+
+
+def encode_leaderboard_cursor(doc, next_index):
+    """Opaque keyset cursor pointing just after `doc` in LEADERBOARD_SORT order.
+    Carries the sort key (months_paid, total_paid, _id) plus the rank offset of
+    the next row so clients can keep numbering rows without counting."""
+    raw = json.dumps([int(doc.get('months_paid', 0)), float(doc.get('total_paid', 0.0)), str(doc['_id']), int(next_index)],
+                     separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_leaderboard_cursor(cursor):
+    """Inverse of encode_leaderboard_cursor. Raises ValueError on a malformed cursor."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        months_paid, total_paid, oid, next_index = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return int(months_paid), float(total_paid), ObjectId(oid), max(0, int(next_index))
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+def _leaderboard_entries(cursor, page_size, start_idx):
+    """Materialize leaderboard documents into JSON-able entries and the cursor
+    for the following page (None when this is the last page)."""
+    docs = list(cursor)
+    entries = [{
+        'username': u.get('username'),
+        'nation': u.get('nation'),
+        'avatar_url': u.get('avatar_url', 'default_avatar.png'),
+        'months_paid': int(u.get('months_paid', 0)),
+        'total_paid': float(u.get('total_paid', 0.0))
+    } for u in docs[:page_size]]
+    next_cursor = None
+    if len(docs) > page_size:
+        next_cursor = encode_leaderboard_cursor(docs[page_size - 1], start_idx + page_size)
+    return entries, next_cursor
+
+
+def get_leaderboard_page(page, page_size, nation=None):
+    """Return one numbered page of the leaderboard read model, optionally
+    restricted to the supporters of one nation.
+    Returns (entries, page, total_supporters, total_pages, start_idx, next_cursor)
+    where entries are dicts with username, nation, avatar_url, months_paid, total_paid.
+    """
+    total_supporters = get_total_supporters(nation)
+    total_pages = max(1, (total_supporters + page_size - 1) // page_size)
+    if page > total_pages:
+        page = total_pages
+    start_idx = (page - 1) * page_size
+
+    def _load():
+        # Fetch one extra row to know whether a next page exists
+        cursor = leaderboard_collection.find(_nation_filter(nation), LEADERBOARD_FIELDS).sort(LEADERBOARD_SORT).skip(start_idx).limit(page_size + 1)
+        return _leaderboard_entries(cursor, page_size, start_idx)
+
+    entries, next_cursor = leaderboard_cache.get_or_load(('page', nation, start_idx, page_size), _load)
+    return entries, page, total_supporters, total_pages, start_idx, next_cursor
+
+
+def _nation_filter(nation):
+    return {'nation': nation} if nation else {}
+
+
+def _leaderboard_seek_query(months_paid, total_paid, oid, after=True):
+    """Range predicate selecting the supporters ranked strictly after (or
+    before) the sort key (months_paid, total_paid, _id). Served by the
+    LEADERBOARD_SORT index."""
+    if after:
+        return {'$or': [
+            {'months_paid': {'$lt': months_paid}},
+            {'months_paid': months_paid, 'total_paid': {'$lt': total_paid}},
+            {'months_paid': months_paid, 'total_paid': total_paid, '_id': {'$gt': oid}}
+        ]}
+    return {'$or': [
+        {'months_paid': {'$gt': months_paid}},
+        {'months_paid': months_paid, 'total_paid': {'$gt': total_paid}},
+        {'months_paid': months_paid, 'total_paid': total_paid, '_id': {'$lt': oid}}
+    ]}
+
+
+def get_leaderboard_after(cursor, page_size, nation=None):
+    """Keyset page: the `page_size` supporters ranked after the position encoded
+    in `cursor` (an empty cursor means the top of the board). Seeks with a range
+    predicate on the LEADERBOARD_SORT index (prefixed by nation when one is
+    given), so every page costs the same no matter how deep it is.
+    Returns (entries, start_idx, next_cursor). Raises ValueError on a malformed cursor."""
+    query = _nation_filter(nation)
+    start_idx = 0
+    if cursor:
+        months_paid, total_paid, oid, start_idx = decode_leaderboard_cursor(cursor)
+        query.update(_leaderboard_seek_query(months_paid, total_paid, oid, after=True))
+
+    def _load():
+        docs = leaderboard_collection.find(query, LEADERBOARD_FIELDS).sort(LEADERBOARD_SORT).limit(page_size + 1)
+        return _leaderboard_entries(docs, page_size, start_idx)
+
+    entries, next_cursor = leaderboard_cache.get_or_load(('after', nation, cursor or '', page_size), _load)
+    return entries, start_idx, next_cursor
+
+
+def get_leaderboard_rank(user_id, window=2):
+    """Locate one supporter on the leaderboard without scanning documents.
+    The rank is a count over the index range ranked ahead of the user, so it
+    still costs O(rank) index keys (cheap near the top, growing with depth);
+    the neighbours are two short index seeks either side. Cached per user in
+    leaderboard_rank_cache. Returns None when the user is not on the
+    leaderboard, otherwise a dict with rank, entry and the `above`/`below`
+    neighbours in board order."""
+    def _load():
+        me = leaderboard_collection.find_one({'_id': ObjectId(user_id)}, LEADERBOARD_FIELDS)
+        if not me:
+            return None
+        months_paid = int(me.get('months_paid', 0))
+        total_paid = float(me.get('total_paid', 0.0))
+        oid = me['_id']
+        rank = leaderboard_collection.count_documents(_leaderboard_seek_query(months_paid, total_paid, oid, after=False)) + 1
+        reverse_sort = [(field, -direction) for field, direction in LEADERBOARD_SORT]
+        above_docs = list(leaderboard_collection.find(
+            _leaderboard_seek_query(months_paid, total_paid, oid, after=False), LEADERBOARD_FIELDS
+        ).sort(reverse_sort).limit(window))[::-1]
+        below_docs = list(leaderboard_collection.find(
+            _leaderboard_seek_query(months_paid, total_paid, oid, after=True), LEADERBOARD_FIELDS
+        ).sort(LEADERBOARD_SORT).limit(window))
+        above, _ = _leaderboard_entries(above_docs, window, rank - 1 - len(above_docs))
+        entry, _ = _leaderboard_entries([me], 1, rank - 1)
+        below, _ = _leaderboard_entries(below_docs, window, rank)
+        for offset, e in enumerate(above):
+            e['rank'] = rank - len(above) + offset
+        for offset, e in enumerate(below):
+            e['rank'] = rank + 1 + offset
+        entry[0]['rank'] = rank
+        return {'rank': rank, 'entry': entry[0], 'above': above, 'below': below}
+
+    return leaderboard_rank_cache.get_or_load((str(user_id), window), _load)
+
+
+def get_total_supporters(nation=None):
+    """Number of supporters on the leaderboard, or of one nation (cached with the pages)."""
+    return leaderboard_cache.get_or_load(('total', nation), lambda: leaderboard_collection.count_documents(_nation_filter(nation)))
+
+
+# Nation aggregates
+# -----------------
+# nations carry precomputed counters next to supporter_count: total_raised and
+# payments_count (completed monthly payments of the nation's supporters). They
+# are $inc'ed by record_payment_aggregates() and recomputed from scratch by
+# reconcile_nation_stats().
+NATION_STATS_FIELDS = {'name': 1, 'flag_url': 1, 'supporter_count': 1, 'total_raised': 1, 'payments_count': 1}
+
+
+def get_nation_stats():
+    """Per-nation counters, highest total raised first (cached with the leaderboard)."""
+    def _load():
+        cursor = nations_collection.find({}, NATION_STATS_FIELDS).sort([('total_raised', -1), ('supporter_count', -1), ('name', 1)])
+        return [{
+            'name': n['name'],
+            'flag_url': n.get('flag_url'),
+            'supporter_count': int(n.get('supporter_count', 0)),
+            'total_raised': float(n.get('total_raised', 0.0)),
+            'payments_count': int(n.get('payments_count', 0))
+        } for n in cursor]
+
+    return leaderboard_cache.get_or_load(('nation_stats',), _load)
+
+
+def reconcile_nation_stats():
+    """Recompute every nation's supporter_count, total_raised and payments_count
+    from users and completed monthly_payments. Returns {nation: counters}.
+    The correction is applied as an $inc of the difference from the counters
+    read once the aggregation finished, so payments recorded by
+    record_payment_aggregates() while the write runs are kept."""
+    from pymongo import UpdateOne
+    fields = ('supporter_count', 'total_raised', 'payments_count')
+    counters = {n['name']: {'supporter_count': 0, 'total_raised': 0.0, 'payments_count': 0}
+                for n in nations_collection.find({}, {'name': 1})}
+
+    for row in users_collection.aggregate([
+        {'$match': {'nation': {'$ne': None}}},
+        {'$group': {'_id': '$nation', 'count': {'$sum': 1}}}
+    ]):
+        if row['_id'] in counters:
+            counters[row['_id']]['supporter_count'] = int(row['count'])
+
+    for row in monthly_payments_collection.aggregate([
+        {'$match': {'status': 'completed'}},
+        *user_lookup('user', {'nation': 1}),
+        {'$group': {'_id': '$user.nation', 'total': {'$sum': '$amount'}, 'count': {'$sum': 1}}}
+    ], allowDiskUse=True):
+        if row['_id'] in counters:
+            counters[row['_id']]['total_raised'] = float(row['total'] or 0)
+            counters[row['_id']]['payments_count'] = int(row['count'])
+
+    current = {n['name']: n for n in nations_collection.find({}, {'name': 1, **{f: 1 for f in fields}})}
+    ops = []
+    for name, values in counters.items():
+        stored = current.get(name, {})
+        update = {'$set': {'stats_reconciled_at': datetime.now()}}
+        diff = {}
+        for f in fields:
+            if stored.get(f) is None:
+                update['$set'][f] = values[f]  # counter predates this field
+            elif values[f] != stored[f]:
+                diff[f] = values[f] - stored[f]
+        if diff:
+            update['$inc'] = diff
+        ops.append(UpdateOne({'name': name}, update))
+    if ops:
+        nations_collection.bulk_write(ops, ordered=False)
+    leaderboard_cache.invalidate()
+    return counters
+
+
+@app.cli.command('reconcile-nations')
+def reconcile_nations_command():
+    """Recompute nation counters from scratch: `flask --app app reconcile-nations`."""
+    counters = reconcile_nation_stats()
+    print(f'nation stats reconciled for {len(counters)} nations')
+
+
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard_command():
+    """Rebuild the leaderboard read model: `flask --app app rebuild-leaderboard`."""
+    ensure_indexes(['leaderboard'])
+    written = rebuild_leaderboard()
+    print(f'leaderboard rebuilt: {written} supporters')
+
 # Routes
 @app.route('/')
 def index():
@@ -1254,9 +3827,8 @@ def auth_callback():
                 'is_admin': False,
                 'created_at': datetime.now()
             })
-            user_id = str(r.inserted_id)
             user_stats_collection.insert_one({
-                'user_id': user_id,
+                'user_id': r.inserted_id,
                 'months_paid': 0,
                 'total_paid': 0.00,
                 'last_payment_month': None
@@ -1264,21 +3836,17 @@ def auth_callback():
             # notify admin about new registration (non-blocking)
             try:
                 admin_subject = f"New user registered: {username}"
-                admin_body = f"A new user has registered via Google OAuth:<br><br><strong>Username:</strong> {username}<br><strong>Email:</strong> {email}<br><strong>Time:</strong> {datetime.now().isoformat()}"
-                # send_admin_notification already starts a background thread by default
+                admin_body = f"A new user has registered via Google OAuth:<br><br><strong>Username:</strong> {escape(username)}<br><strong>Email:</strong> {escape(email)}<br><strong>Time:</strong> {datetime.now().isoformat()}"
+                # send_admin_notification queues through the email outbox
                 send_admin_notification(admin_subject, admin_body)
             except Exception as e:
                 print('Failed to send admin notification for new user:', e)
 
-            # send welcome email (non-blocking)
+            # send welcome email (queued, non-blocking)
             try:
-                import threading
-                threading.Thread(target=lambda e=email, u=username: send_signup_email(e, u), daemon=True).start()
-            except Exception:
-                try:
-                    send_signup_email(email, username)
-                except Exception as e:
-                    print('Welcome email failed:', e)
+                send_signup_email(email, username)
+            except Exception as e:
+                print('Welcome email failed:', e)
 
             user = users_collection.find_one({'_id': r.inserted_id})
         except Exception as e:
@@ -1350,6 +3918,12 @@ def select_nation():
                     {'_id': ObjectId(nation_id)},
                     {'$inc': {'supporter_count': 1}}
                 )
+                # Add the new supporter to the leaderboard read model
+                try:
+                    refresh_leaderboard_entry(session['user_id'])
+                except Exception as e:
+                    print('select_nation: leaderboard refresh failed:', e)
+                sync_push_targeting(session['user_id'])
                 
                 session['nation'] = nation['name']
                 return redirect(url_for('dashboard'))
@@ -1361,6 +3935,56 @@ def select_nation():
     
     return render_template('select_nation.html', nations=nations)
 
+# Small shared pool for the dashboard's independent reads; pymongo clients are
+# thread-safe and each task is a single round trip.
+dashboard_executor = ThreadPoolExecutor(max_workers=int(os.getenv('DASHBOARD_POOL_SIZE', '4')),
+                                        thread_name_prefix='dashboard')
+
+
+def _dashboard_user_documents(user_id):
+    """Fetch the user with their stats, payments and winner claims in one pipeline."""
+    pipeline = [
+        {'$match': {'_id': ObjectId(user_id)}},
+        {'$project': {'username': 1, 'email': 1, 'nation': 1}},
+        *user_ref_lookup('user_stats', 'stats'),
+        *user_ref_lookup('monthly_payments', 'payments', pipeline=[
+            {'$project': {'month_year': 1, 'amount': 1, 'status': 1, 'payment_date': 1, 'approved_at': 1}}
+        ]),
+        *user_ref_lookup('winner_claims', 'claims', pipeline=[
+            {'$project': {'status': 1, 'winning_nation': 1}}
+        ])
+    ]
+    docs = list(users_collection.aggregate(pipeline))
+    return docs[0] if docs else None
+
+
+def _dashboard_top_nations():
+    cursor = nations_collection.find(
+        {},
+        {'name': 1, 'flag_url': 1, 'supporter_count': 1}
+    ).sort('supporter_count', -1).limit(7)
+    return [(n['name'], n['flag_url'], n['supporter_count']) for n in cursor]
+
+
+def load_dashboard_data(user_id):
+    """Load everything dashboard() needs apart from the leaderboard page in
+    about one database round trip: the per-user documents come from a single
+    pipeline, run concurrently with the winner setting and top nations.
+    Returns a dict with user, stats, payments, claims, winning_nation and top_nations."""
+    user_future = dashboard_executor.submit(_dashboard_user_documents, user_id)
+    winner_future = dashboard_executor.submit(get_winning_nation)
+    nations_future = dashboard_executor.submit(_dashboard_top_nations)
+    user = user_future.result() or {}
+    return {
+        'user': user,
+        'stats': (user.get('stats') or [None])[0],
+        'payments': user.get('payments') or [],
+        'claims': user.get('claims') or [],
+        'winning_nation': winner_future.result(),
+        'top_nations': nations_future.result()
+    }
+
+
 @app.route('/dashboard')
 def dashboard():
     if 'user_id' not in session:
@@ -1369,25 +3993,26 @@ def dashboard():
     world_cup_date = datetime(2026, 7, 19)
     now = datetime.now()
     time_left = world_cup_date - now
-    winning_nation = get_winning_nation()
+
+    # One pipeline for the user's own documents, run concurrently with the
+    # settings and top-nations reads (see load_dashboard_data)
+    data = load_dashboard_data(session['user_id'])
+    winning_nation = data['winning_nation']
     
     # Get user stats
-    user_stats_doc = user_stats_collection.find_one({'user_id': session['user_id']})
+    user_stats_doc = data['stats']
     user_stats = (
         int(user_stats_doc.get('months_paid', 0)) if user_stats_doc else 0,
         float(user_stats_doc.get('total_paid', 0.00)) if user_stats_doc else 0.00,
         user_stats_doc.get('last_payment_month') if user_stats_doc else None
     )
     
-    # Get payment history
-    payment_history_cursor = monthly_payments_collection.find(
-        {'user_id': session['user_id']},
-        {'month_year': 1, 'amount': 1, 'status': 1, 'payment_date': 1, 'approved_at': 1}
-    ).sort('payment_date', -1)
+    # Get payment history (newest payment_date first, undated records last)
+    payments = data['payments']
     payment_history = []
-    for p in payment_history_cursor:
+    for p in sorted(payments, key=lambda p: p.get('payment_date') if isinstance(p.get('payment_date'), datetime) else datetime.min, reverse=True):
         # Format datetime objects
-        payment_date = p['payment_date']
+        payment_date = p.get('payment_date')
         if isinstance(payment_date, datetime):
             payment_date_str = payment_date.strftime('%Y-%m-%d %H:%M:%S')
         else:
@@ -1409,38 +4034,25 @@ def dashboard():
     
     # Get current month payment status
     current_month = get_current_month_year()
-    current_payment_doc = monthly_payments_collection.find_one({
-        'user_id': session['user_id'],
-        'month_year': current_month
-    })
+    current_payment_doc = next((p for p in payments if p.get('month_year') == current_month), None)
     current_payment = (current_payment_doc['status'],) if current_payment_doc else None
     
     # Check if user has pending winner claim
-    pending_claim_doc = winner_claims_collection.find_one({
-        'user_id': session['user_id'],
-        'status': 'pending'
-    })
+    claims = data['claims']
+    pending_claim_doc = next((c for c in claims if c.get('status') == 'pending'), None)
     pending_claim = (pending_claim_doc['status'],) if pending_claim_doc else None
     
     # Check if user can claim reward
     can_claim_reward = False
     if winning_nation and session.get('nation') == winning_nation:
-        existing_claim = winner_claims_collection.find_one({
-            'user_id': session['user_id'],
-            'winning_nation': winning_nation
-        })
+        existing_claim = next((c for c in claims if c.get('winning_nation') == winning_nation), None)
         can_claim_reward = not existing_claim
     
     # Get top nations
-    top_nations_cursor = nations_collection.find(
-        {},
-        {'name': 1, 'flag_url': 1, 'supporter_count': 1}
-    ).sort('supporter_count', -1).limit(7)
-    top_nations = [(n['name'], n['flag_url'], n['supporter_count']) for n in top_nations_cursor]
+    top_nations = data['top_nations']
     
-    # Get leaderboard using a MongoDB aggregation with $lookup to join user_stats
-    # This avoids building the entire user list in Python and is far more
-    # efficient for large collections (uses DB sort + skip + limit).
+    # Get leaderboard page from the materialized `leaderboard` read model
+    # (one indexed range scan instead of a users/user_stats join per request).
     try:
         try:
             supporters_page = int(request.args.get('supporters_page', '1'))
@@ -1450,75 +4062,14 @@ def dashboard():
             supporters_page = 1
         PAGE_SIZE = 10
 
-        total_supporters = users_collection.count_documents({'nation': {'$ne': None}})
-        total_pages = max(1, (total_supporters + PAGE_SIZE - 1) // PAGE_SIZE)
-        if supporters_page > total_pages:
-            supporters_page = total_pages
-        start_idx = (supporters_page - 1) * PAGE_SIZE
-
-        # Aggregation pipeline: match nation, project fields, lookup stats by converting _id to string
-        pipeline = [
-            {'$match': {'nation': {'$ne': None}}},
-            {'$project': {'username': 1, 'nation': 1, 'avatar_url': 1}},
-            {'$addFields': {'_id_str': {'$toString': '$_id'}}},
-            # Lookup user_stats matching either the stringified _id or the ObjectId form
-            {'$lookup': {
-                'from': 'user_stats',
-                'let': {'uid_str': '$_id_str', 'uid_obj': '$_id'},
-                'pipeline': [
-                    {'$match': {
-                        '$expr': {
-                            '$or': [
-                                {'$eq': ['$user_id', '$$uid_str']},
-                                {'$eq': ['$user_id', {'$toString': '$$uid_obj'}]}
-                            ]
-                        }
-                    }},
-                    {'$project': {'months_paid': 1, 'total_paid': 1, '_id': 0}}
-                ],
-                'as': 'stats'
-            }},
-            {'$unwind': {'path': '$stats', 'preserveNullAndEmptyArrays': True}},
-            {'$addFields': {
-                'months_paid': {'$ifNull': ['$stats.months_paid', 0]},
-                'total_paid': {'$ifNull': ['$stats.total_paid', 0]}
-            }},
-            # Deduplicate users: if multiple stats entries exist for same user, group by _id
-            # If multiple stats documents matched (rare), take the max values to dedupe
-            {'$group': {
-                '_id': '$_id',
-                'username': {'$first': '$username'},
-                'nation': {'$first': '$nation'},
-                'avatar_url': {'$first': '$avatar_url'},
-                'months_paid': {'$max': '$months_paid'},
-                'total_paid': {'$max': '$total_paid'}
-            }},
-            # Re-format documents (bring _id back as ObjectId string if needed)
-            {'$project': {
-                'username': 1,
-                'nation': 1,
-                'avatar_url': 1,
-                'months_paid': 1,
-                'total_paid': 1
-            }},
-            # Stable sort: add _id as a tie-breaker to make pagination deterministic
-            {'$sort': {'months_paid': -1, 'total_paid': -1, '_id': 1}},
-            {'$skip': start_idx},
-            {'$limit': PAGE_SIZE}
-        ]
-
-        cursor = users_collection.aggregate(pipeline)
-        leaderboard = []
-        idx = start_idx
-        for u in cursor:
-            idx += 1
-            leaderboard.append((u.get('username'), u.get('nation'), u.get('avatar_url', 'default_avatar.png'), int(u.get('months_paid', 0)), float(u.get('total_paid', 0.0))))
+        entries, supporters_page, total_supporters, total_pages, start_idx, supporters_next_cursor = get_leaderboard_page(supporters_page, PAGE_SIZE)
+        leaderboard = [(u['username'], u['nation'], u['avatar_url'], u['months_paid'], u['total_paid']) for u in entries]
     except Exception as e:
-        print('dashboard: leaderboard aggregation failed, falling back to in-memory (error):', e)
+        print('dashboard: leaderboard read failed, falling back to in-memory (error):', e)
         # Fallback: small dataset approach
         users_with_stats = []
         for user in users_collection.find({'nation': {'$ne': None}}, {'username': 1, 'nation': 1, 'avatar_url': 1}):
-            stats = user_stats_collection.find_one({'user_id': str(user['_id'])})
+            stats = user_stats_collection.find_one({'user_id': user_ref_query(user['_id'])})
             users_with_stats.append({
                 'username': user['username'],
                 'nation': user['nation'],
@@ -1537,17 +4088,14 @@ def dashboard():
         start_idx = (supporters_page - 1) * PAGE_SIZE
         page_slice = users_with_stats[start_idx:start_idx+PAGE_SIZE]
         leaderboard = [(u['username'], u['nation'], u['avatar_url'], u['months_paid'], u['total_paid']) for u in page_slice]
+        supporters_next_cursor = None
     
     # Calculate missed payments and payment status for all months
     months_until_wc = get_months_until_world_cup()
     current_month_index = months_until_wc.index(current_month) if current_month in months_until_wc else 0
     
-    # Get all paid/pending months for this user
-    user_payments_cursor = monthly_payments_collection.find(
-        {'user_id': session['user_id']},
-        {'month_year': 1, 'status': 1}
-    )
-    user_payments = {p['month_year']: p['status'] for p in user_payments_cursor}
+    # Get all paid/pending months for this user (same documents as the history)
+    user_payments = {p['month_year']: p['status'] for p in payments}
     
     # Identify missed months (previous months that weren't paid)
     missed_months = []
@@ -1569,12 +4117,18 @@ def dashboard():
         if is_past and status not in ['completed', 'pending']:
             missed_months.append(month)
     
-    # Send warning email if there are missed payments (once per login session)
-    if missed_months and 'missed_payment_warning_sent' not in session:
-        user = users_collection.find_one({'_id': ObjectId(session['user_id'])})
-        if user and user.get('email'):
-            send_missed_payment_warning(user['email'], session['username'], missed_months)
-            session['missed_payment_warning_sent'] = True
+    # Queue a warning email for missed payments. Deduplicated server-side per
+    # user and set of missed months; the session key only saves the round trip
+    # on repeat views.
+    if missed_months:
+        warning_key = missed_payment_warning_key(session['user_id'], missed_months)
+        user = data['user']
+        if session.get('missed_payment_warning_key') != warning_key and user and user.get('email'):
+            try:
+                enqueue_missed_payment_warning(session['user_id'], user['email'], session['username'], missed_months)
+                session['missed_payment_warning_key'] = warning_key
+            except Exception as e:
+                print('dashboard: could not queue missed payment warning:', e)
     
     return render_template('dashboard.html', 
                          time_left=time_left,
@@ -1593,17 +4147,42 @@ def dashboard():
                          supporters_page=supporters_page,
                          total_pages=total_pages,
                          total_supporters=total_supporters,
+                         supporters_next_cursor=supporters_next_cursor,
                          index_start=start_idx)
 
 
 @app.route('/api/supporters')
 def api_supporters():
     """Return JSON slice of supporters for AJAX pagination.
-    Query params: page (int)
+    Query params: page (int) for numbered pages, or cursor (the `next_cursor`
+    of a previous response; empty for the first page) for keyset paging whose
+    cost does not grow with depth. Both modes return `next_cursor`.
     """
     if 'user_id' not in session:
         return jsonify({'status': 'error', 'message': 'not_authenticated'}), 401
 
+    PAGE_SIZE = 10
+
+    if 'cursor' in request.args:
+        try:
+            entries, start_idx, next_cursor = get_leaderboard_after(request.args.get('cursor', ''), PAGE_SIZE)
+            total_supporters = get_total_supporters()
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'invalid_cursor'}), 400
+        except Exception as e:
+            print('api_supporters: cursor read failed:', e)
+            return jsonify({'status': 'error', 'message': 'server_error'}), 500
+        return jsonify({
+            'status': 'ok',
+            'entries': entries,
+            'page': start_idx // PAGE_SIZE + 1,
+            'page_size': PAGE_SIZE,
+            'total_supporters': total_supporters,
+            'total_pages': max(1, (total_supporters + PAGE_SIZE - 1) // PAGE_SIZE),
+            'index_start': start_idx,
+            'next_cursor': next_cursor
+        })
+
     try:
         supporters_page = int(request.args.get('page', '1'))
     except Exception:
@@ -1611,74 +4190,9 @@ def api_supporters():
     if supporters_page < 1:
         supporters_page = 1
 
-    PAGE_SIZE = 10
-
-    # Use DB aggregation for pagination + lookup for efficiency
+    # Read the page from the materialized leaderboard collection
     try:
-        total_supporters = users_collection.count_documents({'nation': {'$ne': None}})
-        total_pages = max(1, (total_supporters + PAGE_SIZE - 1) // PAGE_SIZE)
-        if supporters_page > total_pages:
-            supporters_page = total_pages
-
-        start_idx = (supporters_page - 1) * PAGE_SIZE
-
-        pipeline = [
-            {'$match': {'nation': {'$ne': None}}},
-            {'$project': {'username': 1, 'nation': 1, 'avatar_url': 1}},
-            {'$addFields': {'_id_str': {'$toString': '$_id'}}},
-            {'$lookup': {
-                'from': 'user_stats',
-                'let': {'uid_str': '$_id_str', 'uid_obj': '$_id'},
-                'pipeline': [
-                    {'$match': {
-                        '$expr': {
-                            '$or': [
-                                {'$eq': ['$user_id', '$$uid_str']},
-                                {'$eq': ['$user_id', {'$toString': '$$uid_obj'}]}
-                            ]
-                        }
-                    }},
-                    {'$project': {'months_paid': 1, 'total_paid': 1, '_id': 0}}
-                ],
-                'as': 'stats'
-            }},
-            {'$unwind': {'path': '$stats', 'preserveNullAndEmptyArrays': True}},
-            {'$addFields': {
-                'months_paid': {'$ifNull': ['$stats.months_paid', 0]},
-                'total_paid': {'$ifNull': ['$stats.total_paid', 0]}
-            }},
-            # Deduplicate in case multiple user_stats docs exist for same user
-            {'$group': {
-                '_id': '$_id',
-                'username': {'$first': '$username'},
-                'nation': {'$first': '$nation'},
-                'avatar_url': {'$first': '$avatar_url'},
-                'months_paid': {'$max': '$months_paid'},
-                'total_paid': {'$max': '$total_paid'}
-            }},
-            {'$project': {
-                'username': 1,
-                'nation': 1,
-                'avatar_url': 1,
-                'months_paid': 1,
-                'total_paid': 1
-            }},
-            # Stable sort: add _id as a tie-breaker to make pagination deterministic
-            {'$sort': {'months_paid': -1, 'total_paid': -1, '_id': 1}},
-            {'$skip': start_idx},
-            {'$limit': PAGE_SIZE}
-        ]
-
-        cursor = users_collection.aggregate(pipeline)
-        entries = []
-        for u in cursor:
-            entries.append({
-                'username': u.get('username'),
-                'nation': u.get('nation'),
-                'avatar_url': u.get('avatar_url', 'default_avatar.png'),
-                'months_paid': int(u.get('months_paid', 0)),
-                'total_paid': float(u.get('total_paid', 0.0))
-            })
+        entries, supporters_page, total_supporters, total_pages, start_idx, next_cursor = get_leaderboard_page(supporters_page, PAGE_SIZE)
 
         return jsonify({
             'status': 'ok',
@@ -1687,14 +4201,15 @@ def api_supporters():
             'page_size': PAGE_SIZE,
             'total_supporters': total_supporters,
             'total_pages': total_pages,
-            'index_start': start_idx
+            'index_start': start_idx,
+            'next_cursor': next_cursor
         })
     except Exception as e:
-        print('api_supporters: aggregation failed, falling back to in-memory (error):', e)
+        print('api_supporters: leaderboard read failed, falling back to in-memory (error):', e)
         # Fallback to previous behavior
         users_with_stats = []
         for user in users_collection.find({'nation': {'$ne': None}}, {'username': 1, 'nation': 1, 'avatar_url': 1}):
-            stats = user_stats_collection.find_one({'user_id': str(user['_id'])})
+            stats = user_stats_collection.find_one({'user_id': user_ref_query(user['_id'])})
             users_with_stats.append({
                 'username': user['username'],
                 'nation': user['nation'],
@@ -1727,10 +4242,142 @@ def api_supporters():
             'page_size': PAGE_SIZE,
             'total_supporters': total_supporters,
             'total_pages': total_pages,
-            'index_start': start_idx
+            'index_start': start_idx,
+            'next_cursor': None
         })
 
 
+@app.route('/api/supporters/me')
+def api_supporters_me():
+    """Return the caller's leaderboard rank and a window of neighbours.
+    Query params: window (int, neighbours on each side, default 2, max 10)
+    """
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'not_authenticated'}), 401
+
+    PAGE_SIZE = 10
+    try:
+        window = min(10, max(0, int(request.args.get('window', '2'))))
+    except Exception:
+        window = 2
+
+    try:
+        result = get_leaderboard_rank(session['user_id'], window=window)
+        total_supporters = get_total_supporters()
+    except Exception as e:
+        print('api_supporters_me: rank lookup failed:', e)
+        return jsonify({'status': 'error', 'message': 'server_error'}), 500
+
+    if not result:
+        return jsonify({'status': 'ok', 'on_leaderboard': False, 'total_supporters': total_supporters})
+
+    return jsonify({
+        'status': 'ok',
+        'on_leaderboard': True,
+        'rank': result['rank'],
+        'page': (result['rank'] - 1) // PAGE_SIZE + 1,
+        'page_size': PAGE_SIZE,
+        'total_supporters': total_supporters,
+        'entry': result['entry'],
+        'above': result['above'],
+        'below': result['below']
+    })
+
+
+@app.route('/api/nations/stats')
+def api_nations_stats():
+    """Return every nation's supporter count, total raised and completed payments."""
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'not_authenticated'}), 401
+    try:
+        nations = get_nation_stats()
+    except Exception as e:
+        print('api_nations_stats: read failed:', e)
+        return jsonify({'status': 'error', 'message': 'server_error'}), 500
+    return jsonify({'status': 'ok', 'nations': nations})
+
+
+@app.route('/api/nations/<name>/supporters')
+def api_nation_supporters(name):
+    """Ranked supporters of one nation, same paging contract as /api/supporters.
+    Query params: page (int) or cursor (next_cursor of a previous response)
+    """
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'not_authenticated'}), 401
+
+    PAGE_SIZE = 10
+    if not nations_collection.find_one({'name': name}, {'_id': 1}):
+        return jsonify({'status': 'error', 'message': 'unknown_nation'}), 404
+
+    try:
+        if 'cursor' in request.args:
+            entries, start_idx, next_cursor = get_leaderboard_after(request.args.get('cursor', ''), PAGE_SIZE, nation=name)
+            total_supporters = get_total_supporters(name)
+            total_pages = max(1, (total_supporters + PAGE_SIZE - 1) // PAGE_SIZE)
+            page = start_idx // PAGE_SIZE + 1
+        else:
+            try:
+                page = max(1, int(request.args.get('page', '1')))
+            except Exception:
+                page = 1
+            entries, page, total_supporters, total_pages, start_idx, next_cursor = get_leaderboard_page(page, PAGE_SIZE, nation=name)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'invalid_cursor'}), 400
+    except Exception as e:
+        print('api_nation_supporters: read failed:', e)
+        return jsonify({'status': 'error', 'message': 'server_error'}), 500
+
+    return jsonify({
+        'status': 'ok',
+        'nation': name,
+        'entries': entries,
+        'page': page,
+        'page_size': PAGE_SIZE,
+        'total_supporters': total_supporters,
+        'total_pages': total_pages,
+        'index_start': start_idx,
+        'next_cursor': next_cursor
+    })
+
+
+@app.route('/admin/email-outbox')
+def admin_email_outbox():
+    """Admin-only: email outbox counts per status and the most recent failures."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    failures = [{
+        'id': str(j['_id']),
+        'subject': j.get('subject'),
+        'recipients': j.get('recipients'),
+        'attempts': j.get('attempts'),
+        'last_error': j.get('last_error'),
+        'failed_at': j['failed_at'].isoformat() if isinstance(j.get('failed_at'), datetime) else None
+    } for j in email_outbox_collection.find({'status': 'failed'}).sort('failed_at', -1).limit(20)]
+    return jsonify({
+        'status': 'ok',
+        'counts': email_outbox_stats(),
+        'recent_failures': failures,
+        'rate_limits': {name: bucket.stats() for name, bucket in email_rate_limiters.items()}
+    })
+
+
+@app.route('/admin/smtp-health')
+def admin_smtp_health():
+    """Admin-only: live NOOP check of the pooled SMTP transport plus pool counters."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    ok, detail = smtp_pool.health_check(force=True)
+    return jsonify({'status': 'ok' if ok else 'error', 'detail': detail, 'pool': smtp_pool.stats()}), (200 if ok else 503)
+
+
+@app.route('/admin/leaderboard-cache')
+def admin_leaderboard_cache():
+    """Admin-only: hit/miss counters of the in-process leaderboard page and rank caches."""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'status': 'error', 'message': 'unauthorized'}), 403
+    return jsonify({'status': 'ok', 'cache': leaderboard_cache.stats(), 'rank_cache': leaderboard_rank_cache.stats()})
+
+
 @app.route('/admin/debug-supporters')
 def admin_debug_supporters():
     """Admin-only diagnostic: returns counts and inconsistent records that can
@@ -1747,37 +4394,39 @@ def admin_debug_supporters():
 
     # Find user_id values in user_stats that appear multiple times
     dup_pipeline = [
-        {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+        # Group on the string form so legacy and migrated references collapse together
+        {'$group': {'_id': {'$toString': '$user_id'}, 'count': {'$sum': 1}}},
         {'$match': {'count': {'$gt': 1}}},
         {'$project': {'user_id': '$_id', 'count': 1, '_id': 0}}
     ]
     duplicated_stats = list(user_stats_collection.aggregate(dup_pipeline))
 
-    # user_stats that don't have a matching users document
+    # user_stats that don't have a matching users document (indexed join on users._id)
     orphan_pipeline = [
         {'$project': {'user_id': 1}},
+        {'$addFields': {'_user_oid': {'$convert': {'input': '$user_id', 'to': 'objectId', 'onError': None, 'onNull': None}}}},
+        _lookup_stage('users', '_user_oid', '_id', 'user', [{'$project': {'_id': 1}}]),
+        {'$match': {'user': {'$size': 0}}},
+        {'$project': {'_id': 0, 'user_id': {'$toString': '$user_id'}}}
     ]
-    orphaned = []
-    for doc in user_stats_collection.find({}, {'user_id': 1}):
-        uid = doc.get('user_id')
-        if not uid:
-            orphaned.append({'user_id': uid})
-            continue
-        # try both ObjectId and string match
-        try:
-            if not users_collection.find_one({'_id': ObjectId(uid)}):
-                if not users_collection.find_one({'_id': uid}):
-                    orphaned.append({'user_id': uid})
-        except Exception:
-            if not users_collection.find_one({'_id': uid}):
-                orphaned.append({'user_id': uid})
+    orphaned = list(user_stats_collection.aggregate(orphan_pipeline))
+
+    # Users with nation but no user_stats (indexed join on user_stats.user_id)
+    missing_pipeline = [
+        {'$match': {'nation': {'$ne': None}}},
+        {'$project': {'username': 1}},
+        *user_ref_lookup('user_stats', 'stats', pipeline=[{'$project': {'_id': 1}}]),
+        {'$match': {'stats': {'$size': 0}}},
+        {'$limit': 200},
+        {'$project': {'_id': 0, 'user_id': {'$toString': '$_id'}, 'username': 1}}
+    ]
+    users_missing_stats = list(users_collection.aggregate(missing_pipeline))
 
-    # Users with nation but no user_stats
-    users_missing_stats = []
-    for user in users_collection.find({'nation': {'$ne': None}}, {'_id': 1, 'username': 1}):
-        uid = str(user['_id'])
-        if not user_stats_collection.find_one({'user_id': uid}):
-            users_missing_stats.append({'user_id': uid, 'username': user.get('username')})
+    # Legacy string user_id references still waiting for the ObjectId migration
+    legacy_user_id_refs = {
+        c.name: c.count_documents({'user_id': {'$type': 'string'}})
+        for c in (user_stats_collection, monthly_payments_collection, winner_claims_collection)
+    }
 
     return jsonify({
         'status': 'ok',
@@ -1785,7 +4434,8 @@ def admin_debug_supporters():
         'total_user_stats': total_user_stats,
         'duplicated_user_stats': duplicated_stats,
         'orphaned_user_stats': orphaned,
-        'users_missing_stats': users_missing_stats[:200]
+        'users_missing_stats': users_missing_stats,
+        'legacy_user_id_refs': legacy_user_id_refs
     })
 @app.route('/pay-monthly')
 def pay_monthly():
@@ -1802,7 +4452,7 @@ def pay_monthly():
     
     # Check if payment already exists for this month
     existing_payment = monthly_payments_collection.find_one({
-        'user_id': session['user_id'],
+        'user_id': user_ref_query(session['user_id']),
         'month_year': selected_month
     })
     
@@ -1834,7 +4484,7 @@ def create_razorpay_order():
         selected_month = data.get('month', get_current_month_year())
 
         # Ensure no completed payment exists for this user/month
-        existing_payment = monthly_payments_collection.find_one({'user_id': session['user_id'], 'month_year': selected_month})
+        existing_payment = monthly_payments_collection.find_one({'user_id': user_ref_query(session['user_id']), 'month_year': selected_month})
         if existing_payment and existing_payment.get('status') == 'completed':
             return jsonify({'error': 'Payment already completed for this month'}), 400
 
@@ -1853,7 +4503,7 @@ def create_razorpay_order():
             payment_doc_id = existing_payment['_id']
         else:
             res = monthly_payments_collection.insert_one({
-                'user_id': session['user_id'],
+                'user_id': user_ref(session['user_id']),
                 'month_year': selected_month,
                 'order_id': synth_order_id,
                 'amount': 50.00,
@@ -1877,6 +4527,257 @@ def create_razorpay_order():
         print('Error creating synthetic upi order:', e)
         return jsonify({'error': 'server_error'}), 500
 
+# Payment completion
+# ------------------
+# Every way of confirming a monthly payment (UPI transaction id, Razorpay
+# signature) goes through complete_payment(). The transaction id is claimed by
+# one conditional update, the payment record is completed only if it is not
+# completed yet, and user_stats is $inc'ed returning the new totals, so two
+# concurrent requests cannot credit the same transaction or record twice. On a
+# replica set the writes also share a MongoDB transaction.
+PAYMENT_AMOUNT = 50.00
+PREMIUM_MONTHS = 3
+
+_mongo_transactions = None
+
+
+class PaymentError(Exception):
+    """A payment could not be completed. `message` is the error code the JSON
+    routes return and `status` their HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def mongo_supports_transactions():
+    """True when connected to a replica set or mongos (checked once)."""
+    global _mongo_transactions
+    if _mongo_transactions is None:
+        try:
+            hello = client.admin.command('hello')
+            _mongo_transactions = bool(hello.get('setName') or hello.get('msg') == 'isdbgrid')
+        except Exception as e:
+            print('payments: could not detect transaction support', e)
+            _mongo_transactions = False
+    return _mongo_transactions
+
+
+def _transaction_amount(txdoc):
+    """Amount of a parsed UPI transaction, stored as a number or an extended-JSON double."""
+    amount = txdoc.get('amount')
+    if isinstance(amount, dict):
+        amount = amount.get('$numberDouble')
+    try:
+        return float(amount or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _complete_payment_writes(state, user_oid, transaction_id=None, order_id=None, razorpay=None,
+                             month_year=None, session_=None):
+    """Database writes of complete_payment(); returns (payment, stats, user).
+    Sets state['claimed'] once the transaction id belongs to this call."""
+    from pymongo import ReturnDocument
+    from pymongo.errors import DuplicateKeyError
+    transactions_collection = db['transactions']
+    now = datetime.now()
+
+    def _month_paid(month):
+        return monthly_payments_collection.find_one(
+            {'user_id': user_ref_query(user_oid), 'month_year': month, 'status': 'completed'},
+            {'_id': 1}, session=session_) is not None
+
+    # Refuse before claiming anything: the upsert below would add a second completed record
+    if month_year and _month_paid(month_year):
+        raise PaymentError('already_paid')
+
+    if transaction_id:
+        txdoc = transactions_collection.find_one_and_update(
+            {'transaction_id': transaction_id, 'claimed_by': None},
+            {'$set': {'claimed_by': user_oid, 'claimed_at': now}},
+            projection={'amount': 1},
+            return_document=ReturnDocument.AFTER,
+            session=session_
+        )
+        if txdoc is None:
+            if transactions_collection.find_one({'transaction_id': transaction_id}, {'_id': 1}, session=session_):
+                raise PaymentError('transaction already used')
+            raise PaymentError('transaction not found', 404)
+        # Ids used before claims existed are only marked by migration 2, which
+        # may not have run yet: keep the claim (the id is used) and refuse
+        if monthly_payments_collection.find_one({'transaction_id': transaction_id}, {'_id': 1}, session=session_):
+            raise PaymentError('transaction already used')
+        state['claimed'] = True
+        if abs(_transaction_amount(txdoc) - PAYMENT_AMOUNT) > 0.01:
+            raise PaymentError('amount mismatch')
+        completed = {'transaction_id': transaction_id, 'approved_by': 'upi_manual'}
+    else:
+        completed = {'razorpay_payment_id': razorpay['payment_id'], 'razorpay_signature': razorpay['signature'],
+                     'approved_by': 'razorpay_auto'}
+    completed.update(status='completed', amount=PAYMENT_AMOUNT, approved_at=now)
+
+    def _complete(query, update, **kwargs):
+        try:
+            return monthly_payments_collection.find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER, session=session_, **kwargs)
+        except DuplicateKeyError as e:
+            # unique (user_id, month_year, status) index: a concurrent call paid the month
+            key_pattern = (e.details or {}).get('keyPattern')
+            if key_pattern is None and session_ is None:
+                # older servers don't report the index; outside a transaction we can look
+                record = monthly_payments_collection.find_one(query, {'month_year': 1}) or {}
+                key_pattern = {'month_year': 1} if _month_paid(month_year or record.get('month_year')) else {}
+            if 'month_year' in (key_pattern or {}):
+                raise PaymentError('already_paid')
+            # unique transaction_id index: the id completed a payment before claims existed
+            raise PaymentError('transaction already used')
+
+    open_record = {'user_id': user_ref_query(user_oid), 'status': {'$ne': 'completed'}}
+    payment = None
+    if month_year:
+        # Pay a month directly: complete its open record, or create one
+        payment = _complete(dict(open_record, month_year=month_year),
+                            {'$set': dict(completed, payment_date=now), '$setOnInsert': {'user_id': user_oid}},
+                            upsert=True)
+    elif razorpay:
+        payment = _complete(dict(open_record, razorpay_order_id=razorpay['order_id']), {'$set': completed})
+        if payment is None:
+            raise PaymentError('no_payment_record', 404)
+    else:
+        if order_id:
+            payment = _complete(dict(open_record, order_id=order_id), {'$set': completed})
+        if payment is None:
+            payment = _complete({'user_id': user_ref_query(user_oid), 'status': 'pending'}, {'$set': completed},
+                                sort=[('_id', -1)])
+    if payment is None:
+        raise PaymentError('no_pending_payment', 404)
+
+    stats_update = {
+        '$inc': {'months_paid': 1, 'total_paid': PAYMENT_AMOUNT},
+        '$set': {'last_payment_month': payment['month_year']},
+        '$setOnInsert': {'user_id': user_oid}
+    }
+    try:
+        stats = user_stats_collection.find_one_and_update(
+            {'user_id': user_ref_query(user_oid)}, stats_update,
+            upsert=True, return_document=ReturnDocument.AFTER, session=session_)
+    except DuplicateKeyError:
+        # A concurrent first payment created the stats document: now it exists.
+        # Inside a transaction the error aborted it, so leave it to the caller
+        if session_ is not None:
+            raise
+        stats = user_stats_collection.find_one_and_update(
+            {'user_id': user_ref_query(user_oid)}, stats_update,
+            return_document=ReturnDocument.AFTER, session=session_)
+
+    projection = {'username': 1, 'email': 1, 'is_premium': 1}
+    if stats.get('months_paid', 0) >= PREMIUM_MONTHS:
+        user = users_collection.find_one_and_update(
+            {'_id': user_oid}, {'$set': {'is_premium': True}},
+            projection=projection, return_document=ReturnDocument.AFTER, session=session_)
+    else:
+        user = users_collection.find_one({'_id': user_oid}, projection, session=session_)
+    return payment, stats, user or {}
+
+
+def complete_payment(user_id, transaction_id=None, order_id=None, razorpay=None, month_year=None):
+    """Complete a monthly payment for user_id and apply it everywhere.
+
+    Confirmed either by a UPI `transaction_id` from the transactions collection
+    (completing the record for `month_year`, created if needed, else the one for
+    `order_id`, else the user's pending record) or by a verified `razorpay` dict
+    (order_id, payment_id, signature). Then updates the aggregates and push
+    targeting and notifies the admin and the user. Returns the payment
+    document; raises PaymentError."""
+    from pymongo.errors import DuplicateKeyError
+    user_oid = user_ref(user_id)
+    state = {}
+    kwargs = dict(transaction_id=transaction_id, order_id=order_id, razorpay=razorpay, month_year=month_year)
+    if mongo_supports_transactions():
+        # Create the stats document first: a duplicate-key race inside the
+        # transaction would abort it rather than be retried
+        try:
+            user_stats_collection.update_one(
+                {'user_id': user_ref_query(user_oid)},
+                {'$setOnInsert': {'user_id': user_oid, 'months_paid': 0, 'total_paid': 0.00,
+                                  'last_payment_month': None}},
+                upsert=True)
+        except DuplicateKeyError:
+            pass
+        with client.start_session() as session_:
+            payment, stats, user = session_.with_transaction(
+                lambda s: _complete_payment_writes(state, user_oid, session_=s, **kwargs))
+    else:
+        try:
+            payment, stats, user = _complete_payment_writes(state, user_oid, **kwargs)
+        except Exception:
+            # Nothing to roll back: hand the transaction id back if this call claimed it
+            if state.get('claimed'):
+                try:
+                    db['transactions'].update_one(
+                        {'transaction_id': transaction_id, 'claimed_by': user_oid},
+                        {'$unset': {'claimed_by': '', 'claimed_at': ''}}
+                    )
+                except Exception as e:
+                    print('payments: failed to release transaction claim', transaction_id, e)
+            raise
+
+    # The payment is committed: follow-up failures must not report it as failed
+    try:
+        record_payment_aggregates(user_oid, PAYMENT_AMOUNT)
+    except Exception as e:
+        print('payments: aggregate update failed:', e)
+    try:
+        sync_push_targeting(user_oid)
+    except Exception as e:
+        print('payments: push targeting sync failed:', e)
+
+    username = user.get('username') or ''
+    month = payment['month_year']
+    try:
+        via = 'UPI' if transaction_id else 'Razorpay'
+        reference = transaction_id or razorpay.get('payment_id') or razorpay['order_id']
+        send_admin_notification(
+            f'Payment Completed ({via})',
+            f"<strong>{escape(username)}</strong> completed payment for <strong>{escape(month)}</strong> — ₹{PAYMENT_AMOUNT:.0f}"
+            f"<br>Order/Ref: {escape(payment.get('order_id') or payment.get('razorpay_order_id') or '')}"
+            f"<br>Transaction: {escape(reference)}"
+        )
+    except Exception as e:
+        print('Admin notify failed:', e)
+    try:
+        if user.get('email'):
+            send_payment_approved(user['email'], username, month, PAYMENT_AMOUNT)
+    except Exception as e:
+        print('User payment confirmation email failed:', e)
+    return payment
+
+
+def complete_payment_from_params(user_id, params):
+    """Complete a payment from verification request fields (form or JSON):
+    a UPI transaction id, or a Razorpay signature when a client is configured."""
+    order_id = params.get('razorpay_order_id') or params.get('order_id')
+    payment_id = params.get('razorpay_payment_id') or params.get('payment_id')
+    signature = params.get('razorpay_signature') or params.get('signature')
+    txn_id = (params.get('transaction_id') or params.get('txn_id') or '').strip()
+    if txn_id:
+        return complete_payment(user_id, transaction_id=txn_id, order_id=order_id)
+    if razorpay_client and order_id:
+        try:
+            razorpay_client.utility.verify_payment_signature({
+                'razorpay_order_id': order_id,
+                'razorpay_payment_id': payment_id,
+                'razorpay_signature': signature
+            })
+        except Exception as e:
+            print('Razorpay signature verify failed:', e)
+            raise PaymentError('signature_verification_failed')
+        return complete_payment(user_id, razorpay={'order_id': order_id, 'payment_id': payment_id, 'signature': signature})
+    raise PaymentError('unsupported_verification_method')
+
+
 @app.route('/verify-razorpay-payment', methods=['POST'])
 def verify_razorpay_payment():
     """Verify Razorpay payment signature and update database"""
@@ -1887,140 +4788,13 @@ def verify_razorpay_payment():
         # Two supported verification modes:
         # 1) UPI/manual mode: client posts a transaction_id (preferred)
         # 2) Legacy Razorpay mode: verify Razorpay signature if client provides it
-        order_id = request.form.get('razorpay_order_id') or request.form.get('order_id')
-        # Legacy params (may be provided by Razorpay callbacks)
-        payment_id = request.form.get('razorpay_payment_id') or request.form.get('payment_id')
-        signature = request.form.get('razorpay_signature') or request.form.get('signature')
-
-        txn_id = (request.form.get('transaction_id') or request.form.get('txn_id') or '').strip()
-
-        payment_record = None
-
-        # If transaction_id supplied, verify against transactions collection
-        if txn_id:
-            transactions_collection = db['transactions']
-            txdoc = transactions_collection.find_one({'transaction_id': txn_id})
-            if not txdoc:
-                print('UPI txn not found:', txn_id)
-                return render_template('payment_failed.html')
-
-            # read amount safely
-            try:
-                amount = float(txdoc.get('amount', {}).get('$numberDouble', txdoc.get('amount') or 0))
-            except Exception:
-                try:
-                    amount = float(txdoc.get('amount') or 0)
-                except Exception:
-                    amount = 0.0
-
-            if abs(amount - 50.0) > 0.01:
-                print('UPI amount mismatch', amount)
-                return render_template('payment_failed.html')
-
-            # Ensure transaction not used
-            existing = monthly_payments_collection.find_one({'transaction_id': txn_id})
-            if existing:
-                print('Transaction already used', txn_id)
-                return render_template('payment_failed.html')
-
-            # Find pending payment by order_id if provided, else by user and month
-            if order_id:
-                payment_record = monthly_payments_collection.find_one({'order_id': order_id, 'user_id': session['user_id']})
-            if not payment_record:
-                # fallback: find pending for this user and month
-                payment_record = monthly_payments_collection.find_one({'user_id': session['user_id'], 'status': 'pending'})
-
-            if not payment_record:
-                print('No pending payment record found for user to attach txn', session['user_id'])
-                return render_template('payment_failed.html')
-
-            # Mark payment completed
-            monthly_payments_collection.update_one({'_id': payment_record['_id']}, {'$set': {
-                'status': 'completed',
-                'transaction_id': txn_id,
-                'amount': 50.00,
-                'approved_at': datetime.now(),
-                'approved_by': 'upi_manual'
-            }})
-        
-        if payment_record:
-            # Update payment status to completed
-            monthly_payments_collection.update_one(
-                {'_id': payment_record['_id']},
-                {
-                    '$set': {
-                        'status': 'completed',
-                        'razorpay_payment_id': payment_id,
-                        'razorpay_signature': signature,
-                        'approved_at': datetime.now(),
-                        'approved_by': 'razorpay_auto'
-                    }
-                }
-            )
-            
-            # Update user stats
-            user_stats = user_stats_collection.find_one({'user_id': session['user_id']})
-            if user_stats:
-                new_months_paid = user_stats.get('months_paid', 0) + 1
-                user_stats_collection.update_one(
-                    {'user_id': session['user_id']},
-                    {
-                        '$inc': {
-                                'months_paid': 1,
-                                'total_paid': 50.00
-                        },
-                        '$set': {
-                            'last_payment_month': payment_record['month_year']
-                        }
-                    }
-                )
-                
-                # Check if user qualifies for premium (3+ payments)
-                if new_months_paid >= 3:
-                    users_collection.update_one(
-                        {'_id': ObjectId(session['user_id'])},
-                        {'$set': {'is_premium': True}}
-                    )
-            else:
-                user_stats_collection.insert_one({
-                    'user_id': session['user_id'],
-                    'months_paid': 1,
-                    'total_paid': 50.00,
-                    'last_payment_month': payment_record['month_year']
-                })
-            
-            # Notify admin (non-blocking by default)
-            try:
-                send_admin_notification(
-                    "Payment Completed",
-                    f"<strong>{session['username']}</strong> successfully completed payment for <strong>{payment_record['month_year']}</strong>.<br>Order/Ref: {order_id or payment_record.get('order_id') or ''}<br>Transaction: {txn_id if txn_id else payment_record.get('transaction_id','N/A')}"
-                )
-            except Exception as e:
-                print('Admin notify failed:', e)
-
-            # Send confirmation email to the user (non-blocking)
-            try:
-                # Capture request/session-scoped values here so the background thread
-                # does NOT try to access Flask's `session` or request context.
-                user_email = payment_record.get('email') or session.get('email')
-                username = session.get('username')
-                month_year = payment_record['month_year']
-
-                import threading
-                threading.Thread(target=lambda e=user_email, u=username, m=month_year: send_payment_approved(e, u, m, 50.00), daemon=True).start()
-            except Exception:
-                # Fallback synchronous send (safe because values already captured)
-                try:
-                    send_payment_approved(payment_record.get('email') or session.get('email'), session.get('username'), payment_record['month_year'], 50.00)
-                except Exception as e:
-                    print('User payment confirmation email failed:', e)
-            
-            # Render success page directly to avoid intermediate redirect/pain flashes
-            return render_template('payment_success.html')
-        else:
-            return render_template('payment_failed.html')
+        complete_payment_from_params(session['user_id'], request.form)
+        # Render success page directly to avoid intermediate redirect/pain flashes
+        return render_template('payment_success.html')
+    except PaymentError as e:
+        print('Payment not completed:', e.message)
+        return render_template('payment_failed.html')
     except Exception as e:
-        # If razorpay client exists and signature was provided, we attempted verification
         print(f"Error verifying payment: {str(e)}")
         return render_template('payment_failed.html')
 
@@ -2034,109 +4808,11 @@ def verify_razorpay_payment_ajax():
     if 'user_id' not in session:
         return jsonify({'status': 'error', 'message': 'not_authenticated'}), 401
 
-    data = request.get_json() or {}
-    payment_id = data.get('razorpay_payment_id')
-    order_id = data.get('razorpay_order_id')
-    signature = data.get('razorpay_signature')
-
     try:
-        # If client provided a transaction_id in JSON, use UPI verification flow
-        txn_id = (data.get('transaction_id') or data.get('txn_id') or '').strip()
-        payment_record = None
-        if txn_id:
-            transactions_collection = db['transactions']
-            txdoc = transactions_collection.find_one({'transaction_id': txn_id})
-            if not txdoc:
-                return jsonify({'status': 'error', 'message': 'transaction not found'}), 404
-
-            try:
-                amount = float(txdoc.get('amount', {}).get('$numberDouble', txdoc.get('amount') or 0))
-            except Exception:
-                try:
-                    amount = float(txdoc.get('amount') or 0)
-                except Exception:
-                    amount = 0.0
-
-            if abs(amount - 50.0) > 0.01:
-                return jsonify({'status': 'error', 'message': 'amount mismatch'}), 400
-
-            # Ensure not already used
-            existing = monthly_payments_collection.find_one({'transaction_id': txn_id})
-            if existing:
-                return jsonify({'status': 'error', 'message': 'transaction already used'}), 400
-
-            # Find pending payment record (by order or by user)
-            if order_id:
-                payment_record = monthly_payments_collection.find_one({'order_id': order_id, 'user_id': session['user_id']})
-            if not payment_record:
-                payment_record = monthly_payments_collection.find_one({'user_id': session['user_id'], 'status': 'pending'})
-            if not payment_record:
-                return jsonify({'status': 'error', 'message': 'no_pending_payment'}), 404
-
-            # Mark completed
-            monthly_payments_collection.update_one({'_id': payment_record['_id']}, {'$set': {
-                'status': 'completed',
-                'transaction_id': txn_id,
-                'amount': 50.00,
-                'approved_at': datetime.now(),
-                'approved_by': 'upi_manual'
-            }})
-
-            # Update or create user stats
-            user_stats = user_stats_collection.find_one({'user_id': session['user_id']})
-            if user_stats:
-                user_stats_collection.update_one({'user_id': session['user_id']}, {'$inc': {'months_paid': 1, 'total_paid': 50.00}, '$set': {'last_payment_month': payment_record['month_year']}})
-                new_months = user_stats.get('months_paid', 0) + 1
-            else:
-                user_stats_collection.insert_one({'user_id': session['user_id'], 'months_paid': 1, 'total_paid': 50.00, 'last_payment_month': payment_record['month_year']})
-                new_months = 1
-
-            if new_months >= 3:
-                users_collection.update_one({'_id': ObjectId(session['user_id'])}, {'$set': {'is_premium': True}})
-
-            # notify admin
-            try:
-                send_admin_notification('Payment Completed (UPI)', f"<strong>{session['username']}</strong> verified a UPI payment (txn={txn_id}) for {payment_record['month_year']} — ₹50")
-            except Exception as e:
-                print('Admin notify failed for UPI (ajax):', e)
-
-            # send user email
-            try:
-                user_email = session.get('email')
-                username = session.get('username')
-                import threading
-                threading.Thread(target=lambda e=user_email, u=username, m=payment_record['month_year']: send_payment_approved(e, u, m, 50.00), daemon=True).start()
-            except Exception as e:
-                print('User email send failed for UPI (ajax):', e)
-
-            return jsonify({'status': 'ok'})
-
-        # Otherwise fall back to legacy signature verification if available
-        if razorpay_client:
-            try:
-                razorpay_client.utility.verify_payment_signature({'razorpay_order_id': order_id, 'razorpay_payment_id': payment_id, 'razorpay_signature': signature})
-            except Exception as e:
-                print('Razorpay signature verify failed (ajax):', e)
-                return jsonify({'status': 'error', 'message': 'signature_verification_failed'}), 400
-            # After successful signature verification, reuse existing logic by looking up payment_record and marking it completed
-            payment_record = monthly_payments_collection.find_one({'razorpay_order_id': order_id, 'user_id': session['user_id']})
-            if not payment_record:
-                return jsonify({'status': 'error', 'message': 'no_payment_record'}), 404
-            monthly_payments_collection.update_one({'_id': payment_record['_id']}, {'$set': {'status': 'completed', 'razorpay_payment_id': payment_id, 'razorpay_signature': signature, 'approved_at': datetime.now(), 'approved_by': 'razorpay_auto'}})
-            # update user stats & notify same as above
-            # ... reuse existing code path by returning ok and letting ajax handler above handle notifications in later code
-            try:
-                send_admin_notification('Payment Completed (Razorpay)', f"<strong>{session['username']}</strong> completed payment for {payment_record['month_year']}")
-            except Exception:
-                pass
-            try:
-                import threading
-                threading.Thread(target=lambda: send_payment_approved(session.get('email'), session.get('username'), payment_record['month_year'], 50.00), daemon=True).start()
-            except Exception:
-                pass
-            return jsonify({'status': 'ok'})
-
-        return jsonify({'status': 'error', 'message': 'unsupported_verification_method'}), 400
+        complete_payment_from_params(session['user_id'], request.get_json() or {})
+        return jsonify({'status': 'ok'})
+    except PaymentError as e:
+        return jsonify({'status': 'error', 'message': e.message}), e.status
     except Exception as e:
         print(f'Error verifying payment (ajax): {e}')
         return jsonify({'status': 'error', 'message': 'server_error'}), 500
@@ -2158,75 +4834,10 @@ def verify_upi_transaction():
         return jsonify({'status': 'error', 'message': 'transaction_id required'}), 400
 
     try:
-        # Look up transaction in the `transactions` collection
-        transactions_collection = db['transactions']
-        txdoc = transactions_collection.find_one({'transaction_id': txn})
-        if not txdoc:
-            return jsonify({'status': 'error', 'message': 'transaction not found'}), 404
-
-        # Basic sanity: amount approx 50
-        try:
-            amount = float(txdoc.get('amount', {}).get('$numberDouble', txdoc.get('amount') or 0))
-        except Exception:
-            # attempt direct numeric
-            try:
-                amount = float(txdoc.get('amount') or 0)
-            except Exception:
-                amount = 0.0
-
-        if abs(amount - 50.0) > 0.01:
-            return jsonify({'status': 'error', 'message': 'amount mismatch'}), 400
-
-        # Check if we already used this transaction id for a payment
-        existing = monthly_payments_collection.find_one({'transaction_id': txn})
-        if existing:
-            return jsonify({'status': 'error', 'message': 'transaction already used'}), 400
-
-        # Mark payment completed: create monthly payment record and update user stats
-        # Compute month_year as current month name + year
-        month_year = get_current_month_year()
-
-        # Insert monthly payment record
-        monthly_payments_collection.insert_one({
-            'user_id': session['user_id'],
-            'month_year': month_year,
-            'amount': 50.00,
-            'status': 'completed',
-            'transaction_id': txn,
-            'payment_date': datetime.now(),
-            'approved_at': datetime.now(),
-            'approved_by': 'upi_manual'
-        })
-
-        # Update or insert user stats
-        user_stats = user_stats_collection.find_one({'user_id': session['user_id']})
-        if user_stats:
-            user_stats_collection.update_one({'user_id': session['user_id']}, {'$inc': {'months_paid': 1, 'total_paid': 50.00}, '$set': {'last_payment_month': month_year}})
-            new_months = user_stats.get('months_paid', 0) + 1
-        else:
-            user_stats_collection.insert_one({'user_id': session['user_id'], 'months_paid': 1, 'total_paid': 50.00, 'last_payment_month': month_year})
-            new_months = 1
-
-        # If user now qualifies for premium, set it
-        if new_months >= 3:
-            users_collection.update_one({'_id': ObjectId(session['user_id'])}, {'$set': {'is_premium': True}})
-
-        # Notify admin
-        try:
-            send_admin_notification('Payment Completed (UPI)', f"<strong>{session.get('username')}</strong> verified a UPI payment (txn={txn}) for {month_year} — ₹50")
-        except Exception as e:
-            print('Admin notify failed for UPI:', e)
-
-        # Send user confirmation email in background
-        try:
-            user_email = session.get('email')
-            username = session.get('username')
-            import threading
-            threading.Thread(target=lambda e=user_email, u=username, m=month_year: send_payment_approved(e, u, m, 50.00), daemon=True).start()
-        except Exception as e:
-            print('User email send failed for UPI:', e)
-
+        complete_payment(session['user_id'], transaction_id=txn, month_year=get_current_month_year())
         return jsonify({'status': 'ok'})
+    except PaymentError as e:
+        return jsonify({'status': 'error', 'message': e.message}), e.status
     except Exception as e:
         print('Error verifying UPI transaction:', e)
         return jsonify({'status': 'error', 'message': 'internal_error'}), 500
@@ -2259,7 +4870,7 @@ def claim_reward():
     
     # Check if already claimed
     existing_claim = winner_claims_collection.find_one({
-        'user_id': session['user_id'],
+        'user_id': user_ref_query(session['user_id']),
         'winning_nation': winning_nation
     })
     
@@ -2279,7 +4890,7 @@ def claim_reward():
         reward_amount = round(total_pool / winner_count, 2) if winner_count > 0 else 0
         
         winner_claims_collection.insert_one({
-            'user_id': session['user_id'],
+            'user_id': user_ref(session['user_id']),
             'winning_nation': winning_nation,
             'reward_amount': reward_amount,
             'status': 'pending',
@@ -2291,7 +4902,7 @@ def claim_reward():
         # Notify admin about reward claim
         send_admin_notification(
             "New Reward Claim",
-            f"User <strong>{session['username']}</strong> has claimed a reward of <strong>₹{reward_amount}</strong> for supporting <strong>{winning_nation}</strong>. Please review in admin panel."
+            f"User <strong>{escape(session['username'])}</strong> has claimed a reward of <strong>₹{reward_amount}</strong> for supporting <strong>{escape(winning_nation)}</strong>. Please review in admin panel."
         )
     
     return redirect(url_for('reward_processing'))
@@ -2316,6 +4927,13 @@ def update_profile():
         {'$set': {'avatar_url': avatar_url}}
     )
     
+    # Keep the avatar shown on the leaderboard in sync
+    leaderboard_collection.update_one(
+        {'_id': ObjectId(session['user_id'])},
+        {'$set': {'avatar_url': avatar_url}}
+    )
+    leaderboard_cache.invalidate()
+
     session['avatar_url'] = avatar_url
     
     return jsonify({'success': True, 'message': 'Profile updated successfully'})
@@ -2350,7 +4968,7 @@ def user_profile():
     
     # Get user data
     user = users_collection.find_one({'_id': ObjectId(session['user_id'])})
-    user_stats = user_stats_collection.find_one({'user_id': session['user_id']})
+    user_stats = user_stats_collection.find_one({'user_id': user_ref_query(session['user_id'])})
     
     # Format created_at as string
     created_at = user.get('created_at')
@@ -2380,7 +4998,7 @@ def user_profile():
     
     # Get payment history
     payment_history_cursor = monthly_payments_collection.find(
-        {'user_id': session['user_id']},
+        {'user_id': user_ref_query(session['user_id'])},
         {'month_year': 1, 'amount': 1, 'status': 1, 'payment_date': 1, 'approved_at': 1}
     ).sort('payment_date', -1)
     payment_history = []
@@ -2415,59 +5033,74 @@ def admin_panel():
     
     # Get recent completed payments (instead of pending, since Razorpay auto-approves)
     completed_payments_data = []
-    for payment in monthly_payments_collection.find({'status': 'completed'}).sort('approved_at', -1).limit(50):
-        user = users_collection.find_one({'_id': ObjectId(payment['user_id'])})
-        if user:
-            # Format approved_at
-            approved_at = payment.get('approved_at')
-            if isinstance(approved_at, datetime):
-                approved_at_str = approved_at.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                approved_at_str = str(approved_at) if approved_at else None
-            
-            completed_payments_data.append((
-                str(payment['_id']),
-                payment['user_id'],
-                user['username'],
-                user.get('nation'),
-                payment['month_year'],
-                payment['amount'],
-                approved_at_str,
-                payment.get('razorpay_payment_id', 'N/A')
-            ))
+    completed_pipeline = [
+        {'$match': {'status': 'completed'}},
+        {'$sort': {'approved_at': -1}},
+        {'$limit': 50},
+        *user_lookup('user', {'username': 1, 'nation': 1})
+    ]
+    for payment in monthly_payments_collection.aggregate(completed_pipeline):
+        user = payment['user']
+        # Format approved_at
+        approved_at = payment.get('approved_at')
+        if isinstance(approved_at, datetime):
+            approved_at_str = approved_at.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            approved_at_str = str(approved_at) if approved_at else None
+
+        completed_payments_data.append((
+            str(payment['_id']),
+            str(payment['user_id']),
+            user['username'],
+            user.get('nation'),
+            payment['month_year'],
+            payment['amount'],
+            approved_at_str,
+            payment.get('razorpay_payment_id', 'N/A')
+        ))
     
     # Get pending reward claims (these still need manual approval for payout)
     pending_rewards_data = []
-    for claim in winner_claims_collection.find({'status': 'pending'}).sort('claimed_at', -1):
-        user = users_collection.find_one({'_id': ObjectId(claim['user_id'])})
-        if user:
-            # Format claimed_at
-            claimed_at = claim['claimed_at']
-            if isinstance(claimed_at, datetime):
-                claimed_at_str = claimed_at.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                claimed_at_str = str(claimed_at) if claimed_at else None
-            
-            pending_rewards_data.append((
-                str(claim['_id']),
-                user['username'],
-                claim['winning_nation'],
-                claim['reward_amount'],
-                claimed_at_str
-            ))
-    
-    # Get all users with their stats
+    claims_pipeline = [
+        {'$match': {'status': 'pending'}},
+        {'$sort': {'claimed_at': -1}},
+        *user_lookup('user', {'username': 1})
+    ]
+    for claim in winner_claims_collection.aggregate(claims_pipeline):
+        user = claim['user']
+        # Format claimed_at
+        claimed_at = claim['claimed_at']
+        if isinstance(claimed_at, datetime):
+            claimed_at_str = claimed_at.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            claimed_at_str = str(claimed_at) if claimed_at else None
+
+        pending_rewards_data.append((
+            str(claim['_id']),
+            user['username'],
+            claim['winning_nation'],
+            claim['reward_amount'],
+            claimed_at_str
+        ))
+    
+    # Get all users with their stats, joining user_stats and the completed
+    # payments totals through the user_id indexes in a single pipeline
     users_data = []
-    for user in users_collection.find({'nation': {'$ne': None}}):
+    users_pipeline = [
+        {'$match': {'nation': {'$ne': None}}},
+        {'$project': {'username': 1, 'nation': 1, 'is_premium': 1}},
+        *user_ref_lookup('user_stats', 'stats'),
+        *user_ref_lookup('monthly_payments', 'payments', pipeline=[
+            {'$match': {'status': 'completed'}},
+            {'$group': {'_id': None, 'total': {'$sum': '$amount'}, 'months': {'$sum': 1}}}
+        ])
+    ]
+    for user in users_collection.aggregate(users_pipeline):
         uid_str = str(user['_id'])
-        stats = user_stats_collection.find_one({'user_id': uid_str})
+        stats = user['stats'][0] if user.get('stats') else None
 
-        # Fallback: if stats.total_paid is missing or zero, compute total from completed payments
-        payments_pipeline = [
-            {'$match': {'user_id': uid_str, 'status': 'completed'}},
-            {'$group': {'_id': None, 'total': {'$sum': '$amount'}, 'months': {'$sum': 1}}}
-        ]
-        payments_res = list(monthly_payments_collection.aggregate(payments_pipeline))
+        # Fallback: if stats.total_paid is missing or zero, use the total from completed payments
+        payments_res = user.get('payments') or []
         payments_total = float(payments_res[0]['total']) if payments_res and payments_res[0].get('total') is not None else 0.00
         payments_months = int(payments_res[0]['months']) if payments_res and payments_res[0].get('months') is not None else 0
 
@@ -2632,18 +5265,17 @@ def set_winner():
             }
         )
         
-        # Send emails to all users
+        # Email all users from a background job; the panel polls its progress
         try:
-            send_winner_announcement_to_winners(winning_nation)
-            send_winner_announcement_to_losers(winning_nation)
-            send_admin_notification(
-                "Winner Declared",
-                f"World Cup winner has been set to <strong>{winning_nation}</strong>. All users have been notified via email."
-            )
+            job_id = submit_admin_job('winner-announcement', {'winning_nation': winning_nation},
+                                      campaigns=[f'winners:{winning_nation}', f'losers:{winning_nation}'],
+                                      created_by=session.get('user_id'))
         except Exception as e:
-            print(f"Error sending winner announcement emails: {e}")
+            print(f"Error queuing winner announcement emails: {e}")
+            return jsonify({'error': f'Winner set to {winning_nation}, but the announcement emails could not be queued: {e}'}), 500
         
-        return jsonify({'success': True, 'message': f'World Cup Winner set to {winning_nation}! All users have been notified.'})
+        return jsonify({'success': True, 'job_id': job_id,
+                        'message': f'World Cup Winner set to {winning_nation}! Users are being notified by email.'})
     
     return jsonify({'error': 'Invalid nation'}), 400
 
@@ -2728,14 +5360,31 @@ def add_security_headers(response):
     
     return response
 
-if __name__ == '__main__':
-    init_db()
-    # Start monthly reminder scheduler thread
+def _bootstrap_database():
+    # Gunicorn never calls init_db(): create missing indexes and build an empty leaderboard
     try:
-        import threading
-        t = threading.Thread(target=_monthly_scheduler_loop, daemon=True)
-        t.start()
+        ensure_indexes()
+    except Exception as e:
+        print('indexes: startup creation failed:', e)
+    try:
+        ensure_leaderboard()
     except Exception as e:
-        print('Could not start monthly scheduler thread:', e)
+        print('leaderboard: startup build failed:', e)
+
 
+def start_background():
+    """Start this process's background threads. Only the web entry points call
+    this (gunicorn's post_worker_init hook in gunicorn_config.py and
+    `python app.py`): CLI commands must not claim jobs or leases they would
+    abandon on exit."""
+    # Scheduled jobs run from every web process; their lease locks keep each run unique
+    start_scheduler()
+    start_email_outbox_workers()
+    start_campaign_resumer()
+    threading.Thread(target=_bootstrap_database, name='db-bootstrap', daemon=True).start()
+
+
+if __name__ == '__main__':
+    init_db()
+    start_background()
     app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
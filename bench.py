@@ -0,0 +1,107 @@
+"""Benchmark commands, kept out of the production module.
+
+Run them through Flask's CLI with this module as the app:
+
+    flask --app bench brevo-benchmark
+    flask --app bench email-render-benchmark
+"""
+import json
+import threading
+import time
+
+import click
+
+from app import (app, brevo_send_batch, BREVO_BATCH_SIZE, render_email, EmailCampaign,
+                 get_current_month_year, APP_LINK)
+
+
+def _brevo_stand_in(latency=0.0):
+    """Local HTTP server that answers like Brevo's /smtp/email; rejects
+    any request addressed to an @invalid recipient with a 400."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            versions = body.get('messageVersions') or [{'to': body.get('to', [])}]
+            if latency:
+                time.sleep(latency)
+            bad = any(t.get('email', '').endswith('@invalid') for v in versions for t in v.get('to', []))
+            status = 400 if bad else 201
+            out = json.dumps({'message': 'invalid email'} if bad else
+                             {'messageIds': [f'<{i}@stand-in>' for i in range(len(versions))]}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+            self.server.requests_seen += 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests_seen = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@app.cli.command('brevo-benchmark')
+@click.option('--messages', default=2000, help='Messages to send.')
+@click.option('--batch-size', default=BREVO_BATCH_SIZE, help='messageVersions per request.')
+@click.option('--invalid', default=3, help='Messages addressed to a rejected recipient.')
+@click.option('--latency', default=0.02, help='Simulated API latency per request (seconds).')
+def brevo_benchmark_command(messages, batch_size, invalid, latency):
+    """Measure Brevo throughput against a local stand-in: `flask --app bench brevo-benchmark`."""
+    server = _brevo_stand_in(latency)
+    api_url = f'http://127.0.0.1:{server.server_port}'
+    rejected = set(range(0, messages, max(1, messages // invalid))[:invalid]) if invalid else set()
+    batch = [(f'Reminder {i}', [f'user{i}@invalid' if i in rejected else f'user{i}@example.com'],
+              f'<p>Hi user{i}</p>') for i in range(messages)]
+    try:
+        for label, size in (('per-message', 1), ('messageVersions', batch_size)):
+            server.requests_seen = 0
+            started = time.perf_counter()
+            # Unpaced (limiter=None): this measures the transport, not the configured rate
+            results = brevo_send_batch(batch, api_key='benchmark', api_url=api_url, batch_size=size, limiter=None)
+            elapsed = time.perf_counter() - started
+            sent = sum(1 for ok, _ in results if ok)
+            print(f'{label:>16}: {sent}/{messages} sent, {len(results) - sent} rejected, '
+                  f'{server.requests_seen} requests, {messages / elapsed:.0f} msg/s')
+    finally:
+        server.shutdown()
+
+
+@app.cli.command('email-render-benchmark')
+@click.option('--recipients', default=5000, help='Recipients to render for.')
+def email_render_benchmark_command(recipients):
+    """Per-recipient render cost of bulk emails: `flask --app bench email-render-benchmark`."""
+    users = [{'username': f'supporter_{i}<&>', 'nation': 'Brazil'} for i in range(recipients)]
+    month = get_current_month_year()
+    cases = [
+        ('payment_reminder',
+         lambda u: render_email('payment_reminder', username=u['username'], month_year=month,
+                                reminder_type='start', app_link=APP_LINK),
+         lambda: EmailCampaign('payment_reminder', personal=('username',), month_year=month,
+                               reminder_type='start', app_link=APP_LINK),
+         lambda c, u: c.render(username=u['username'])),
+        ('loser_announcement',
+         lambda u: render_email('loser_announcement', username=u['username'],
+                                their_nation=u['nation'], winning_nation='Argentina'),
+         lambda: EmailCampaign('loser_announcement', personal=('username', 'their_nation'),
+                               winning_nation='Argentina'),
+         lambda c, u: c.render(username=u['username'], their_nation=u['nation'])),
+    ]
+    for name, full, build, personalise in cases:
+        started = time.perf_counter()
+        expected = [full(u) for u in users]
+        full_us = (time.perf_counter() - started) / recipients * 1e6
+        started = time.perf_counter()
+        campaign = build()
+        rendered = [personalise(campaign, u) for u in users]
+        campaign_us = (time.perf_counter() - started) / recipients * 1e6
+        same = 'identical' if rendered == expected else 'MISMATCH'
+        print(f'{name:>20}: full render {full_us:.1f} us/recipient, '
+              f'campaign {campaign_us:.1f} us/recipient ({same} output)')
@@ -25,3 +25,9 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+
+# ✅ Background threads (scheduler, outbox) — web workers only, never CLI commands
+def post_worker_init(worker):
+    from app import start_background
+    start_background()
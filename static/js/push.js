@@ -116,6 +116,24 @@
     }
   }
 
+  // Re-send an existing subscription so the server can link it to the signed-in
+  // user (it may have been created before login). Once linked, skip for the session.
+  async function syncExistingSubscription(reg){
+    try {
+      if (!reg || !window.Notification || Notification.permission !== 'granted') return;
+      if (sessionStorage.getItem('pushSubscriptionLinked')) return;
+      const subscription = await reg.pushManager.getSubscription();
+      if (!subscription) return;
+      const resp = await fetch('/subscribe', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(subscription.toJSON())
+      });
+      const j = await resp.json();
+      if (j && j.linked) sessionStorage.setItem('pushSubscriptionLinked', '1');
+    } catch (e) { console.error('[push] subscription sync failed', e); }
+  }
+
   // Expose a global helper for manual subscription (e.g., Bound to a button)
   window.pushHelper = {
     init: async function(){
@@ -139,10 +157,13 @@
   };
 
   // Auto-init in background (non-blocking)
+  function initPush(){
+    registerServiceWorker().then(syncExistingSubscription);
+  }
   if (document.readyState === 'complete' || document.readyState === 'interactive') {
-    registerServiceWorker();
+    initPush();
   } else {
-    window.addEventListener('DOMContentLoaded', registerServiceWorker);
+    window.addEventListener('DOMContentLoaded', initPush);
   }
 
   // Auto-request Notification permission for all users once only.
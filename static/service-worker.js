@@ -33,8 +33,11 @@ self.addEventListener('push', event => {
     data: payload.data || {},
   };
 
-  // If HTML is present, include flags so that on click we open the viewer
-  if (payload.data && payload.data.html) {
+  // Stored notification HTML: the push only carries the viewer URL
+  if (payload.data && payload.data.viewer_url) {
+    options.data.hasHtml = true;
+  } else if (payload.data && payload.data.html) {
+    // Older pushes embedded the HTML itself
     options.data.hasHtml = true;
     // Copy the html and allow_js flag into notification data so click handler
     // can forward them. NOTE: Some browsers may truncate large payloads.
@@ -50,6 +53,12 @@ self.addEventListener('notificationclick', event => {
   event.notification.close();
   const data = (event.notification && event.notification.data) || {};
 
+  // Stored HTML is rendered by /push-viewer/<id>
+  if (data.viewer_url) {
+    event.waitUntil(self.clients.openWindow(data.viewer_url));
+    return;
+  }
+
   // If payload included HTML, open the push viewer route with the HTML encoded in the URL
   if (data.hasHtml && data.html) {
     // Prefer direct html data if present (some browsers include it in notification data)